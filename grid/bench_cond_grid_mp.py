@@ -0,0 +1,60 @@
+"""
+Scaling of cond_grid_dag's data parallel trainer with the number of
+worker processes: median time per training step and trajectories/sec,
+with the minibatch split across the workers (--scaling strong) or
+growing with them (--scaling weak, --mbsize per worker).
+
+    python bench_cond_grid_mp.py --procs 1 2 4 8 16 32 --scaling strong --mbsize 128
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+import torch
+
+import cond_grid_dag
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--procs", default=[1, 2, 4, 8, 16, 32], nargs='+', type=int)
+parser.add_argument("--scaling", default='strong', choices=['strong', 'weak'])
+parser.add_argument("--mbsize", default=128, type=int,
+                    help="minibatch size, per worker with --scaling weak")
+parser.add_argument("--horizon", default=32, type=int)
+parser.add_argument("--n_train_steps", default=100, type=int)
+parser.add_argument("--out", default='bench_cond_grid_mp.json')
+
+
+def main(args):
+    results = []
+    for n in args.procs:
+        mbsize = args.mbsize * n if args.scaling == 'weak' else args.mbsize
+        if mbsize % n:
+            print(f'skipping {n} procs, minibatch {mbsize} does not split evenly')
+            continue
+        cargs = cond_grid_dag.parser.parse_args([
+            '--n_mp_procs', str(n), '--mbsize', str(mbsize), '--horizon', str(args.horizon),
+            '--n_train_steps', str(args.n_train_steps), '--n_distr_measurements', '1'])
+        cargs.save_path = None
+        t0 = time.perf_counter()
+        res = cond_grid_dag.main(cargs)
+        # the first step includes starting the workers
+        step = float(np.median(res['step_times'][1:]))
+        r = {'procs': n, 'mbsize': mbsize, 'seconds_per_step': step,
+             'trajectories_per_sec': mbsize / step,
+             'total_seconds': time.perf_counter() - t0}
+        results.append(r)
+        base = results[0]['trajectories_per_sec'] / results[0]['procs']
+        print(f'{n:3d} procs, minibatch {mbsize:5d}: {step * 1e3:8.1f}ms/step '
+              f'{r["trajectories_per_sec"]:9.0f} traj/s, '
+              f'efficiency {r["trajectories_per_sec"] / (base * n):.2f}')
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=1)
+    return results
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    torch.set_num_threads(1)
+    main(args)
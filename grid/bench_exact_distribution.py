@@ -0,0 +1,93 @@
+"""
+Time of grid_lattice.exact_terminal_distribution, the level by level
+exact distribution of a policy on the grid DAG, for a uniform policy
+an MLP policy over one-hot observations (as FlowNetAgent's) and the same
+MLP over index observations (--obs_type index).
+
+On small lattices the result is also checked against a plain Python
+propagation over a dict of states.
+
+    python bench_exact_distribution.py --horizon 8 32 64 --ndim 2 3 4
+"""
+import argparse
+import itertools
+import json
+import time
+from collections import defaultdict
+
+import numpy as np
+import torch
+
+import grid_lattice
+from toy_grid_dag import GridEnv, make_mlp
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--horizon", default=[8, 32, 64], nargs='+', type=int)
+parser.add_argument("--ndim", default=[2, 3, 4], nargs='+', type=int)
+parser.add_argument("--policies", default=['uniform', 'mlp', 'mlp-index'], nargs='+')
+parser.add_argument("--n_hid", default=64, type=int)
+parser.add_argument("--max_batch", default=2**16, type=int)
+parser.add_argument("--check_max_states", default=4096, type=int)
+parser.add_argument("--seed", default=0, type=int)
+parser.add_argument("--out", default='bench_exact_distribution.json')
+
+
+def reference_distribution(horizon, ndim, policy):
+    """propagates the mass state by state, in order of coordinate sum"""
+    states = sorted(itertools.product(range(horizon), repeat=ndim), key=sum)
+    p = defaultdict(float)
+    p[(0,) * ndim] = 1
+    end = {}
+    for s in states:
+        if max(s) == horizon - 1:
+            end[s] = p[s]
+            continue
+        pi = policy(torch.LongTensor([s]))[0].double().numpy()
+        end[s] = p[s] * pi[-1]
+        for i in range(ndim):
+            p[s[:i] + (s[i] + 1,) + s[i + 1:]] += p[s] * pi[i]
+    return np.float64([end[tuple(s)] for s in
+                       np.concatenate(list(grid_lattice.terminal_states(horizon, ndim)))])
+
+
+def make_policy(kind, horizon, ndim, n_hid):
+    if kind == 'uniform':
+        return lambda s: torch.full((s.shape[0], ndim + 1), 1 / (ndim + 1))
+    index = kind == 'mlp-index'
+    env = GridEnv(horizon, ndim, obs_type='index' if index else 'one-hot')
+    model = make_mlp([horizon * ndim, n_hid, n_hid, ndim + 1],
+                     index_obs=(ndim, 0) if index else None)
+    def policy(s):
+        with torch.no_grad():
+            return torch.softmax(model(torch.tensor(env.obs_batch(s.numpy()))), 1)
+    return policy
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    results = []
+    for horizon, ndim, kind in itertools.product(args.horizon, args.ndim, args.policies):
+        policy = make_policy(kind, horizon, ndim, args.n_hid)
+        t0 = time.perf_counter()
+        d = grid_lattice.exact_terminal_distribution(horizon, ndim, policy,
+                                                     max_batch=args.max_batch).numpy()
+        t = time.perf_counter() - t0
+        r = {'horizon': horizon, 'ndim': ndim, 'policy': kind, 'states': horizon ** ndim,
+             'seconds': t, 'mass_error': abs(d.sum() - 1)}
+        if horizon ** ndim <= args.check_max_states:
+            r['max_abs_diff_reference'] = float(np.abs(d - reference_distribution(
+                horizon, ndim, policy)).max())
+        results.append(r)
+        print(f'horizon={horizon:3d} ndim={ndim} {kind:>9s}: {t:8.2f}s '
+              f'|sum-1| {r["mass_error"]:.2e}' +
+              (f' vs reference {r["max_abs_diff_reference"]:.2e}'
+               if 'max_abs_diff_reference' in r else ''))
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=1, default=float)
+    return results
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,81 @@
+"""
+Environment steps/sec of a list of GridEnv's (stepped one by one, as the
+agents used to) against BatchGridEnv, with uniformly random actions over
+full trajectories.
+
+    python bench_grid_env.py --horizon 8 16 32 64 --ndim 2 3 4 5 6 --n 16 256
+"""
+import argparse
+import itertools
+import json
+import time
+
+import numpy as np
+
+from toy_grid_dag import GridEnv, BatchGridEnv, func_corners
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--horizon", default=[8, 16, 32, 64], nargs='+', type=int)
+parser.add_argument("--ndim", default=[2, 3, 4, 5, 6], nargs='+', type=int)
+parser.add_argument("--n", default=[16, 256], nargs='+', type=int, help="parallel envs")
+parser.add_argument("--min_time", default=1, type=float, help="seconds per measurement")
+parser.add_argument("--seed", default=0, type=int)
+parser.add_argument("--out", default='bench_grid_env.json')
+
+
+def run_list(envs, rng):
+    """one trajectory per env, returns the number of steps"""
+    ndim = envs[0].ndim
+    [e.reset() for e in envs]
+    active, steps = list(envs), 0
+    while len(active):
+        acts = rng.randint(0, ndim + 1, len(active))
+        step = [e.step(a) for e, a in zip(active, acts)]
+        active = [e for e, (_, _, d, _) in zip(active, step) if not d]
+        steps += len(step)
+    return steps
+
+
+def run_batch(env, rng):
+    env.reset()
+    steps = 0
+    while not env.done.all():
+        n = (~env.done).sum()
+        env.step(rng.randint(0, env.ndim + 1, n))
+        steps += n
+    return steps
+
+
+def steps_per_sec(f, min_time):
+    f() # warmup, also builds the lookup tables
+    t0 = time.perf_counter()
+    steps = 0
+    while time.perf_counter() - t0 < min_time:
+        steps += f()
+    return steps / (time.perf_counter() - t0)
+
+
+def main(args):
+    results = []
+    for horizon, ndim, n in itertools.product(args.horizon, args.ndim, args.n):
+        rng = np.random.RandomState(args.seed)
+        envs = [GridEnv(horizon, ndim, func=func_corners) for i in range(n)]
+        benv = BatchGridEnv(n, horizon, ndim, func=func_corners)
+        r = {'horizon': horizon, 'ndim': ndim, 'n': n,
+             'tables': benv._reward_table is not None,
+             'list': steps_per_sec(lambda: run_list(envs, rng), args.min_time),
+             'batch': steps_per_sec(lambda: run_batch(benv, rng), args.min_time)}
+        r['speedup'] = r['batch'] / r['list']
+        results.append(r)
+        print(f'horizon={horizon:3d} ndim={ndim} n={n:4d}: {r["list"]:10.0f} -> '
+              f'{r["batch"]:10.0f} steps/s x{r["speedup"]:.1f}' +
+              ('' if r['tables'] else ' (no tables)'))
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=1)
+    return results
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,66 @@
+"""
+Chain steps/sec of the MCMC baselines (MHAgent, MARSAgent), whose chains
+are stepped together on a BatchGridEnv, for growing numbers of chains.
+
+    python bench_mcmc.py --horizon 8 32 --ndim 2 4 --bufsize 16 1024 100000
+"""
+import argparse
+import itertools
+import json
+import time
+
+import numpy as np
+import torch
+
+import toy_grid_dag
+from toy_grid_dag import BatchGridEnv, MARSAgent, MHAgent, VisitedStates, func_corners
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--horizon", default=[8, 32], nargs='+', type=int)
+parser.add_argument("--ndim", default=[2, 4], nargs='+', type=int)
+parser.add_argument("--bufsize", default=[16, 1024, 16384, 100000], nargs='+', type=int,
+                    help="parallel chains")
+parser.add_argument("--methods", default=['mcmc', 'mars'], nargs='+')
+parser.add_argument("--min_time", default=1, type=float, help="seconds per measurement")
+parser.add_argument("--seed", default=0, type=int)
+parser.add_argument("--out", default='bench_mcmc.json')
+
+
+def steps_per_sec(agent, visited, n, min_time):
+    """chain steps/sec, and the total number of chain steps taken"""
+    agent.sample_many(n, visited) # warmup
+    t0 = time.perf_counter()
+    steps = 0
+    while time.perf_counter() - t0 < min_time:
+        agent.sample_many(n, visited)
+        steps += n
+    return steps / (time.perf_counter() - t0), steps + n
+
+
+def main(args):
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    results = []
+    for horizon, ndim, n, method in itertools.product(args.horizon, args.ndim, args.bufsize,
+                                                      args.methods):
+        targs = toy_grid_dag.parser.parse_args([
+            '--horizon', str(horizon), '--ndim', str(ndim), '--bufsize', str(n)])
+        targs.dev = torch.device('cpu')
+        envs = BatchGridEnv(n, horizon, ndim, func=func_corners)
+        agent = (MHAgent if method == 'mcmc' else MARSAgent)(targs, envs)
+        visited = VisitedStates(horizon, ndim, targs.num_empirical_loss)
+        sps, steps = steps_per_sec(agent, visited, n, args.min_time)
+        r = {'horizon': horizon, 'ndim': ndim, 'bufsize': n, 'method': method,
+             'steps_per_sec': sps, 'acceptance_rate': len(visited) / steps}
+        results.append(r)
+        print(f'horizon={horizon:3d} ndim={ndim} chains={n:6d} {method:>5s}: '
+              f'{sps:12.0f} chain steps/s, acceptance {r["acceptance_rate"]:.3f}')
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=1)
+    return results
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main(args)
@@ -2,10 +2,9 @@ import argparse
 import copy
 import gzip
 import heapq
-import itertools
 import os
 import pickle
-from collections import defaultdict
+import time
 from itertools import count, chain
 
 import numpy as np
@@ -16,6 +15,8 @@ import torch.nn as nn
 from torch.distributions.categorical import Categorical
 import torch.multiprocessing as mp
 
+import grid_lattice
+
 parser = argparse.ArgumentParser()
 
 parser.add_argument("--save_path", default='results/example_branincurrin.pkl.gz', type=str)
@@ -43,6 +44,8 @@ parser.add_argument("--n_mp_procs", default=4, type=int)
 # Env
 parser.add_argument('--func', default='BraninCurrin')
 parser.add_argument("--horizon", default=32, type=int)
+parser.add_argument("--obs_type", default='one-hot',
+                    choices=['one-hot', 'scalar', 'tab', 'index', 'tab-index'])
 
 
 
@@ -89,11 +92,26 @@ class GridEnv:
             self.num_obs_dim = self.ndim
         elif obs_type == 'tab':
             self.num_obs_dim = self.horizon ** self.ndim
-        
+        # 'index' and 'tab-index' are 'one-hot' and 'tab' given by the
+        # indices of their hot entries, for a OneHotLinear first layer
+        elif obs_type == 'index':
+            self.num_obs_dim = self.horizon * self.ndim
+        elif obs_type == 'tab-index':
+            self.num_obs_dim = self.horizon ** self.ndim
+        self.index_obs = None
+        if obs_type in ('index', 'tab-index'):
+            self.index_obs = (self.ndim if obs_type == 'index' else 1, self.num_cond_dim)
+
+    def obs_width(self):
+        """the width of the observations, num_obs_dim + num_cond_dim unless
+        they are index observations"""
+        if self.index_obs is not None:
+            return sum(self.index_obs)
+        return self.num_obs_dim + self.num_cond_dim
 
     def obs(self, s=None):
         s = np.int32(self._state if s is None else s)
-        z = np.zeros(self.num_obs_dim + self.num_cond_dim)
+        z = np.zeros(self.obs_width())
         if self.obs_type == 'one-hot':
             z = np.zeros((self.horizon * self.ndim + self.num_cond_dim), dtype=np.float32)
             z[np.arange(len(s)) * self.horizon + s] = 1
@@ -102,9 +120,29 @@ class GridEnv:
         elif self.obs_type == 'tab':
             idx = (s * (self.horizon ** np.arange(self.ndim))).sum()
             z[idx] = 1
+        elif self.obs_type == 'index':
+            z[:self.ndim] = np.arange(self.ndim) * self.horizon + s
+        elif self.obs_type == 'tab-index':
+            z[0] = (s * (self.horizon ** np.arange(self.ndim))).sum()
         z[-self.num_cond_dim:] = self.cond_obs
         return z
 
+    def obs_batch(self, s):
+        s = np.int64(s)
+        z = np.zeros((len(s), self.obs_width()), dtype=np.float32)
+        if self.obs_type == 'one-hot':
+            z[np.arange(len(s))[:, None], np.arange(self.ndim) * self.horizon + s] = 1
+        elif self.obs_type == 'scalar':
+            z[:, :self.ndim] = self.s2x(s)
+        elif self.obs_type == 'tab':
+            z[np.arange(len(s)), (s * (self.horizon ** np.arange(self.ndim))).sum(1)] = 1
+        elif self.obs_type == 'index':
+            z[:, :self.ndim] = np.arange(self.ndim) * self.horizon + s
+        elif self.obs_type == 'tab-index':
+            z[:, 0] = (s * (self.horizon ** np.arange(self.ndim))).sum(1)
+        z[:, -self.num_cond_dim:] = self.cond_obs
+        return z
+
     def s2x(self, s):
         return s / (self.horizon-1) * self.width + self.start
 
@@ -135,6 +173,26 @@ class GridEnv:
                 actions += [i]
         return parents, actions
 
+    def parent_states(self, s, used_stop_action):
+        """parent_transitions of a batch of states s (n, ndim), as flat
+        arrays: the parent states, the actions, and for each parent the
+        index in s of the state it leads to"""
+        s = np.int64(s)
+        stop = np.asarray(used_stop_action, dtype=bool)
+        # candidate parents: one per dimension, then the state itself for
+        # the stop action
+        ar = np.arange(self.ndim)
+        sp = np.repeat(s[:, None], self.ndim, 1)
+        sp[:, ar, ar] -= 1
+        # can't have a terminal parent
+        valid = (s > 0) & (sp.max(2) < self.horizon - 1) & ~stop[:, None]
+        idx, actions = np.nonzero(np.concatenate([valid, stop[:, None]], 1))
+        return np.concatenate([sp, s[:, None]], 1)[idx, actions], actions, idx
+
+    def parent_transitions_batch(self, s, used_stop_action):
+        parents, actions, idx = self.parent_states(s, used_stop_action)
+        return self.obs_batch(parents), actions, idx
+
 
     def step(self, a, s=None):
         _s = s
@@ -150,19 +208,41 @@ class GridEnv:
 
 
     def state_info(self):
-        all_int_states = np.float32(list(itertools.product(*[list(range(self.horizon))]*self.ndim)))
-        state_mask = (all_int_states == self.horizon-1).sum(1) <= 1
-        pos = all_int_states[state_mask].astype('float')
+        pos = np.concatenate(list(grid_lattice.terminal_states(self.horizon, self.ndim))).astype('float')
         s = pos / (self.horizon-1) * (self.xspace[-1] - self.xspace[0]) + self.xspace[0]
         r = np.stack([f(s) for f in self.funcs]).T
         return s, r, pos
 
     
     
-def make_mlp(l, act=nn.LeakyReLU, tail=[]):
-    """makes an MLP with no top layer activation"""
+class OneHotLinear(nn.Module):
+    """nn.Linear(in_features, out_features) for inputs whose first
+    in_features - num_dense entries are one-hot with k hot entries, given
+    instead by the indices of the hot entries: x is (n, k + num_dense),
+    its first k columns being indices (as floats, like the rest of the
+    observation). Same parameters and outputs as the Linear on the
+    one-hot inputs, a gather and sum instead of a mostly-zero matmul."""
+
+    def __init__(self, in_features, out_features, k, num_dense=0):
+        super().__init__()
+        lin = nn.Linear(in_features, out_features)
+        self.weight, self.bias = lin.weight, lin.bias
+        self.k = k
+        self.num_dense = num_dense
+
+    def forward(self, x):
+        out = self.weight.t()[x[:, :self.k].long()].sum(1) + self.bias
+        if self.num_dense:
+            out = out + x[:, self.k:] @ self.weight[:, -self.num_dense:].t()
+        return out
+
+
+def make_mlp(l, act=nn.LeakyReLU, tail=[], index_obs=None):
+    """makes an MLP with no top layer activation. With index_obs = (k,
+    num_dense), the first layer is a OneHotLinear"""
+    first = (lambda i, o: OneHotLinear(i, o, *index_obs)) if index_obs else nn.Linear
     return nn.Sequential(*(sum(
-        [[nn.Linear(i, o)] + ([act()] if n < len(l)-2 else [])
+        [[(first if n == 0 else nn.Linear)(i, o)] + ([act()] if n < len(l)-2 else [])
          for n, (i, o) in enumerate(zip(l, l[1:]))], []) + tail))
 
 
@@ -171,7 +251,7 @@ class FlowNet_TBAgent:
     def __init__(self, args, envs):
         self.model = make_mlp([envs[0].num_obs_dim + envs[0].num_cond_dim] +
                               [args.n_hid] * args.n_layers +
-                              [args.ndim+1])
+                              [args.ndim+1], index_obs=envs[0].index_obs)
         self.Z = make_mlp([envs[0].num_cond_dim] + [args.n_hid // 2] * args.n_layers + [1])
         self.model.to(args.dev)
         self.n_forward_logits = args.ndim+1
@@ -203,11 +283,12 @@ class FlowNet_TBAgent:
                 acts[ridx] = torch.tensor(racts)
             logp = cat.log_prob(acts)
             step = [i.step(a) for i,a in zip([e for d, e in zip(done, self.envs) if not d], acts)]
-            p_a = [self.envs[0].parent_transitions(sp_state, a == self.ndim)
-                   for a, (sp, r, done, sp_state) in zip(acts, step)]
+            _, _, pidx = self.envs[0].parent_states(np.stack([i[3] for i in step]),
+                                                     acts.numpy() == self.ndim)
+            num_parents = np.bincount(pidx, minlength=len(step))
             for i, (bi, lp, (_, r, d, sp)) in enumerate(zip(np.nonzero(np.logical_not(done))[0], logp, step)):
                 fwd_prob[bi].append(logp[i])
-                bck_prob[bi].append(torch.tensor(np.log(1/len(p_a[i][0]))).float())
+                bck_prob[bi].append(torch.tensor(np.log(1/num_parents[i])).float())
                 if d: bck_prob[bi].append(torch.tensor(np.log(r)).float())
                 #traj_mass[bi] = traj_mass[bi] + (
                 #    logp[i] - np.log(1/len(p_a[i][0])) - (np.log(r) if d else 0))
@@ -243,70 +324,68 @@ def make_opt(params, args):
 
 
 def compute_exact_dag_distribution(envs, agent, args):
+    """Terminal distribution of the agent's policy for each env's
+    conditioning, (num terminal states, len(envs))"""
     env = envs[0]
-    stack = [np.zeros(env.ndim, dtype=np.int32)]
-    state_prob = defaultdict(lambda: np.zeros(len(envs)))
-    state_prob[tuple(stack[0])] += 1
-    end_prob = {}
-    opened = {}
-    softmax = nn.Softmax(1)
-    asd = tqdm(total=env.horizon ** env.ndim, disable=not args.progress or 1, leave=False)
-    while len(stack):
-        asd.update(1)
-        s = stack.pop(0)
-        p = state_prob[tuple(s)]
-        if s.max() >= env.horizon - 1:
-            end_prob[tuple(s)] = p
-            continue
-        policy = softmax(agent.forward_logits(
-            torch.tensor(np.float32([i.obs(s) for i in envs])))).detach().numpy()
-        end_prob[tuple(s)] = p * policy[:, -1]
-        for i in range(env.ndim):
-            sp = s + 0
-            sp[i] += 1
-            state_prob[tuple(sp)] += policy[:, i] * p
-            if tuple(sp) not in opened:
-                opened[tuple(sp)] = 1
-                stack.append(sp)
-    asd.close()
-    all_int_states = np.int32(list(itertools.product(*[list(range(env.horizon))]*env.ndim)))
-    state_mask = (all_int_states == env.horizon-1).sum(1) <= 1
-    distribution = np.float32([
-        end_prob[i] for i in map(tuple,all_int_states[state_mask])])
-    return distribution
-
-def worker(args, agent, events, outq):
-    stop_event, backprop_barrier = events
+    softmax = nn.Softmax(-1)
+    def policy(s):
+        # one forward for all the states of a level and all the configs
+        obs = np.stack([i.obs_batch(s.numpy()) for i in envs], 1)
+        with torch.no_grad():
+            logits = agent.forward_logits(torch.tensor(obs).reshape((-1, obs.shape[-1])))
+        return softmax(logits).reshape(obs.shape[:2] + (-1,))
+    return np.float32(grid_lattice.exact_terminal_distribution(
+        env.horizon, env.ndim, policy, num_cond=len(envs)).numpy())
+
+def set_flat_grads(params, flat):
+    """sets the .grad of params to views of the flat vector flat"""
+    for p, g in zip(params, torch.split(flat, [p.numel() for p in params])):
+        p.grad = g.view_as(p)
+
+def worker(args, agent, rank, grads, events, outq):
+    """Data parallel worker: computes the gradient of its share of the
+    minibatch into its own slot grads[rank] of the shared (n_mp_procs,
+    num_params) buffer, then waits on the barrier for the parent to
+    average the slots and step, and on it again before sampling with the
+    updated (shared) parameters."""
+    stop_event, barrier = events
     torch.set_num_threads(1)
     torch.manual_seed(os.getpid())
     np.random.seed(os.getpid())
     mbs = args.mbsize // args.n_mp_procs
     
-    agent.envs = [GridEnv(args.horizon, args.ndim, funcs=agent.envs[0].funcs)
+    agent.envs = [GridEnv(args.horizon, args.ndim, funcs=agent.envs[0].funcs,
+                          obs_type=args.obs_type)
                   for i in range(mbs)]
+    params = list(agent.parameters())
 
     while not stop_event.is_set():
+        for p in params:
+            p.grad = None # local, the shared parameters have no .grad
         data = agent.sample_many(mbs)
         losses = agent.learn_from(-1, data) # returns (opt loss, *metrics)
         losses[0].backward()
+        grads[rank].copy_(torch.cat([p.grad.reshape(-1) for p in params]))
         outq.put([losses[0].item()] + list(losses[1:]))
-        backprop_barrier.wait()
+        barrier.wait() # gradients are ready
+        barrier.wait() # parameters are updated
 
         
 def main(args):
     args.dev = torch.device(args.device)
     args.ndim = 2 # Force this for Branin-Currin
     fs = [branin, currin]
-    envs = [GridEnv(args.horizon, args.ndim, funcs=fs)
+    envs = [GridEnv(args.horizon, args.ndim, funcs=fs, obs_type=args.obs_type)
             for i in range(args.mbsize)]
     
     agent = FlowNet_TBAgent(args, envs)
-    for i in agent.parameters():
-        i.grad = torch.zeros_like(i)
     agent.model.share_memory()
     agent.Z.share_memory()
 
     assert args.mbsize % args.n_mp_procs == 0
+    params = list(agent.parameters())
+    # one gradient slot per worker, averaged by the parent
+    grads = torch.zeros((args.n_mp_procs, sum(p.numel() for p in params))).share_memory_()
     
     opt = make_opt(agent.model.parameters(), args)
     optZ = make_opt(agent.Z.parameters(), args)
@@ -316,23 +395,24 @@ def main(args):
         ([a,1-a], temp)
         for a in np.linspace(0,1,11)
         for temp in [1,2,4,8,16]]
-    test_envs = [GridEnv(args.horizon, args.ndim, funcs=fs)
+    test_envs = [GridEnv(args.horizon, args.ndim, funcs=fs, obs_type=args.obs_type)
                  for i in range(len(cond_confs))]
 
-    stop_event, backprop_barrier = mp.Event(), mp.Barrier(args.n_mp_procs + 1)
+    stop_event, barrier = mp.Event(), mp.Barrier(args.n_mp_procs + 1)
     losses_q = mp.Queue()
 
     processes = [
-        mp.Process(target=worker, args=(args, agent, (stop_event, backprop_barrier), losses_q))
-        for i in range(args.n_mp_procs)]
+        mp.Process(target=worker, args=(args, agent, rank, grads, (stop_event, barrier), losses_q))
+        for rank in range(args.n_mp_procs)]
     [i.start() for i in processes]
     
     all_losses = []
     distributions = []
+    step_times = [] # sampling, backward and update, without the measurements
     progress_bar = tqdm(range(args.n_train_steps + 1), disable=not args.progress)
+    t0 = time.perf_counter()
     for t in progress_bar:
-        while backprop_barrier.n_waiting < args.n_mp_procs:
-            pass
+        barrier.wait() # the workers' gradients are ready
         for i in processes:
             all_losses.append(losses_q.get())
         if len(all_losses):
@@ -340,20 +420,22 @@ def main(args):
                 f'{np.mean([i[j] for i in all_losses[-100:]]):.5f}'
                 for j in range(len(all_losses[0]))]))
 
+        t1 = time.perf_counter()
         if t % (args.n_train_steps // args.n_distr_measurements) == 0:
             for cfg, env in zip(cond_confs, test_envs):
                 env.reset(*cfg)
             distributions.append(compute_exact_dag_distribution(test_envs, agent, args))
-        # Workers add to the .grad even if they take the mean of the
-        # loss, so let's divide here
-        [i.grad.mul_(1 / args.n_mp_procs) for i in agent.parameters()]
+        t2 = time.perf_counter()
+        # each worker's loss is a mean over its share of the minibatch
+        set_flat_grads(params, grads.mean(0))
         opt.step()
-        opt.zero_grad()
         optZ.step()
-        optZ.zero_grad()
         if t == args.n_train_steps:
             stop_event.set()
-        backprop_barrier.wait() # Trigger barrier passing
+        barrier.wait() # the workers can sample with the new parameters
+        t3 = time.perf_counter()
+        step_times.append(t3 - t0 - (t2 - t1))
+        t0 = t3
         
     [i.join() for i in processes]
     
@@ -367,6 +449,7 @@ def main(args):
                'final_distribution': final_distribution,
                'cond_confs': cond_confs,
                'state_info': envs[0].state_info(),
+               'step_times': np.float32(step_times),
                'args':args}
     if args.save_path is not None:
         root = os.path.split(args.save_path)[0]
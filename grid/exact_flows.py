@@ -0,0 +1,188 @@
+"""
+Exact flows of the grid DAG for a given reward, as a reference for the
+learned ones.
+
+With a uniform backward policy, the flow of a state is its stop flow
+R(s) (or R(s) for a forced terminal state, which has no other edge) plus
+the flow coming back from each child c, F(c) / num_parents(c). This is
+computed level by level (see grid_lattice) from the last level down,
+with array ops over each level. The edge flows are FlowNetAgent's
+parametrization (log edge flows, the last action being stop), so
+OracleFlows.q gives the Q-values a perfect flow matching agent would
+output. They can be compared with a learned model (compare_agent) or be
+regression targets to warm start one (warm_start).
+
+    python exact_flows.py --horizon 32 --ndim 4 --func corners
+    python exact_flows.py --results results/flow_insp_0.pkl.gz   # compare a trained agent
+"""
+import argparse
+import gzip
+import json
+import pickle
+import time
+
+import numpy as np
+import torch
+
+import grid_lattice
+
+
+def num_parents(s, horizon):
+    """number of non-stop parents of each state of s (n, ndim)"""
+    sp = s[:, None, :] - np.eye(s.shape[1], dtype=s.dtype)
+    return ((s > 0) & (sp.max(2) < horizon - 1)).sum(1)
+
+
+def exact_flows(horizon, ndim, func, xrange=(-1, 1)):
+    """(state flows (n,), edge flows (n, ndim+1)) over the flat lattice,
+    edge_flow[s, ndim] being the stop flow. States that can't be reached
+    have no flow, forced terminal states no edges."""
+    n = horizon ** ndim
+    order, bounds = grid_lattice.levels(horizon, ndim)
+    mult = horizon ** np.arange(ndim - 1, -1, -1, dtype=np.int64)
+    F = np.zeros(n)
+    G = np.zeros(n) # F(s) / num_parents(s), the flow of each edge into s
+    edge = np.zeros((n, ndim + 1))
+    for lo, hi in reversed(list(zip(bounds[:-1], bounds[1:]))):
+        idx = order[lo:hi]
+        s = idx[:, None] // mult % horizon
+        r = func(grid_lattice.states2x(s, horizon, xrange))
+        inner = (s < horizon - 1).all(1)
+        ii = idx[inner]
+        edge[ii, :ndim] = G[ii[:, None] + mult]
+        edge[ii, ndim] = r[inner]
+        F[idx] = np.where(inner, edge[idx].sum(1), r) * grid_lattice.terminal_mask(s, horizon)
+        npar = num_parents(s, horizon)
+        G[idx] = F[idx] / np.maximum(npar, 1) * (npar > 0)
+    return F, edge
+
+
+def flow_matching_residual(F, edge, horizon, ndim):
+    """max over reachable non-root states of |in flow - F(s)| / F(s)"""
+    mult = horizon ** np.arange(ndim - 1, -1, -1, dtype=np.int64)
+    inflow = np.zeros_like(F)
+    src = np.flatnonzero(edge[:, :ndim].sum(1) > 0)
+    for i in range(ndim):
+        np.add.at(inflow, src + mult[i], edge[src, i])
+    mask = F > 0
+    mask[0] = False
+    return float((np.abs(inflow - F)[mask] / F[mask]).max())
+
+
+class OracleFlows:
+    """Exact flows of the grid DAG for func, see exact_flows"""
+
+    def __init__(self, horizon, ndim, func, xrange=(-1, 1)):
+        self.horizon = horizon
+        self.ndim = ndim
+        t0 = time.time()
+        self.state_flow, self.edge_flow = exact_flows(horizon, ndim, func, xrange)
+        self.time = time.time() - t0
+        self._mult = horizon ** np.arange(ndim - 1, -1, -1, dtype=np.int64)
+
+    @property
+    def logZ(self):
+        return float(np.log(self.state_flow[0]))
+
+    def flat_index(self, s):
+        return (np.int64(s) * self._mult).sum(-1)
+
+    def inner_states(self):
+        """the states a FlowNetAgent takes actions from (no coordinate at horizon-1)"""
+        return np.concatenate([s[(s < self.horizon - 1).all(1)] for s in
+                               grid_lattice.terminal_states(self.horizon, self.ndim)])
+
+    def q(self, s):
+        """log edge flows of states s (n, ndim)"""
+        with np.errstate(divide='ignore'):
+            return np.log(self.edge_flow[self.flat_index(s)])
+
+    def policy(self, s):
+        e = self.edge_flow[self.flat_index(s)]
+        return e / e.sum(1, keepdims=True)
+
+
+def compare_agent(oracle, model, obs_batch, mbsize=2**14):
+    """Errors of model's Q-values (log edge flows) on every inner state"""
+    s = oracle.inner_states()
+    with torch.no_grad():
+        q = torch.cat([model(torch.tensor(obs_batch(s[i:i + mbsize])))
+                       for i in range(0, len(s), mbsize)]).double().numpy()
+    err = q - oracle.q(s)
+    learned_logZ = float(np.logaddexp.reduce(q[oracle.flat_index(s) == 0][0]))
+    return {'q_mse': float((err ** 2).mean()),
+            'q_max_abs': float(np.abs(err).max()),
+            'q_mse_per_action': (err ** 2).mean(0).tolist(),
+            'logZ': oracle.logZ,
+            'learned_logZ': learned_logZ}
+
+
+def warm_start(model, oracle, obs_batch, steps=1000, mbsize=256, learning_rate=1e-3):
+    """Regresses model's Q-values on the oracle's, returns the last loss"""
+    s = oracle.inner_states()
+    x, y = torch.tensor(obs_batch(s)), torch.tensor(oracle.q(s)).float()
+    dev = next(model.parameters()).device
+    opt = torch.optim.Adam(model.parameters(), learning_rate)
+    for t in range(steps):
+        i = torch.randint(0, len(s), (mbsize,))
+        loss = (model(x[i].to(dev)) - y[i].to(dev)).pow(2).mean()
+        opt.zero_grad()
+        loss.backward()
+        opt.step()
+    return loss.item()
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--horizon", default=8, type=int)
+parser.add_argument("--ndim", default=2, type=int)
+parser.add_argument('--func', default='corners')
+parser.add_argument("--results", default='', help="toy_grid_dag results to compare against, "
+                    "overrides the env args")
+parser.add_argument("--out", default='exact_flows.json')
+
+
+def main(args):
+    import toy_grid_dag
+    learned = None
+    obs_type = 'one-hot'
+    if args.results:
+        learned = pickle.load(gzip.open(args.results))
+        rargs = learned['args']
+        args.horizon, args.ndim, args.func = rargs.horizon, rargs.ndim, rargs.func
+        obs_type = getattr(rargs, 'obs_type', 'one-hot')
+    f = {'default': None,
+         'cos_N': toy_grid_dag.func_cos_N,
+         'corners': toy_grid_dag.func_corners,
+         'corners_floor_A': toy_grid_dag.func_corners_floor_A,
+         'corners_floor_B': toy_grid_dag.func_corners_floor_B,
+    }[args.func]
+    env = toy_grid_dag.GridEnv(args.horizon, args.ndim, func=f, obs_type=obs_type)
+    xrange = (env.xspace[0], env.xspace[-1])
+    oracle = OracleFlows(args.horizon, args.ndim, env.func, xrange)
+    td, end_states, _ = env.true_density()
+    # the oracle's policy must sample from the true density
+    d = grid_lattice.exact_terminal_distribution(
+        args.horizon, args.ndim, lambda s: torch.tensor(oracle.policy(s.numpy()))).numpy()
+    report = {'horizon': args.horizon, 'ndim': args.ndim, 'func': args.func,
+              'states': args.horizon ** args.ndim,
+              'seconds': oracle.time,
+              'logZ': oracle.logZ,
+              'flow_matching_residual': flow_matching_residual(
+                  oracle.state_flow, oracle.edge_flow, args.horizon, args.ndim),
+              'policy_vs_true_density_max_abs': float(np.abs(d - td).max())}
+    if learned is not None:
+        model = toy_grid_dag.make_mlp([args.horizon * args.ndim] +
+                                      [rargs.n_hid] * rargs.n_layers + [args.ndim + 1],
+                                      index_obs=toy_grid_dag.index_obs(rargs))
+        for p, v in zip(model.parameters(), learned['params']):
+            p.data = torch.tensor(v)
+        report['agent'] = compare_agent(oracle, model, env.obs_batch)
+    print(json.dumps(report, indent=1))
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=1)
+    return report
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,133 @@
+"""
+Vectorized enumeration of the horizon**ndim grid lattice, shared by the
+grid scripts.
+
+A state can be terminal iff at most one of its coordinates is horizon-1
+(with two or more, every parent already had one at horizon-1 and was
+terminal itself), so the terminal set, its rewards and the true density
+are computed in chunks of the lattice without walking the DAG. Densities
+are cached on disk, keyed by (horizon, ndim, xrange, func), so that
+sweeps over seeds only compute them once.
+
+The exact terminal distribution of a policy is computed by propagating
+probability mass through the lattice level by level (states with the
+same coordinate sum), with one batched policy evaluation per level.
+"""
+import hashlib
+import os
+
+import numpy as np
+import torch
+
+
+CHUNK_SIZE = 2**20 # lattice states per chunk
+
+
+def lattice_states(horizon, ndim, start, stop):
+    """int32 states with flat indices in [start, stop), in the order of
+    itertools.product"""
+    return np.int32(np.stack(np.unravel_index(np.arange(start, stop), [horizon] * ndim), 1))
+
+
+def terminal_mask(states, horizon):
+    return (states == horizon - 1).sum(1) <= 1
+
+
+def terminal_states(horizon, ndim, chunk_size=CHUNK_SIZE):
+    """Yields the terminal states of the lattice, chunk by chunk"""
+    n = horizon ** ndim
+    for i in range(0, n, chunk_size):
+        s = lattice_states(horizon, ndim, i, min(n, i + chunk_size))
+        yield s[terminal_mask(s, horizon)]
+
+
+def terminal_indices(horizon, ndim, chunk_size=CHUNK_SIZE):
+    """flat indices of the terminal states, in the order of terminal_states"""
+    n = horizon ** ndim
+    return np.concatenate([
+        i + np.flatnonzero(terminal_mask(lattice_states(horizon, ndim, i, min(n, i + chunk_size)),
+                                         horizon))
+        for i in range(0, n, chunk_size)])
+
+
+def levels(horizon, ndim, chunk_size=CHUNK_SIZE):
+    """flat indices sorted by level, and the boundaries of each level"""
+    n = horizon ** ndim
+    lv = np.zeros(n, dtype=np.int16)
+    for i in range(0, n, chunk_size):
+        lv[i:i + chunk_size] = lattice_states(horizon, ndim, i, min(n, i + chunk_size)).sum(1)
+    order = np.argsort(lv, kind='stable')
+    return order, np.concatenate([[0], np.cumsum(np.bincount(lv))])
+
+
+def exact_terminal_distribution(horizon, ndim, policy, num_cond=0, max_batch=2**16,
+                                device=torch.device('cpu')):
+    """P(x) for the terminal states x (in the order of terminal_states) of
+    the grid DAG under a policy.
+
+    policy maps a LongTensor of states (n, ndim) to the action
+    probabilities (n, ndim+1), the last action being stop, or with
+    num_cond > 0 to (n, num_cond, ndim+1) for that many conditioning
+    configurations at once. It is called on at most max_batch states at
+    a time, for the non-terminal states of each level in turn."""
+    n = horizon ** ndim
+    order, bounds = levels(horizon, ndim)
+    order = torch.as_tensor(order, device=device)
+    mult = torch.as_tensor(horizon ** np.arange(ndim - 1, -1, -1), device=device)
+    shape = (n, num_cond) if num_cond else (n,)
+    p = torch.zeros(shape, dtype=torch.float64, device=device) # mass flowing into each state
+    end = torch.zeros(shape, dtype=torch.float64, device=device) # mass ending in each state
+    p[0] = 1
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        idx = order[lo:hi]
+        s = idx[:, None] // mult % horizon
+        ps = p[idx]
+        done = (s == horizon - 1).any(1)
+        end[idx[done]] = ps[done]
+        idx, s, ps = idx[~done], s[~done], ps[~done]
+        for j in range(0, len(idx), max_batch):
+            pi = policy(s[j:j + max_batch]).to(device, torch.float64)
+            pj, ij = ps[j:j + max_batch], idx[j:j + max_batch]
+            end[ij] = pj * pi[..., -1]
+            for i in range(ndim):
+                p.index_add_(0, ij + mult[i], pj * pi[..., i])
+    return end[torch.as_tensor(terminal_indices(horizon, ndim), device=device)]
+
+
+def states2x(s, horizon, xrange):
+    return np.float32(s) / (horizon - 1) * (xrange[1] - xrange[0]) + xrange[0]
+
+
+def func_key(func):
+    """A key identifying func's code, None if it can't be cached"""
+    code = getattr(func, '__code__', None)
+    if code is None:
+        return None
+    h = hashlib.sha1(code.co_code + repr(code.co_consts).encode()).hexdigest()[:12]
+    name = func.__name__.replace('<', '').replace('>', '')
+    return f'{name}_{h}'
+
+
+def true_density(horizon, ndim, func, xrange=(-1, 1), cache_dir='', chunk_size=CHUNK_SIZE):
+    """(density, terminal states (n, ndim), rewards) of func over the
+    terminal states of the lattice"""
+    key = func_key(func)
+    path = None
+    if cache_dir and key is not None:
+        path = os.path.join(cache_dir, f'true_density_{horizon}_{ndim}_{xrange[0]}_{xrange[1]}_{key}.npz')
+        if os.path.exists(path):
+            d = np.load(path)
+            return d['density'], d['states'], d['rewards']
+    states, rewards = [], []
+    for s in terminal_states(horizon, ndim, chunk_size):
+        states.append(s)
+        rewards.append(func(states2x(s, horizon, xrange)))
+    states, rewards = np.concatenate(states), np.concatenate(rewards)
+    density = rewards / rewards.sum()
+    if path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        # concurrent runs may write the same file
+        tmp = f'{path}.{os.getpid()}.npz'
+        np.savez(tmp, density=density, states=states, rewards=rewards)
+        os.replace(tmp, path)
+    return density, states, rewards
@@ -2,11 +2,8 @@ import argparse
 import copy
 import gzip
 import heapq
-import itertools
 import os
 import pickle
-from collections import defaultdict
-from itertools import count
 
 import numpy as np
 from scipy.stats import norm
@@ -15,6 +12,9 @@ import torch
 import torch.nn as nn
 from torch.distributions.categorical import Categorical
 
+import exact_flows
+import grid_lattice
+
 
 parser = argparse.ArgumentParser()
 
@@ -40,15 +40,23 @@ parser.add_argument("--num_empirical_loss", default=200000, type=int,
 parser.add_argument('--func', default='corners')
 parser.add_argument("--horizon", default=8, type=int)
 parser.add_argument("--ndim", default=2, type=int)
+parser.add_argument("--obs_type", default='one-hot', choices=['one-hot', 'index'],
+                    help="index: the coordinates' one-hot indices, with OneHotLinear first layers")
+parser.add_argument("--density_cache", default='results/true_density_cache', type=str,
+                    help="where true densities are cached, '' to disable")
 
 # MCMC
 parser.add_argument("--bufsize", default=16, help="MCMC buffer size", type=int)
+parser.add_argument("--n_dataset_pts", default=50000, type=int,
+                    help="MARS keeps the last n (state, action) pairs to train on")
 
 # Flownet
 parser.add_argument("--bootstrap_tau", default=0., type=float)
 parser.add_argument("--replay_strategy", default='none', type=str) # top_k none
 parser.add_argument("--replay_sample_size", default=2, type=int)
 parser.add_argument("--replay_buf_size", default=100, type=float)
+parser.add_argument("--oracle_warm_start", default=0, type=int,
+                    help="steps of regression on the exact log edge flows before training")
 
 # PPO
 parser.add_argument("--ppo_num_epochs", default=32, type=int) # number of SGD steps per epoch
@@ -89,7 +97,8 @@ def func_cos_N(x):
 
 class GridEnv:
 
-    def __init__(self, horizon, ndim=2, xrange=[-1, 1], func=None, allow_backward=False):
+    def __init__(self, horizon, ndim=2, xrange=[-1, 1], func=None, allow_backward=False,
+                 density_cache='', obs_type='one-hot'):
         self.horizon = horizon
         self.start = [xrange[0]] * ndim
         self.ndim = ndim
@@ -102,15 +111,30 @@ class GridEnv:
                                               # MCMC ergodic env,
                                               # otherwise a DAG
         self._true_density = None
+        self.density_cache = density_cache
+        # with 'index', observations are the indices of the hot entries of
+        # the one-hot ones, see OneHotLinear
+        self.obs_type = obs_type
+        self.obs_dim = ndim if obs_type == 'index' else horizon * ndim
 
     def obs(self, s=None):
         s = np.int32(self._state if s is None else s)
+        if self.obs_type == 'index':
+            return np.float32(np.arange(len(s)) * self.horizon + s)
         z = np.zeros((self.horizon * self.ndim), dtype=np.float32)
         z[np.arange(len(s)) * self.horizon + s] = 1
         return z
 
+    def obs_batch(self, s):
+        s = np.int64(s)
+        if self.obs_type == 'index':
+            return np.float32(np.arange(self.ndim) * self.horizon + s)
+        z = np.zeros((len(s), self.horizon * self.ndim), dtype=np.float32)
+        z[np.arange(len(s))[:, None], np.arange(self.ndim) * self.horizon + s] = 1
+        return z
+
     def s2x(self, s):
-        return (self.obs(s).reshape((self.ndim, self.horizon)) * self.xspace[None, :]).sum(1)
+        return self.xspace[np.int64(s)]
 
     def reset(self):
         self._state = np.int32([0] * self.ndim)
@@ -132,6 +156,26 @@ class GridEnv:
                 actions += [i]
         return parents, actions
 
+    def parent_states(self, s, used_stop_action):
+        """parent_transitions of a batch of states s (n, ndim), as flat
+        arrays: the parent states, the actions, and for each parent the
+        index in s of the state it leads to"""
+        s = np.int64(s)
+        stop = np.asarray(used_stop_action, dtype=bool)
+        # candidate parents: one per dimension, then the state itself for
+        # the stop action
+        ar = np.arange(self.ndim)
+        sp = np.repeat(s[:, None], self.ndim, 1)
+        sp[:, ar, ar] -= 1
+        # can't have a terminal parent
+        valid = (s > 0) & (sp.max(2) < self.horizon - 1) & ~stop[:, None]
+        idx, actions = np.nonzero(np.concatenate([valid, stop[:, None]], 1))
+        return np.concatenate([sp, s[:, None]], 1)[idx, actions], actions, idx
+
+    def parent_transitions_batch(self, s, used_stop_action):
+        parents, actions, idx = self.parent_states(s, used_stop_action)
+        return self.obs_batch(parents), actions, idx
+
     def step(self, a, s=None):
         if self.allow_backward:
             return self.step_chain(a, s)
@@ -166,84 +210,206 @@ class GridEnv:
         return self.obs(s), self.func(self.s2x(s)), s, reverse_a
 
     def true_density(self):
-        if self._true_density is not None:
-            return self._true_density
-        all_int_states = np.int32(list(itertools.product(*[list(range(self.horizon))]*self.ndim)))
-        state_mask = np.array([len(self.parent_transitions(s, False)[0]) > 0 or sum(s) == 0
-                               for s in all_int_states])
-        all_xs = (np.float32(all_int_states) / (self.horizon-1) *
-                  (self.xspace[-1] - self.xspace[0]) + self.xspace[0])
-        traj_rewards = self.func(all_xs)[state_mask]
-        self._true_density = (traj_rewards / traj_rewards.sum(),
-                              list(map(tuple,all_int_states[state_mask])),
-                              traj_rewards)
+        """(density, terminal states, rewards), see grid_lattice.true_density"""
+        if self._true_density is None:
+            self._true_density = grid_lattice.true_density(
+                self.horizon, self.ndim, self.func, (self.xspace[0], self.xspace[-1]),
+                self.density_cache)
         return self._true_density
 
     def all_possible_states(self):
         """Compute quantities for debugging and analysis"""
-        # all possible action sequences
-        def step_fast(a, s):
-            s = s + 0
-            s[a] += 1
-            return s
-        f = lambda a, s: (
-            [np.int32(a)] if np.max(s) == self.horizon - 1 else
-            [np.int32(a+[self.ndim])]+sum([f(a+[i], step_fast(i, s)) for i in range(self.ndim)], []))
-        all_act_seqs = f([], np.zeros(self.ndim, dtype='int32'))
         # all RL states / intermediary nodes
-        all_int_states = list(itertools.product(*[list(range(self.horizon))]*self.ndim))
-        # Now we need to know for each partial action sequence what
-        # the corresponding states are. Here we can just count how
-        # many times we moved in each dimension:
-        all_traj_states = np.int32([np.bincount(i[:j], minlength=self.ndim+1)[:-1]
-                                   for i in all_act_seqs
-                                   for j in range(len(i))])
-        # all_int_states is ordered, so we can map a trajectory to its
-        # index via a sum
-        arr_mult = np.int32([self.horizon**(self.ndim-i-1)
-                             for i in range(self.ndim)])
-        all_traj_states_idx = (
-            all_traj_states * arr_mult[None, :]
-        ).sum(1)
-        # For each partial trajectory, we want the index of which trajectory it belongs to
-        all_traj_idxs = [[j]*len(i) for j,i in enumerate(all_act_seqs)]
-        # For each partial trajectory, we want the index of which state it leads to
-        all_traj_s_idxs = [(np.bincount(i, minlength=self.ndim+1)[:-1] * arr_mult).sum()
-                           for i in all_act_seqs]
-        # Vectorized
-        a = torch.cat(list(map(torch.LongTensor, all_act_seqs)))
-        u = torch.LongTensor(all_traj_states_idx)
-        v1 = torch.cat(list(map(torch.LongTensor, all_traj_idxs)))
-        v2 = torch.LongTensor(all_traj_s_idxs)
-        # With all this we can do an index_add, given
-        # pi(all_int_states):
+        all_int_states = grid_lattice.lattice_states(self.horizon, self.ndim, 0,
+                                                     self.horizon ** self.ndim)
+        state_mask = grid_lattice.terminal_mask(all_int_states, self.horizon)
+        arr_mult = torch.LongTensor(self.horizon ** np.arange(self.ndim - 1, -1, -1))
         def compute_all_probs(policy_for_all_states):
             """computes p(x) given pi(a|s) for all s"""
             dev = policy_for_all_states.device
-            pi_a_s = torch.log(policy_for_all_states[u, a])
-            q = torch.exp(torch.zeros(len(all_act_seqs), device=dev)
-                                      .index_add_(0, v1, pi_a_s))
-            q_sum = (torch.zeros((all_xs.shape[0],), device=dev)
-                     .index_add_(0, v2, q))
-            return q_sum[state_mask]
-        # some states aren't actually reachable
-        state_mask = np.bincount(all_traj_s_idxs, minlength=len(all_int_states)) > 0
+            mult = arr_mult.to(dev)
+            return grid_lattice.exact_terminal_distribution(
+                self.horizon, self.ndim, lambda s: policy_for_all_states[(s * mult).sum(1)],
+                device=dev).to(policy_for_all_states.dtype)
         # Let's compute the reward as well
-        all_xs = (np.float32(all_int_states) / (self.horizon-1) *
-                  (self.xspace[-1] - self.xspace[0]) + self.xspace[0])
+        all_xs = grid_lattice.states2x(all_int_states, self.horizon, (self.xspace[0], self.xspace[-1]))
         traj_rewards = self.func(all_xs)[state_mask]
         # All the states as the agent sees them:
-        all_int_obs = np.float32([self.obs(i) for i in all_int_states])
-        print(all_int_obs.shape, a.shape, u.shape, v1.shape, v2.shape)
+        all_int_obs = self.obs_batch(all_int_states)
         return all_int_obs, traj_rewards, all_xs, compute_all_probs
 
-def make_mlp(l, act=nn.LeakyReLU(), tail=[]):
-    """makes an MLP with no top layer activation"""
+
+class BatchGridEnv:
+    """n DAG GridEnv's stepped together, their states being one (n, ndim)
+    int array. Rewards and observations are looked up in tables over the
+    horizon**ndim lattice when it is small enough. step_chain steps MCMC
+    chains on the lattice instead, whose states are kept by the caller."""
+
+    def __init__(self, n, horizon, ndim=2, xrange=[-1, 1], func=None,
+                 max_table_states=2**22, max_obs_table_size=2**24, obs_type='one-hot'):
+        self.env = GridEnv(horizon, ndim, xrange, func, obs_type=obs_type) # for single state queries
+        self.n = n
+        self.horizon = horizon
+        self.ndim = ndim
+        self.func = self.env.func
+        self.xspace = self.env.xspace
+        self.num_states = horizon ** ndim
+        self.obs_type = obs_type
+        self.obs_dim = self.env.obs_dim
+        # flat index of a state, in the order of itertools.product
+        self._mult = horizon ** np.arange(ndim - 1, -1, -1, dtype=np.int64)
+        self._offsets = np.arange(ndim, dtype=np.int64) * horizon
+        self._reward_table = None
+        self._obs_table = None
+        if self.num_states <= max_table_states:
+            self._reward_table = self.func(self.xspace[self.all_states()])
+        if obs_type == 'one-hot' and self.num_states * horizon * ndim <= max_obs_table_size:
+            self._obs_table = self._obs(self.all_states())
+
+    def all_states(self):
+        return np.indices([self.horizon] * self.ndim).reshape((self.ndim, -1)).T
+
+    def flat_index(self, s):
+        return (s * self._mult).sum(-1)
+
+    def _obs(self, s):
+        if self.obs_type == 'index':
+            return torch.as_tensor(np.float32(s + self._offsets), device=_dev[0])
+        z = torch.zeros((s.shape[0], self.horizon * self.ndim), device=_dev[0])
+        return z.scatter_(1, torch.as_tensor(s + self._offsets, device=_dev[0]), 1)
+
+    def obs(self, s):
+        if self._obs_table is not None:
+            return self._obs_table[torch.as_tensor(self.flat_index(s), device=_dev[0])]
+        return self._obs(s)
+
+    def parent_transitions(self, s, used_stop_action):
+        """GridEnv.parent_transitions_batch as tensors, the last one being the
+        segment index for index_add_"""
+        parents, actions, idx = self.env.parent_states(s, used_stop_action)
+        return self.obs(parents), tl(actions), tl(idx)
+
+    def reward(self, s):
+        if self._reward_table is not None:
+            return self._reward_table[self.flat_index(s)]
+        return self.func(self.xspace[s])
+
+    def reset(self, n=None):
+        self.n = self.n if n is None else n
+        self.s = np.zeros((self.n, self.ndim), dtype=np.int64)
+        self.done = np.zeros(self.n, dtype=bool)
+        return self.obs(self.s)
+
+    def step(self, a, obs=True):
+        """Steps the envs that aren't done, a holding one action for each of
+        them. Returns their (obs, reward, done, state) and their indices."""
+        idx = np.flatnonzero(~self.done)
+        a = np.asarray(a)
+        s = self.s[idx]
+        move = np.flatnonzero(a < self.ndim)
+        s[move, a[move]] += 1
+        done = (s.max(1) >= self.horizon - 1) | (a == self.ndim)
+        r = np.zeros(len(idx))
+        r[done] = self.reward(s[done])
+        self.s[idx] = s
+        self.done[idx] = done
+        return self.obs(s) if obs else None, r, done, s, idx
+
+    def step_chain(self, a, s):
+        """GridEnv.step_chain for the states s (n, ndim) of n chains, a
+        holding one action in [0, 2*ndim) for each. Returns the new states,
+        their rewards and the actions reversing the moves."""
+        j = np.arange(len(s))
+        d = a % self.ndim
+        sp = s.copy()
+        sp[j, d] = np.clip(s[j, d] + np.where(a < self.ndim, 1, -1), 0, self.horizon - 1)
+        moved = sp[j, d] != s[j, d]
+        reverse_a = np.where(moved, (a + self.ndim) % (2 * self.ndim), a)
+        return sp, self.reward(sp), reverse_a
+
+class OneHotLinear(nn.Module):
+    """nn.Linear(in_features, out_features) for inputs whose first
+    in_features - num_dense entries are one-hot with k hot entries, given
+    instead by the indices of the hot entries: x is (n, k + num_dense),
+    its first k columns being indices (as floats, like the rest of the
+    observation). Same parameters and outputs as the Linear on the
+    one-hot inputs, a gather and sum instead of a mostly-zero matmul."""
+
+    def __init__(self, in_features, out_features, k, num_dense=0):
+        super().__init__()
+        lin = nn.Linear(in_features, out_features)
+        self.weight, self.bias = lin.weight, lin.bias
+        self.k = k
+        self.num_dense = num_dense
+
+    def forward(self, x):
+        out = self.weight.t()[x[:, :self.k].long()].sum(1) + self.bias
+        if self.num_dense:
+            out = out + x[:, self.k:] @ self.weight[:, -self.num_dense:].t()
+        return out
+
+
+def make_mlp(l, act=nn.LeakyReLU(), tail=[], index_obs=None):
+    """makes an MLP with no top layer activation. With index_obs = (k,
+    num_dense), the first layer is a OneHotLinear"""
+    first = (lambda i, o: OneHotLinear(i, o, *index_obs)) if index_obs else nn.Linear
     return nn.Sequential(*(sum(
-        [[nn.Linear(i, o)] + ([act] if n < len(l)-2 else [])
+        [[(first if n == 0 else nn.Linear)(i, o)] + ([act] if n < len(l)-2 else [])
          for n, (i, o) in enumerate(zip(l, l[1:]))], []) + tail))
 
 
+def index_obs(args):
+    """make_mlp's index_obs for args.obs_type"""
+    return (args.ndim, 0) if getattr(args, 'obs_type', 'one-hot') == 'index' else None
+
+
+class TransitionBuffer:
+    """Flow matching transitions as whole tensors, preallocated and grown
+    by doubling: per parent (parents, actions, idx), idx being the index of
+    the transition the parent leads to, and per transition (r, sp, done)"""
+
+    def __init__(self, obs_dim, capacity=1024):
+        f = lambda *shape: torch.zeros(shape, device=_dev[0])
+        l = lambda n: torch.zeros(n, dtype=torch.long, device=_dev[0])
+        self.parents, self.actions, self.idx = f(capacity, obs_dim), l(capacity), l(capacity)
+        self.r, self.sp, self.done = f(capacity), f(capacity, obs_dim), f(capacity)
+        self.num_parents = 0
+        self.num_transitions = 0
+
+    def clear(self):
+        self.num_parents = 0
+        self.num_transitions = 0
+
+    def _reserve(self, names, n):
+        for k in names:
+            t = getattr(self, k)
+            if t.shape[0] < n:
+                new = t.new_zeros((max(n, 2 * t.shape[0]),) + t.shape[1:])
+                new[:t.shape[0]] = t
+                setattr(self, k, new)
+
+    def add(self, parents, actions, idx, r, sp, done):
+        """Appends transitions, idx indexing the ones being added"""
+        p0, t0 = self.num_parents, self.num_transitions
+        p1, t1 = p0 + len(actions), t0 + len(r)
+        self._reserve(('parents', 'actions', 'idx'), p1)
+        self._reserve(('r', 'sp', 'done'), t1)
+        as_t = lambda x: torch.as_tensor(x, device=_dev[0])
+        self.parents[p0:p1] = as_t(parents)
+        self.actions[p0:p1] = as_t(actions)
+        self.idx[p0:p1] = as_t(idx) + t0
+        self.r[t0:t1] = as_t(r)
+        self.sp[t0:t1] = as_t(sp)
+        self.done[t0:t1] = as_t(done)
+        self.num_parents, self.num_transitions = p1, t1
+
+    def tensors(self):
+        """(parents, actions, idx, r, sp, done) views of the transitions"""
+        p, t = self.num_parents, self.num_transitions
+        return (self.parents[:p], self.actions[:p], self.idx[:p],
+                self.r[:t], self.sp[:t], self.done[:t])
+
+
 class ReplayBuffer:
     def __init__(self, args, env):
         self.buf = []
@@ -261,80 +427,80 @@ class ReplayBuffer:
         if not len(self.buf):
             return []
         idxs = np.random.randint(0, len(self.buf), self.sample_size)
-        return sum([self.generate_backward(*self.buf[i]) for i in idxs], [])
+        trajs = [self.generate_backward(*self.buf[i]) for i in idxs]
+        return [i for i in trajs if i is not None]
 
     def generate_backward(self, r, s0):
-        s = np.int8(s0)
-        os0 = self.env.obs(s)
+        """a trajectory ending in s0, in the format of TransitionBuffer.add"""
+        s = np.int64(s0)
         # If s0 is a forced-terminal state, the the action that leads
         # to it is s0.argmax() which .parents finds, but if it isn't,
         # we must indicate that the agent ended the trajectory with
         # the stop action
         used_stop_action = s.max() < self.env.horizon - 1
-        done = True
         # Now we work backward from that last transition
-        traj = []
+        states, stops = [], []
         while s.sum() > 0:
-            parents, actions = self.env.parent_transitions(s, used_stop_action)
-            # add the transition
-            traj.append([tf(i) for i in (parents, actions, [r], [self.env.obs(s)], [done])])
+            states.append(s + 0)
+            stops.append(used_stop_action)
             # Then randomly choose a parent state
             if not used_stop_action:
-                i = np.random.randint(0, len(parents))
-                a = actions[i]
-                s[a] -= 1
-            # Values for intermediary trajectory states:
+                _, actions, _ = self.env.parent_states(s[None], [False])
+                s[actions[np.random.randint(0, len(actions))]] -= 1
             used_stop_action = False
-            done = False
-            r = 0
-        return traj
+        if not len(states):
+            return None
+        parents, actions, idx = self.env.parent_transitions_batch(states, stops)
+        # only the last transition has a reward and is done
+        rs, done = np.zeros(len(states)), np.zeros(len(states))
+        rs[0], done[0] = r, 1
+        return parents, actions, idx, rs, self.env.obs_batch(states), done
 
 class FlowNetAgent:
     def __init__(self, args, envs):
         self.model = make_mlp([args.horizon * args.ndim] +
                               [args.n_hid] * args.n_layers +
-                              [args.ndim+1])
+                              [args.ndim+1], index_obs=index_obs(args))
         self.model.to(args.dev)
         self.target = copy.deepcopy(self.model)
         self.envs = envs
         self.ndim = args.ndim
         self.tau = args.bootstrap_tau
-        self.replay = ReplayBuffer(args, envs[0])
+        self.replay = ReplayBuffer(args, envs.env)
+        # filled by sample_many, emptied by the first sample_many following
+        # a learn_from
+        self.buffer = TransitionBuffer(envs.obs_dim)
+        self._learned = False
 
     def parameters(self):
         return self.model.parameters()
 
     def sample_many(self, mbsize, all_visited):
-        batch = []
-        batch += self.replay.sample()
-        s = tf([i.reset()[0] for i in self.envs])
-        done = [False] * mbsize
-        while not all(done):
-            # Note to self: this is ugly, ugly code
+        if self._learned:
+            self.buffer.clear()
+            self._learned = False
+        for traj in self.replay.sample():
+            self.buffer.add(*traj)
+        s = self.envs.reset(mbsize)
+        while len(s):
             with torch.no_grad():
-                acts = Categorical(logits=self.model(s)).sample()
-            step = [i.step(a) for i,a in zip([e for d, e in zip(done, self.envs) if not d], acts)]
-            p_a = [self.envs[0].parent_transitions(sp_state, a == self.ndim)
-                   for a, (sp, r, done, sp_state) in zip(acts, step)]
-            batch += [[tf(i) for i in (p, a, [r], [sp], [d])]
-                      for (p, a), (sp, r, d, _) in zip(p_a, step)]
-            c = count(0)
-            m = {j:next(c) for j in range(mbsize) if not done[j]}
-            done = [bool(d or step[m[i]][2]) for i, d in enumerate(done)]
-            s = tf([i[0] for i in step if not i[2]])
-            for (_, r, d, sp) in step:
-                if d:
-                    all_visited.append(tuple(sp))
-                    self.replay.add(tuple(sp), r)
-        return batch
+                acts = Categorical(logits=self.model(s)).sample().cpu().numpy()
+            sp, r, done, sp_state, _ = self.envs.step(acts)
+            parents, actions, idx = self.envs.parent_transitions(sp_state, acts == self.ndim)
+            self.buffer.add(parents, actions, idx, r, sp, done)
+            s = sp[torch.as_tensor(~done, device=sp.device)]
+            all_visited.extend(sp_state[done])
+            for x, rx in zip(sp_state[done], r[done]):
+                self.replay.add(tuple(x), rx)
+        return [] # the transitions are in self.buffer
 
 
     def learn_from(self, it, batch):
+        self._learned = True
         loginf = tf([1000])
-        batch_idxs = tl(sum([[i]*len(parents) for i, (parents,_,_,_,_) in enumerate(batch)], []))
-        parents, actions, r, sp, done = map(torch.cat, zip(*batch))
+        parents, actions, batch_idxs, r, sp, done = self.buffer.tensors()
         parents_Qsa = self.model(parents)[torch.arange(parents.shape[0]), actions.long()]
-        in_flow = torch.log(torch.zeros((sp.shape[0],))
+        in_flow = torch.log(torch.zeros((sp.shape[0],), device=sp.device)
                             .index_add_(0, batch_idxs, torch.exp(parents_Qsa)))
         if self.tau > 0:
             with torch.no_grad(): next_q = self.target(sp)
@@ -382,58 +548,59 @@ class MARSAgent:
     def __init__(self, args, envs):
         self.model = make_mlp([args.horizon * args.ndim] +
                               [args.n_hid] * args.n_layers +
-                              [args.ndim*2])
+                              [args.ndim*2], index_obs=index_obs(args))
         self.model.to(args.dev)
-        self.dataset = []
+        # ring buffer of the last dataset_max (state, action) pairs
         self.dataset_max = args.n_dataset_pts
+        self.dataset_s = np.zeros((self.dataset_max, args.ndim), dtype=np.int64)
+        self.dataset_a = np.zeros(self.dataset_max, dtype=np.int64)
+        self.dataset_n = 0
         self.mbsize = args.mbsize
         self.envs = envs
-        self.batch = [i.reset() for i in envs] # The N MCMC chains
         self.ndim = args.ndim
         self.bufsize = args.bufsize
+        # The N MCMC chains
+        self.s = np.zeros((self.bufsize, self.ndim), dtype=np.int64)
+        self.r = envs.reward(self.s)
 
     def parameters(self):
         return self.model.parameters()
 
+    def add_to_dataset(self, s, a):
+        s, a = s[-self.dataset_max:], a[-self.dataset_max:]
+        i = (self.dataset_n + np.arange(len(a))) % self.dataset_max
+        self.dataset_s[i], self.dataset_a[i] = s, a
+        self.dataset_n += len(a)
+
     def sample_many(self, mbsize, all_visited):
-        s = torch.cat([tf([i[0]]) for i in self.batch])
-        r = torch.cat([tf([i[1]]) for i in self.batch])
-        with torch.no_grad(): logits = self.model(s)
+        with torch.no_grad(): logits = self.model(self.envs.obs(self.s))
         pi = SplitCategorical(self.ndim, logits=logits)
-        a = pi.sample()
-        q_xpx = torch.exp(pi.log_prob(a))
-        steps = [self.envs[j].step(a[j].item(), s=self.batch[j][2]) for j in range(len(self.envs))]
-        sp = torch.cat([tf([i[0]]) for i in steps])
-        rp = torch.cat([tf([i[1]]) for i in steps])
-        with torch.no_grad(): logits_sp = self.model(sp)
-        reverse_a = tl([i[3] for i in steps])
-        pi_sp = SplitCategorical(self.ndim, logits=logits_sp)
-        q_xxp = torch.exp(pi.log_prob(reverse_a))
+        a = pi.sample().cpu().numpy()
+        sp, rp, reverse_a = self.envs.step_chain(a, self.s)
         # This is the correct MH acceptance ratio:
         #A = (rp * q_xxp) / (r * q_xpx + 1e-6)
+        # with q_xpx = pi(a|s) and q_xxp = pi_sp(reverse_a|sp)
 
         # But the paper suggests to use this ratio, for reasons poorly
         # explained... it does seem to actually work better? but still
         # diverges sometimes. Idk
-        A = rp / r
-        U = torch.rand(self.bufsize)
-        for j in range(self.bufsize):
-            if A[j] > U[j]: # Accept
-                self.batch[j] = (sp[j].numpy(), rp[j].item(), steps[j][2])
-                all_visited.append(tuple(steps[j][2]))
-            # Added `or U[j] < 0.05` for stability in these toy settings
-            if rp[j] > r[j] or U[j] < 0.05: # Add to dataset
-                self.dataset.append((s[j].unsqueeze(0), a[j].unsqueeze(0)))
+        A = rp / self.r
+        U = np.random.uniform(0, 1, self.bufsize)
+        # Added `or U < 0.05` for stability in these toy settings
+        add = (rp > self.r) | (U < 0.05)
+        self.add_to_dataset(self.s[add], a[add])
+        accept = A > U
+        self.s[accept], self.r[accept] = sp[accept], rp[accept]
+        all_visited.extend(sp[accept])
         return [] # agent is stateful, no need to return minibatch data
 
 
     def learn_from(self, i, data):
-        if not i % 20 and len(self.dataset) > self.dataset_max:
-            self.dataset = self.dataset[-self.dataset_max:]
-        if len(self.dataset) < self.mbsize:
+        n = min(self.dataset_n, self.dataset_max)
+        if n < self.mbsize:
             return None
-        idxs = np.random.randint(0, len(self.dataset), self.mbsize)
-        s, a = map(torch.cat, zip(*[self.dataset[i] for i in idxs]))
+        idxs = np.random.randint(0, n, self.mbsize)
+        s, a = self.envs.obs(self.dataset_s[idxs]), tl(self.dataset_a[idxs])
         logits = self.model(s)
         pi = SplitCategorical(self.ndim, logits=logits)
         q_xxp = pi.log_prob(a)
@@ -445,36 +612,45 @@ class MARSAgent:
 class MHAgent:
     def __init__(self, args, envs):
         self.envs = envs
-        self.batch = [i.reset() for i in envs] # The N MCMC chains
         self.bufsize = args.bufsize
         self.nactions = args.ndim*2
         self.model = None
+        # The N MCMC chains
+        self.s = np.zeros((self.bufsize, args.ndim), dtype=np.int64)
+        self.r = envs.reward(self.s)
 
     def parameters(self):
         return []
 
     def sample_many(self, mbsize, all_visited):
-        r = np.float32([i[1] for i in self.batch])
         a = np.random.randint(0, self.nactions, self.bufsize)
-        steps = [self.envs[j].step(a[j], s=self.batch[j][2]) for j in range(self.bufsize)]
-        rp = np.float32([i[1] for i in steps])
-        A = rp / r
+        sp, rp, _ = self.envs.step_chain(a, self.s)
+        A = rp / self.r
         U = np.random.uniform(0,1,self.bufsize)
-        for j in range(self.bufsize):
-            if A[j] > U[j]: # Accept
-                self.batch[j] = (None, rp[j], steps[j][2])
-                all_visited.append(tuple(steps[j][2]))
+        accept = A > U
+        self.s[accept], self.r[accept] = sp[accept], rp[accept]
+        all_visited.extend(sp[accept])
         return []
 
     def learn_from(self, *a):
         return None
 
 
+def group_by_trajectory(steps):
+    """Concatenates the per step tuples of tensors in steps, whose last
+    entry is the trajectory of each row, with the rows ordered by
+    trajectory then step"""
+    cols = [torch.cat(i, 0) for i in zip(*steps)]
+    order = np.argsort(cols[-1].cpu().numpy(), kind='stable')
+    order = torch.as_tensor(order, device=cols[-1].device)
+    return [i[order] for i in cols]
+
+
 class PPOAgent:
     def __init__(self, args, envs):
         self.model = make_mlp([args.horizon * args.ndim] +
                               [args.n_hid] * args.n_layers +
-                              [args.ndim+1+1]) # +1 for stop action, +1 for V
+                              [args.ndim+1+1], index_obs=index_obs(args)) # +1 for stop action, +1 for V
         self.model.to(args.dev)
         self.envs = envs
         self.mbsize = args.mbsize
@@ -485,41 +661,31 @@ class PPOAgent:
         return self.model.parameters()
 
     def sample_many(self, mbsize, all_visited):
-        batch = []
-        s = tf([i.reset()[0] for i in self.envs])
-        done = [False] * mbsize
-        trajs = defaultdict(list)
-        while not all(done):
-            # Note to self: this is ugly, ugly code as well
+        s = self.envs.reset(mbsize)
+        steps = [] # whole tensors per step, and the trajectory of each row
+        while len(s):
             with torch.no_grad():
                 pol = Categorical(logits=self.model(s)[:, :-1])
                 acts = pol.sample()
-            step = [i.step(a) for i,a in zip([e for d, e in zip(done, self.envs) if not d], acts)]
-            log_probs = pol.log_prob(acts)
-            c = count(0)
-            m = {j:next(c) for j in range(mbsize) if not done[j]}
-            for si, a, (sp, r, d, _), (traj_idx, _), lp in zip(s, acts, step, sorted(m.items()), log_probs):
-                trajs[traj_idx].append([si[None,:]] + [tf([i]) for i in (a, r, sp, d, lp)])
-            done = [bool(d or step[m[i]][2]) for i, d in enumerate(done)]
-            s = tf([i[0] for i in step if not i[2]])
-            for (_, r, d, sp) in step:
-                if d:
-                    all_visited.append(tuple(sp))
+            sp, r, done, sp_state, idx = self.envs.step(acts.cpu().numpy())
+            steps.append((s, acts, tf(r), sp, tf(done), pol.log_prob(acts), tl(idx)))
+            s = sp[torch.as_tensor(~done, device=sp.device)]
+            all_visited.extend(sp_state[done])
+        s, a, r, sp, d, lp, traj = group_by_trajectory(steps)
         # Compute advantages
-        for tau in trajs.values():
-            s, a, r, sp, d, lp = [torch.cat(i, 0) for i in zip(*tau)]
-            with torch.no_grad():
-                vs = self.model(s)[:, -1]
-                vsp = self.model(sp)[:, -1]
-            adv = r + vsp * (1-d) - vs
-            for i, A in zip(tau, adv):
-                i.append(r[-1].unsqueeze(0)) # The return is always just the last reward, gamma is 1
-                i.append(A.unsqueeze(0))
-        return sum(trajs.values(), [])
+        with torch.no_grad():
+            vs = self.model(s)[:, -1]
+            vsp = self.model(sp)[:, -1]
+        adv = r + vsp * (1-d) - vs
+        # The return is always just the last reward (the only non-zero
+        # one of the trajectory), gamma is 1
+        G = torch.zeros(mbsize, device=r.device).index_add_(0, traj, r)[traj]
+        return [(s, a, r, sp, d, lp, G, adv)]
 
     def learn_from(self, it, batch):
-        idxs = np.random.randint(0, len(batch), self.mbsize)
-        s, a, r, sp, d, lp, G, A = [torch.cat(i, 0) for i in zip(*[batch[i] for i in idxs])]
+        s, a, r, sp, d, lp, G, A = [torch.cat(i, 0) for i in zip(*batch)]
+        idxs = tl(np.random.randint(0, s.shape[0], self.mbsize))
+        s, a, lp, G, A = s[idxs], a[idxs], lp[idxs], G[idxs], A[idxs]
         o = self.model(s)
         logits, values = o[:, :-1], o[:, -1]
 
@@ -549,18 +715,11 @@ class RandomTrajAgent:
         return []
 
     def sample_many(self, mbsize, all_visited):
-        batch = []
-        [i.reset()[0] for i in self.envs]
-        done = [False] * mbsize
-        trajs = defaultdict(list)
-        while not all(done):
-            acts = np.random.randint(0, self.nact, mbsize)
-            step = [i.step(a) for i,a in zip([e for d, e in zip(done, self.envs) if not d], acts)]
-            c = count(0)
-            m = {j:next(c) for j in range(mbsize) if not done[j]}
-            done = [bool(d or step[m[i]][2]) for i, d in enumerate(done)]
-            for (_, r, d, sp) in step:
-                if d: all_visited.append(tuple(sp))
+        self.envs.reset(mbsize)
+        while not self.envs.done.all():
+            acts = np.random.randint(0, self.nact, (~self.envs.done).sum())
+            _, _, done, sp, _ = self.envs.step(acts, obs=False)
+            all_visited.extend(sp[done])
         return []
 
     def learn_from(self, it, batch):
@@ -571,19 +730,19 @@ class SACAgent:
         self.pol = make_mlp([args.horizon * args.ndim] +
                             [args.n_hid] * args.n_layers +
                             [args.ndim+1],
-                            tail=[nn.Softmax(1)])
+                            tail=[nn.Softmax(1)], index_obs=index_obs(args))
         self.Q_1 = make_mlp([args.horizon * args.ndim] +
                             [args.n_hid] * args.n_layers +
-                            [args.ndim+1])
+                            [args.ndim+1], index_obs=index_obs(args))
         self.Q_2 = make_mlp([args.horizon * args.ndim] +
                             [args.n_hid] * args.n_layers +
-                            [args.ndim+1])
+                            [args.ndim+1], index_obs=index_obs(args))
         self.Q_t1 = make_mlp([args.horizon * args.ndim] +
                             [args.n_hid] * args.n_layers +
-                            [args.ndim+1])
+                            [args.ndim+1], index_obs=index_obs(args))
         self.Q_t2 = make_mlp([args.horizon * args.ndim] +
                             [args.n_hid] * args.n_layers +
-                            [args.ndim+1])
+                            [args.ndim+1], index_obs=index_obs(args))
         self.envs = envs
         self.mbsize = args.mbsize
         self.tau = args.bootstrap_tau
@@ -595,24 +754,17 @@ class SACAgent:
                 list(self.Q_2.parameters()) + [self.alpha])
 
     def sample_many(self, mbsize, all_visited):
-        batch = []
-        s = tf([i.reset()[0] for i in self.envs])
-        done = [False] * mbsize
-        trajs = defaultdict(list)
-        while not all(done):
+        s = self.envs.reset(mbsize)
+        steps = [] # whole tensors per step, and the trajectory of each row
+        while len(s):
             with torch.no_grad():
                 pol = Categorical(probs=self.pol(s))
                 acts = pol.sample()
-            step = [i.step(a) for i,a in zip([e for d, e in zip(done, self.envs) if not d], acts)]
-            c = count(0)
-            m = {j:next(c) for j in range(mbsize) if not done[j]}
-            for si, a, (sp, r, d, _), (traj_idx, _) in zip(s, acts, step, sorted(m.items())):
-                trajs[traj_idx].append([si[None,:]] + [tf([i]) for i in (a, r, sp, d)])
-            done = [bool(d or step[m[i]][2]) for i, d in enumerate(done)]
-            s = tf([i[0] for i in step if not i[2]])
-            for (_, r, d, sp) in step:
-                if d: all_visited.append(tuple(sp))
-        return sum(trajs.values(), [])
+            sp, r, done, sp_state, idx = self.envs.step(acts.cpu().numpy())
+            steps.append((s, acts, tf(r), sp, tf(done), tl(idx)))
+            s = sp[torch.as_tensor(~done, device=sp.device)]
+            all_visited.extend(sp_state[done])
+        return [tuple(group_by_trajectory(steps)[:-1])]
 
     def learn_from(self, it, batch):
         s, a, r, sp, d = [torch.cat(i, 0) for i in zip(*batch)]
@@ -654,16 +806,57 @@ def make_opt(params, args):
     return opt
 
 
+class VisitedStates:
+    """The terminal states visited during training, logged as flat indices
+    into the horizon**ndim lattice, and the histogram of the last `window`
+    of them, updated as states enter and leave the window"""
+
+    def __init__(self, horizon, ndim, window):
+        self.horizon = horizon
+        self.ndim = ndim
+        self.window = window
+        self._mult = horizon ** np.arange(ndim - 1, -1, -1, dtype=np.int64)
+        self.log = np.zeros(1024, dtype=np.int64)
+        self.n = 0
+        self.hist = np.zeros(horizon ** ndim, dtype=np.int64)
+
+    def __len__(self):
+        return self.n
+
+    def flat_index(self, s):
+        return (np.int64(s) * self._mult).sum(-1)
+
+    def append(self, s):
+        self.extend([s])
+
+    def extend(self, states):
+        idx = self.flat_index(np.reshape(states, (-1, self.ndim)))
+        n0, n1 = self.n, self.n + len(idx)
+        if n1 > len(self.log):
+            log = np.zeros(max(n1, 2 * len(self.log)), dtype=np.int64)
+            log[:n0] = self.log[:n0]
+            self.log = log
+        self.log[n0:n1] = idx
+        self.n = n1
+        # the window goes from [n0 - window, n0) to [n1 - window, n1)
+        lo0, lo1 = max(0, n0 - self.window), max(0, n1 - self.window)
+        np.subtract.at(self.hist, self.log[lo0:min(lo1, n0)], 1)
+        np.add.at(self.hist, self.log[max(lo1, n0):n1], 1)
+
+    def states(self):
+        """all the visited states, (n, ndim)"""
+        return np.int8(np.stack(np.unravel_index(self.log[:self.n], [self.horizon] * self.ndim), 1))
+
+
 def compute_empirical_distribution_error(env, visited):
+    """L1 and KL between the true density and the histogram of visited's
+    window"""
     if not len(visited):
         return 1, 100
-    hist = defaultdict(int)
-    for i in visited:
-        hist[i] += 1
     td, end_states, true_r = env.true_density()
     true_density = tf(td)
-    Z = sum([hist[i] for i in end_states])
-    estimated_density = tf([hist[i] / Z for i in end_states])
+    hist = visited.hist[visited.flat_index(end_states)]
+    estimated_density = tf(hist / hist.sum())
     k1 = abs(estimated_density - true_density).mean().item()
     # KL divergence
     kl = (true_density * torch.log(estimated_density / true_density)).sum().item()
@@ -681,9 +874,10 @@ def main(args):
 
     args.is_mcmc = args.method in ['mars', 'mcmc']
 
-    env = GridEnv(args.horizon, args.ndim, func=f, allow_backward=args.is_mcmc)
-    envs = [GridEnv(args.horizon, args.ndim, func=f, allow_backward=args.is_mcmc)
-            for i in range(args.bufsize)]
+    env = GridEnv(args.horizon, args.ndim, func=f, allow_backward=args.is_mcmc,
+                  density_cache=args.density_cache, obs_type=args.obs_type)
+    envs = BatchGridEnv(args.bufsize if args.is_mcmc else args.mbsize, args.horizon,
+                        args.ndim, func=f, obs_type=args.obs_type)
     ndim = args.ndim
 
     if args.method == 'flownet':
@@ -699,11 +893,19 @@ def main(args):
     elif args.method == 'random_traj':
         agent = RandomTrajAgent(args, envs)
 
+    if args.method == 'flownet' and args.oracle_warm_start > 0:
+        oracle = exact_flows.OracleFlows(args.horizon, args.ndim, env.func,
+                                         (env.xspace[0], env.xspace[-1]))
+        loss = exact_flows.warm_start(agent.model, oracle, env.obs_batch, args.oracle_warm_start,
+                                      args.mbsize, args.learning_rate)
+        agent.target.load_state_dict(agent.model.state_dict())
+        print('warm start loss', loss, 'logZ', oracle.logZ)
+
     opt = make_opt(agent.parameters(), args)
 
     # metrics
     all_losses = []
-    all_visited = []
+    all_visited = VisitedStates(args.horizon, args.ndim, args.num_empirical_loss)
     empirical_distrib_losses = []
 
     ttsr = max(int(args.train_to_sample_ratio), 1)
@@ -730,7 +932,7 @@ def main(args):
 
         if not i % 100:
             empirical_distrib_losses.append(
-                compute_empirical_distribution_error(env, all_visited[-args.num_empirical_loss:]))
+                compute_empirical_distribution_error(env, all_visited))
             if args.progress:
                 k1, kl = empirical_distrib_losses[-1]
                 print('empirical L1 distance', k1, 'KL', kl)
@@ -744,7 +946,7 @@ def main(args):
         {'losses': np.float32(all_losses),
          #'model': agent.model.to('cpu') if agent.model else None,
          'params': [i.data.to('cpu').numpy() for i in agent.parameters()],
-         'visited': np.int8(all_visited),
+         'visited': all_visited.states(),
          'emp_dist_loss': empirical_distrib_losses,
          'true_d': env.true_density()[0],
          'args':args},
@@ -21,8 +21,9 @@ from botorch.fit import fit_gpytorch_model
 from botorch.models import SingleTaskGP
 from torch.utils.data import TensorDataset, DataLoader
 
-from toy_grid_dag import GridEnv, func_cos_N, func_corners_floor_A, func_corners_floor_B, func_corners
+from toy_grid_dag import GridEnv, BatchGridEnv, func_cos_N, func_corners_floor_A, func_corners_floor_B, func_corners
 from toy_grid_dag import make_mlp, make_opt, SplitCategorical, compute_empirical_distribution_error, set_device
+from toy_grid_dag import VisitedStates
 from toy_grid_dag import ReplayBuffer, FlowNetAgent, MARSAgent, MHAgent, RandomTrajAgent, PPOAgent
 
 
@@ -41,9 +42,14 @@ parser.add_argument("--bootstrap_tau", default=0.1, type=float)
 parser.add_argument("--kappa", default=0, type=float)
 parser.add_argument("--mbsize", default=16, help="Minibatch size", type=int)
 parser.add_argument("--bufsize", default=16, help="MCMC buffer size", type=int)
+parser.add_argument("--n_dataset_pts", default=50000, type=int,
+                    help="MARS keeps the last n (state, action) pairs to train on")
 parser.add_argument("--train_to_sample_ratio", default=1, type=float)
 parser.add_argument("--horizon", default=8, type=int)
 parser.add_argument("--ndim", default=4, type=int)
+parser.add_argument("--obs_type", default='one-hot', choices=['one-hot', 'index'])
+parser.add_argument("--density_cache", default='results/true_density_cache', type=str,
+                    help="where true densities are cached, '' to disable")
 parser.add_argument("--n_hid", default=256, type=int)
 parser.add_argument("--n_layers", default=2, type=int)
 parser.add_argument("--n_train_steps", default=300, type=int)
@@ -86,6 +92,8 @@ class UCB:
         self.kappa = kappa
 
     def __call__(self, x):
+        if np.ndim(x) > 1: # a batch of states, see BatchGridEnv.reward
+            return self.many(x).cpu().numpy()
         t_x = tf(np.array([[x]]))
         with torch.no_grad():
             output = self.model(t_x)
@@ -102,14 +110,12 @@ class UCB:
 def get_init_data(args, func):
     # Generate initial data to train proxy
     # import pdb; pdb.set_trace();
-    env = GridEnv(args.horizon, args.ndim, func=func)
+    env = GridEnv(args.horizon, args.ndim, func=func, density_cache=args.density_cache)
     td, end_states, true_r = env.true_density()
     idx = np.random.choice(len(end_states), args.num_init_points, replace=False)
-    end_states = np.array(end_states)
-    true_r = np.array(true_r)
     states, y = end_states[idx], true_r[idx]
     print(states[0])
-    x = np.array([env.s2x(s) for s in states])
+    x = env.xspace[states]
     init_data = x, y
     # data = np.dstack((end_states, true_r))[0]
     # np.random.shuffle(data)
@@ -225,9 +231,10 @@ def main(args):
 def train_generative_model(args, f):
     args.is_mcmc = args.method in ['mars', 'mcmc']
 
-    env = GridEnv(args.horizon, args.ndim, func=f, allow_backward=args.is_mcmc)
-    envs = [GridEnv(args.horizon, args.ndim, func=f, allow_backward=args.is_mcmc)
-            for i in range(args.bufsize)]
+    env = GridEnv(args.horizon, args.ndim, func=f, allow_backward=args.is_mcmc,
+                  obs_type=args.obs_type)
+    envs = BatchGridEnv(args.bufsize if args.is_mcmc else args.mbsize, args.horizon,
+                        args.ndim, func=f, obs_type=args.obs_type)
     ndim = args.ndim
 
     if args.method == 'flownet':
@@ -245,7 +252,7 @@ def train_generative_model(args, f):
 
     # metrics
     all_losses = []
-    all_visited = []
+    all_visited = VisitedStates(args.horizon, args.ndim, args.num_empirical_loss)
     empirical_distrib_losses = []
     ttsr = max(int(args.train_to_sample_ratio), 1)
     sttr = max(int(1/args.train_to_sample_ratio), 1) # sample to train ratio
@@ -271,7 +278,7 @@ def train_generative_model(args, f):
 
         if not i % 100:
             empirical_distrib_losses.append(
-                compute_empirical_distribution_error(env, all_visited[-args.num_empirical_loss:]))
+                compute_empirical_distribution_error(env, all_visited))
             if args.progress:
                 k1, kl = empirical_distrib_losses[-1]
                 print('empirical L1 distance', k1, 'KL', kl)
@@ -284,7 +291,7 @@ def train_generative_model(args, f):
     # pickle.dump(
     metrics = {'losses': np.float32(all_losses),
          'model': agent.model.to('cpu') if agent.model else None,
-         'visited': np.int8(all_visited),
+         'visited': all_visited.states(),
          'emp_dist_loss': empirical_distrib_losses}# ,
         #  'true_d': env.true_density()[0],
         #  'args':args} #,
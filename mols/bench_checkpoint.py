@@ -0,0 +1,131 @@
+"""
+Peak memory against step time for message passing checkpointing.
+
+Runs forward+backward of the flow model (see gflownet.make_model) on a
+fixed batch of seeded random molecules for each --segments value, 0
+being no checkpointing, each in a fresh process. Reports the step time,
+the peak RSS of the process, on torch >= 1.10 the bytes saved for
+backward during the forward pass (measured with saved tensor hooks), and
+on CUDA the peak allocated memory.
+
+    python bench_checkpoint.py --segments 0 1 2 5 10 --mbsize 256
+    python bench_checkpoint.py --repr_type atom_graph --model_version v4 --device cuda
+"""
+import argparse
+import json
+import resource
+import time
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from mol_mdp_ext import MolMDPExtended
+from bench_mdp import random_mols
+import gflownet
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--bpath", default="data/blocks_PDB_105.json")
+parser.add_argument("--repr_type", default='block_graph')
+parser.add_argument("--model_version", default='v4')
+parser.add_argument("--mbsize", default=128, type=int, help="molecules per batch")
+parser.add_argument("--max_blocks", default=8, type=int)
+parser.add_argument("--nemb", default=256, type=int)
+parser.add_argument("--num_conv_steps", default=10, type=int)
+parser.add_argument("--segments", default=[0, 1, 2, 5, 10], nargs='+', type=int)
+parser.add_argument("--repeat", default=5, type=int)
+parser.add_argument("--device", default='cpu')
+parser.add_argument("--seed", default=0, type=int)
+parser.add_argument("--out", default='bench_checkpoint.json')
+
+
+def saved_bytes(f):
+    """Calls f() and returns the total size of the tensors it saves for
+    backward, None without saved tensor hooks (torch < 1.10)"""
+    graph = getattr(torch.autograd, 'graph', None)
+    if not hasattr(graph, 'saved_tensors_hooks'):
+        return f(), None
+    total = [0]
+    def pack(t):
+        total[0] += t.numel() * t.element_size()
+        return t
+    with graph.saved_tensors_hooks(pack, lambda t: t):
+        out = f()
+    return out, total[0]
+
+
+def max_rss_mb():
+    """peak resident memory of this process (ru_maxrss is in KB on Linux)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_segments(args, segments, outq):
+    """Measures one --segments value, in its own process so that the peak
+    RSS is that of this setting only"""
+    device = torch.device(args.device)
+    rng = np.random.RandomState(args.seed)
+    mdp = MolMDPExtended(args.bpath)
+    mdp.post_init(device, args.repr_type)
+    mdp.build_translation_table()
+    mdp.floatX = torch.float
+    mols = [m for m, _ in random_mols(mdp, rng, args.mbsize, args.max_blocks)]
+    margs = gflownet.parser.parse_args([])
+    margs.repr_type = args.repr_type
+    margs.model_version = args.model_version
+    margs.nemb = args.nemb
+    margs.num_conv_steps = args.num_conv_steps
+    torch.manual_seed(args.seed)
+    margs.checkpoint_segments = segments
+    model = gflownet.make_model(margs, mdp)
+    model.to(device)
+
+    def step():
+        # forward overwrites the batch's features, so it is rebuilt
+        s = mdp.mols2batch([mdp.mol2repr(m) for m in mols])
+        t0 = time.perf_counter()
+        (stem_o, mol_o), nbytes = saved_bytes(lambda: model(s, None))
+        (stem_o.sum() + mol_o.sum()).backward()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        return time.perf_counter() - t0, nbytes
+
+    base_rss = max_rss_mb()
+    step() # warmup
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats()
+    times, nbytes = zip(*[step() for i in range(args.repeat)])
+    r = {'segments': segments,
+         'step_ms': float(np.median(times)) * 1000,
+         'peak_rss_mb': max_rss_mb(),
+         # what the steps add to the peak, setting up is the same for all
+         'step_rss_mb': max_rss_mb() - base_rss}
+    if nbytes[0] is not None:
+        r['saved_mb'] = nbytes[0] / 2**20
+    if device.type == 'cuda':
+        r['peak_cuda_mb'] = torch.cuda.max_memory_allocated() / 2**20
+    outq.put(r)
+
+
+def main(args):
+    ctx = mp.get_context('spawn')
+    results = []
+    for segments in args.segments:
+        outq = ctx.Queue()
+        p = ctx.Process(target=run_segments, args=(args, segments, outq))
+        p.start()
+        r = outq.get()
+        p.join()
+        results.append(r)
+        print(f'segments={segments:3d} step {r["step_ms"]:8.1f}ms '
+              f'peak RSS {r["peak_rss_mb"]:8.1f}MB (+{r["step_rss_mb"]:.1f}MB in the steps)' +
+              (f' saved for backward {r["saved_mb"]:8.1f}MB' if 'saved_mb' in r else '') +
+              (f' peak {r["peak_cuda_mb"]:8.1f}MB' if 'peak_cuda_mb' in r else ''))
+    with open(args.out, 'w') as f:
+        json.dump({'args': vars(args), 'results': results}, f, indent=1)
+    return results
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,157 @@
+"""
+End-to-end throughput of `gflownet.train_model_with_proxy` on CPU, with
+a synthetic reward instead of the pretrained proxy.
+
+For every point of the grid (mbsize x max_blocks x nemb x num_samplers
+x num_blocks), runs the trainer for --steps steps in a fresh process and
+reports trajectories/sec, transitions/sec, learner step latency
+percentiles and peak RSS. --num_blocks 105 uses data/blocks_PDB_105.json,
+other values use a generated library of that size (see synthetic.py).
+
+    python bench_e2e.py --num_samplers 1 4 8 --num_blocks 105 1000 --out e2e.json
+    python bench_e2e.py --modes execution default  # setup_execution's CPU settings vs torch's defaults
+    python bench_e2e.py --objectives fm tb      # flow matching vs trajectory balance
+    python bench_e2e.py --node_budgets 0 200    # mbsize trajectories vs 200 nodes per batch
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+import json
+import multiprocessing
+import os
+import resource
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--steps", default=100, type=int)
+parser.add_argument("--mbsize", default=[4], nargs='+', type=int)
+parser.add_argument("--max_blocks", default=[8], nargs='+', type=int)
+parser.add_argument("--nemb", default=[256], nargs='+', type=int)
+parser.add_argument("--num_samplers", default=[1, 4, 8], nargs='+', type=int)
+parser.add_argument("--num_blocks", default=[105], nargs='+', type=int)
+parser.add_argument("--repr_type", default='block_graph')
+parser.add_argument("--cpu_threads", default=0, type=int, help="cores to use, 0 for all")
+parser.add_argument("--modes", default=['execution'], nargs='+', choices=['execution', 'default'],
+                    help="execution: execution.setup_execution's CPU settings, "
+                    "default: float64 and torch's default threading")
+parser.add_argument("--objectives", default=['fm'], nargs='+', choices=['fm', 'tb', 'subtb'])
+parser.add_argument("--node_budgets", default=[0], nargs='+', type=int, help="0 uses mbsize")
+parser.add_argument("--seed", default=0, type=int)
+parser.add_argument("--out", default='bench_e2e.json')
+
+
+def run_config(cfg):
+    # imported here so that each config runs in a fresh process
+    import torch
+    import gflownet
+    import instrumentation
+    from execution import setup_execution
+    from synthetic import SyntheticProxy, write_block_library
+
+    torch.manual_seed(cfg['seed'])
+    if cfg['num_blocks'] == 105:
+        bpath = 'data/blocks_PDB_105.json'
+    else:
+        bpath = write_block_library(
+            os.path.join(tempfile.mkdtemp(), f'blocks_{cfg["num_blocks"]}.json'),
+            cfg['num_blocks'], seed=cfg['seed'])
+
+    args = gflownet.parser.parse_args([])
+    for k, v in gflownet.good_config.items():
+        setattr(args, k, v)
+    args.mbsize = cfg['mbsize']
+    args.max_blocks = cfg['max_blocks']
+    args.nemb = cfg['nemb']
+    args.num_samplers = cfg['num_samplers']
+    args.repr_type = cfg['repr_type']
+    args.objective = cfg['objective']
+    args.node_budget = cfg['node_budget']
+    args.progress = ''
+    args.production = True
+    args.instrument = True
+    args.instrument_every = 10**9
+    if cfg['mode'] == 'execution':
+        # float32, intra-op threads split between the learner and the samplers
+        args.device = 'cpu'
+        args.cpu_threads = cfg['cpu_threads']
+        device = setup_execution(args, sampler_threads=args.num_samplers)
+        args.floatX = torch.float
+    else:
+        device = torch.device('cpu')
+        args.floatX = torch.double
+
+    dataset = gflownet.Dataset(args, bpath, device, floatX=args.floatX)
+    model = gflownet.make_model(args, dataset.mdp, out_per_mol=1 + (args.objective == 'subtb'))
+    model.to(args.floatX)
+    model.to(device)
+    proxy = SyntheticProxy(dataset.mdp, seed=cfg['seed'])
+
+    # count the transitions produced by the samplers, batch[3] has one
+    # row per transition for both the fm and tb batches
+    transitions = [0]
+    lock = threading.Lock()
+    sample2batch = dataset.sample2batch
+    def counted_sample2batch(mb):
+        batch = sample2batch(mb)
+        with lock:
+            transitions[0] += batch[3].shape[0]
+        return batch
+    dataset.sample2batch = counted_sample2batch
+
+    t0 = time.time()
+    gflownet.train_model_with_proxy(args, model, proxy, dataset,
+                                    num_steps=cfg['steps'], do_save=False)
+    wall = time.time() - t0
+    stages = instrumentation.snapshot()['stages']
+    step_laps = ['sampler_wait', 'state_forward', 'parent_forward', 'loss',
+                 'backward', 'optimizer_step']
+    step = np.sum([[stages[k]['p50'], stages[k]['p90'], stages[k]['p99']]
+                   for k in step_laps if k in stages], 0)
+    return {**cfg,
+            'wall': wall,
+            'trajectories_per_sec': len(dataset.mol_store) / wall,
+            'transitions_per_sec': transitions[0] / wall,
+            'steps_per_sec': cfg['steps'] / wall,
+            # sum of the per-stage percentiles, an upper bound on the
+            # step latency percentiles
+            'step_latency_p50': step[0],
+            'step_latency_p90': step[1],
+            'step_latency_p99': step[2],
+            'stages': {k: v['p50'] for k, v in stages.items()},
+            'torch_threads': torch.get_num_threads(),
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+
+def main(args):
+    grid = itertools.product(args.mbsize, args.max_blocks, args.nemb,
+                             args.num_samplers, args.num_blocks, args.modes, args.objectives,
+                             args.node_budgets)
+    results = []
+    ctx = multiprocessing.get_context('spawn')
+    for mbsize, max_blocks, nemb, num_samplers, num_blocks, mode, objective, node_budget in grid:
+        cfg = dict(mbsize=mbsize, max_blocks=max_blocks, nemb=nemb,
+                   num_samplers=num_samplers, num_blocks=num_blocks, mode=mode,
+                   objective=objective, node_budget=node_budget,
+                   repr_type=args.repr_type, steps=args.steps, seed=args.seed,
+                   cpu_threads=args.cpu_threads)
+        with ProcessPoolExecutor(1, mp_context=ctx) as ex:
+            r = ex.submit(run_config, cfg).result()
+        results.append(r)
+        print(f'mbsize={mbsize} max_blocks={max_blocks} nemb={nemb} samplers={num_samplers} '
+              f'blocks={num_blocks} {mode} {objective} budget={node_budget}: {r["trajectories_per_sec"]:.1f} traj/s '
+              f'{r["transitions_per_sec"]:.1f} trans/s '
+              f'step p50 {r["step_latency_p50"]*1000:.1f}ms '
+              f'rss {r["peak_rss_mb"]:.0f}MB')
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=1, default=float)
+    return results
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main(args)
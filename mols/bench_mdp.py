@@ -0,0 +1,216 @@
+"""
+Microbenchmarks of the block MDP and representation hot paths.
+
+Times add_block_to, parents, mol_from_frag, mol2repr/mols2batch for each
+repr_type (morgan_fingerprint cold and with its per-state cache), the
+featurize+forward cost of a batch for each repr_type's model,
+GraphAgent.forward (eager and inference_forward, checking that they
+agree) and index_output_by_action, over seeded random molecules of 1 to
+max_blocks blocks. Runs on CPU and only needs the blocks file.
+
+    python bench_mdp.py --out bench_mdp.json
+    python bench_mdp.py --out new.json --compare bench_mdp.json
+
+With --compare, every benchmark slower than the baseline by more than
+--threshold (relative) is flagged, and the exit status is 1 if any is.
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+
+import numpy as np
+import torch
+
+from mol_mdp_ext import MolMDPExtended, BlockMoleculeDataExtended
+import model_atom, model_block, model_fingerprint
+import utils.chem as chem
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--bpath", default="data/blocks_PDB_105.json")
+parser.add_argument("--num_mols", default=500, type=int)
+parser.add_argument("--max_blocks", default=8, type=int)
+parser.add_argument("--mbsize", default=64, type=int)
+parser.add_argument("--nemb", default=256, type=int)
+parser.add_argument("--num_conv_steps", default=10, type=int)
+parser.add_argument("--repr_types", default=['block_graph', 'atom_graph', 'morgan_fingerprint'],
+                    nargs='+')
+parser.add_argument("--repeat", default=5, type=int)
+parser.add_argument("--seed", default=0, type=int)
+parser.add_argument("--torch_threads", default=0, type=int, help="0 leaves torch's default")
+parser.add_argument("--out", default='bench_mdp.json')
+parser.add_argument("--compare", default='', help="baseline json to compare against")
+parser.add_argument("--threshold", default=0.1, type=float)
+
+
+def random_mols(mdp, rng, n, max_blocks):
+    """Returns n (mol, actions) pairs, actions being the (block, stem)
+    sequence that builds mol from the empty molecule"""
+    out = []
+    for i in range(n):
+        m = BlockMoleculeDataExtended()
+        actions = []
+        for t in range(rng.randint(1, max_blocks + 1)):
+            if len(m.blocks) and not len(m.stems):
+                break
+            a = (rng.randint(mdp.num_blocks), rng.randint(max(1, len(m.stems))))
+            m = mdp.add_block_to(m, *a)
+            actions.append(a)
+        out.append((m, actions))
+    return out
+
+
+def timeit(f, make_items, repeat):
+    """Calls f on every item of make_items() (rebuilt, untimed, on every
+    repeat). Returns seconds per call: best and median over repeats."""
+    times = []
+    for r in range(repeat):
+        items = make_items()
+        t0 = time.perf_counter()
+        for x in items:
+            f(x)
+        times.append((time.perf_counter() - t0) / len(items))
+    return {'us_per_call': min(times) * 1e6,
+            'median_us': float(np.median(times)) * 1e6,
+            'calls': len(items)}
+
+
+def replay(mdp, actions):
+    m = BlockMoleculeDataExtended()
+    for a in actions:
+        m = mdp.add_block_to(m, *a)
+    return m
+
+
+def main(args):
+    if args.torch_threads:
+        torch.set_num_threads(args.torch_threads)
+    device = torch.device('cpu')
+    rng = np.random.RandomState(args.seed)
+    torch.manual_seed(args.seed)
+    mdp = MolMDPExtended(args.bpath)
+    mdp.post_init(device, 'block_graph')
+    mdp.build_translation_table()
+    mdp.floatX = torch.float
+    data = random_mols(mdp, rng, args.num_mols, args.max_blocks)
+    mols = [m for m, _ in data]
+    batches = [mols[i:i + args.mbsize] for i in range(0, len(mols), args.mbsize)]
+    results = {}
+
+    def run(name, f, make_items):
+        results[name] = timeit(f, make_items, args.repeat)
+        print(f'{name:>32s} {results[name]["us_per_call"]:12.1f} us')
+
+    run('add_block_to', lambda acts: replay(mdp, acts), lambda: [a for _, a in data])
+    run('parents', mdp.parents, lambda: mols)
+    run('mol_from_frag', lambda m: chem.mol_from_frag(jun_bonds=m.jbonds, frags=m.blocks),
+        lambda: mols)
+
+    for repr_type in args.repr_types:
+        mdp.repr_type = repr_type
+        try:
+            reprs = [mdp.mol2repr(m) for m in mols[:2]]
+            mdp.mols2batch(reprs)
+        except Exception as e:
+            print(f'{repr_type}: skipped ({e!r})')
+            results[f'{repr_type}/error'] = repr(e)
+            continue
+        if repr_type == 'morgan_fingerprint':
+            run(f'{repr_type}/mol2repr_uncached', mdp.mol2repr,
+                lambda: model_fingerprint.clear_fp_cache() or mols)
+        run(f'{repr_type}/mol2repr', mdp.mol2repr, lambda: mols)
+        run(f'{repr_type}/mols2batch', mdp.mols2batch,
+            lambda: [[mdp.mol2repr(m) for m in b] for b in batches])
+
+    # featurization (cached for fingerprints) and forward of a batch, i.e.
+    # what a sampler pays per step with each representation
+    make_models = {
+        'block_graph': lambda: model_block.GraphAgent(
+            nemb=args.nemb, nvec=0, out_per_stem=mdp.num_blocks, out_per_mol=1,
+            num_conv_steps=args.num_conv_steps, mdp_cfg=mdp, version='v4'),
+        'atom_graph': lambda: model_atom.MolAC_GCN(
+            nhid=args.nemb, nvec=0, num_out_per_stem=mdp.num_blocks, num_out_per_mol=1,
+            num_conv_steps=args.num_conv_steps, version='v4'),
+        'morgan_fingerprint': lambda: model_fingerprint.MFP_MLP(
+            args.nemb, 0, mdp.num_blocks, 1)}
+    for repr_type in args.repr_types:
+        if repr_type not in make_models or f'{repr_type}/error' in results:
+            continue
+        mdp.repr_type = repr_type
+        model = make_models[repr_type]().eval()
+        with torch.no_grad():
+            run(f'{repr_type}/batch_forward',
+                lambda b: model(mdp.mols2batch([mdp.mol2repr(m) for m in b]), None),
+                lambda: batches)
+
+    mdp.repr_type = 'block_graph'
+    model = model_block.GraphAgent(nemb=args.nemb, nvec=0, out_per_stem=mdp.num_blocks,
+                                   out_per_mol=1, num_conv_steps=args.num_conv_steps,
+                                   mdp_cfg=mdp, version='v4')
+    model.eval()
+    # forward() overwrites the batch's features, so batches are rebuilt
+    # for every repeat
+    make_batches = lambda: [mdp.mols2batch([mdp.mol2repr(m) for m in b]) for b in batches]
+    with torch.no_grad():
+        model.fused_inference = False
+        run('GraphAgent.forward', model, make_batches)
+        model.fused_inference = True
+        run('GraphAgent.inference_forward', model, make_batches)
+        # largest difference between the two paths' outputs
+        diff = 0
+        for b in batches:
+            model.fused_inference = False
+            eager = model(mdp.mols2batch([mdp.mol2repr(m) for m in b]))
+            model.fused_inference = True
+            fused = model(mdp.mols2batch([mdp.mol2repr(m) for m in b]))
+            diff = max([diff] + [(x - y).abs().max().item() for x, y in zip(eager, fused)])
+        results['GraphAgent.inference_forward/max_abs_diff'] = diff
+        print(f'{"inference_forward max abs diff":>32s} {diff:12.3g}')
+        def make_outputs():
+            out = []
+            for b in make_batches():
+                stem_o, mol_o = model(b)
+                # one random (block, stem) action per molecule
+                a = torch.tensor([(rng.randint(mdp.num_blocks), rng.randint(n))
+                                  for n in np.diff(b.__slices__['stems'])], dtype=torch.long)
+                out.append((b, stem_o, mol_o[:, 0], a))
+            return out
+        run('GraphAgent.index_output_by_action',
+            lambda x: model.index_output_by_action(*x), make_outputs)
+
+    report = {'meta': {'args': vars(args),
+                       'torch': torch.__version__,
+                       'torch_threads': torch.get_num_threads(),
+                       'python': platform.python_version(),
+                       'machine': platform.machine(),
+                       'time': time.time()},
+              'results': results}
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=1)
+    if args.compare:
+        return compare(report, args.compare, args.threshold)
+    return 0
+
+
+def compare(report, baseline_path, threshold):
+    with open(baseline_path) as f:
+        baseline = json.load(f)['results']
+    regressions = 0
+    for name, r in report['results'].items():
+        if not isinstance(r, dict) or not isinstance(baseline.get(name), dict):
+            continue
+        ratio = r['us_per_call'] / baseline[name]['us_per_call']
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = '  REGRESSION'
+            regressions += 1
+        print(f'{name:>32s} {baseline[name]["us_per_call"]:12.1f} -> '
+              f'{r["us_per_call"]:12.1f} us  x{ratio:.2f}{flag}')
+    return int(regressions > 0)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    sys.exit(main(args))
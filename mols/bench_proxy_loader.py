@@ -0,0 +1,59 @@
+"""
+Throughput (molecules/sec) of the proxy training input pipeline:
+the threaded `Dataset.start_samplers` path against the DataLoader path of
+`proxy_data`, on the docked_mols data.
+
+    python bench_proxy_loader.py --num_workers 0 2 4 8
+"""
+import argparse
+
+import torch
+
+from train_proxy import Dataset
+from proxy_data import make_proxy_loader, iterate_forever, benchmark_loader
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--mbsize", default=64, type=int)
+parser.add_argument("--repr_type", default='atom_graph')
+parser.add_argument("--num_examples", default=20000, type=int)
+parser.add_argument("--num_batches", default=200, type=int)
+parser.add_argument("--num_sampler_threads", default=8, type=int)
+parser.add_argument("--num_workers", default=[0, 2, 4, 8], nargs='+', type=int)
+parser.add_argument("--device", default='cuda' if torch.cuda.is_available() else 'cpu')
+parser.add_argument("--progress", default='')
+parser.add_argument("--include_nblocks", default=False)
+
+
+def main(args):
+    bpath = "data/blocks_PDB_105.json"
+    device = torch.device(args.device)
+    args.max_blocks = 10
+    dataset = Dataset(args, bpath, device, floatX=torch.float)
+    dataset.load_h5("data/docked_mols.h5", args, num_examples=args.num_examples)
+    print(len(dataset.train_mols), 'train mols')
+
+    results = {}
+    sampler = dataset.start_samplers(args.num_sampler_threads, args.mbsize)
+    try:
+        results['threads_%d' % args.num_sampler_threads] = benchmark_loader(
+            sampler, args.num_batches, args.mbsize)
+    finally:
+        dataset.stop_samplers_and_join()
+
+    for n in args.num_workers:
+        loader = make_proxy_loader(dataset.train_mols, dataset.mdp, args.mbsize,
+                                   num_workers=n, seed=0)
+        it = iterate_forever(loader, device)
+        results['loader_%d' % n] = benchmark_loader(
+            it.__next__, args.num_batches, args.mbsize)
+        del it, loader
+
+    for k, v in results.items():
+        print(f'{k:>12s} {v:10.1f} mols/s')
+    return results
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,65 @@
+"""
+Sampled training diagnostics for the flow matching loop.
+
+Every `every` steps `FlowDiagnostics.record` stores the terminal/flow
+losses, per-transition flows, rewards, molecules, parameter norms and
+the gradient of the loss w.r.t. the edge flows and the state/parent
+stem outputs (what `train_infos` used to hold, in the same order). The gradients
+are taken in a single `autograd.grad` call before `loss.backward()`, so
+the graph is never retained past the backward pass.
+
+Records live in a bounded ring buffer and are spilled to the results
+writer by `flush`. With `every=0` (or `--production`) the hook is off
+and costs nothing.
+"""
+from collections import deque
+
+import torch
+
+
+class FlowDiagnostics:
+
+    def __init__(self, every=50, capacity=100):
+        self.every = every
+        self.buffer = deque(maxlen=capacity) # (record number, info)
+        self.num_recorded = 0
+        self._next_flush = 0
+
+    @classmethod
+    def from_args(cls, args):
+        every = 0 if args.production else args.diagnostics_every
+        return cls(every, args.diagnostics_buffer)
+
+    def wants(self, step):
+        return self.every > 0 and not step % self.every
+
+    def record(self, model, loss, term_loss, flow_loss, exp_inflow,
+               exp_outflow, r, mols, qsa_p, stem_out_s, stem_out_p):
+        """Must be called before `loss.backward()`"""
+        wrt = [i for i in (qsa_p, stem_out_s, stem_out_p) if i.requires_grad]
+        grads = iter(torch.autograd.grad(loss, wrt, retain_graph=True))
+        # stem_out_s has no grad when it comes from the target network
+        grads = [next(grads).cpu().numpy() if i.requires_grad else None
+                 for i in (qsa_p, stem_out_s, stem_out_p)]
+        with torch.no_grad():
+            norms = [i.pow(2).sum().item() for i in model.parameters()]
+        info = (term_loss.detach().cpu().numpy(),
+                flow_loss.detach().cpu().numpy(),
+                exp_inflow.detach().cpu().numpy(),
+                exp_outflow.detach().cpu().numpy(),
+                r.detach().cpu().numpy(),
+                mols,
+                norms,
+                *grads)
+        self.buffer.append((self.num_recorded, info))
+        self.num_recorded += 1
+
+    def infos(self):
+        return [i for _, i in self.buffer]
+
+    def flush(self, writer, name='train_info'):
+        """Writes the records added since the last flush that are still in
+        the buffer (older ones were overwritten)"""
+        items = [i for n, i in self.buffer if n >= self._next_flush]
+        self._next_flush = self.num_recorded
+        writer.extend(name, items)
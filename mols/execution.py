@@ -0,0 +1,62 @@
+"""
+Device selection shared by the molecule training entry points.
+
+    add_execution_args(parser)
+    ...
+    device = setup_execution(args, sampler_threads=args.num_samplers)
+
+On CUDA nothing changes. On CPU:
+ - everything runs in float32 (args.floatX is overwritten),
+ - torch's intra-op thread pool is sized so that the learner and the
+   sampler threads, which all run torch ops concurrently, don't
+   oversubscribe the cores: (cores - worker_processes) // (sampler_threads + 1),
+ - inter-op parallelism is disabled.
+These are defaults that avoid oversubscription, not benchmarked
+optima: compare them with torch's defaults on the target machine with
+`python bench_e2e.py --modes execution default`.
+"""
+import os
+
+import torch
+
+
+def add_execution_args(parser):
+    parser.add_argument("--device", default='auto', help="cuda, cpu, or auto (cuda if available)")
+    parser.add_argument("--cpu_threads", default=0, type=int,
+                        help="number of cores to use on CPU, 0 for all the available ones")
+
+
+def float_dtype(floatX):
+    """'float32'/'float64' (or an already converted dtype) to a torch dtype"""
+    if isinstance(floatX, torch.dtype):
+        return floatX
+    return {'float32': torch.float, 'float64': torch.double}[floatX]
+
+
+def available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count()
+
+
+def setup_execution(args, sampler_threads=0, worker_processes=0):
+    """Returns the torch.device to use and sets torch up for it.
+
+    `sampler_threads` is the number of threads running torch code next to
+    the learner, `worker_processes` the number of (single threaded)
+    DataLoader worker processes."""
+    name = args.device
+    if name == 'auto':
+        name = 'cuda' if torch.cuda.is_available() else 'cpu'
+    device = torch.device(name)
+    if device.type == 'cpu':
+        if hasattr(args, 'floatX'):
+            args.floatX = 'float32' if isinstance(args.floatX, str) else torch.float
+        cores = args.cpu_threads or available_cores()
+        torch.set_num_threads(max(1, (cores - worker_processes) // (sampler_threads + 1)))
+        try:
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            pass # can only be set before any inter-op work was started
+    args.device = str(device)
+    return device
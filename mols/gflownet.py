@@ -29,6 +29,13 @@ import torch_geometric.nn as gnn
 
 from mol_mdp_ext import MolMDPExtended, BlockMoleculeDataExtended
 import model_atom, model_block, model_fingerprint
+from execution import add_execution_args, setup_execution, float_dtype
+from results_writer import AsyncResultsWriter
+from mol_store import MolStore
+from diagnostics import FlowDiagnostics
+import quantized_proxy
+from surrogate import CascadeProxy, load_surrogate
+import instrumentation
 
 tmp_dir = "/tmp/molexp"
 os.makedirs(tmp_dir, exist_ok=True)
@@ -60,17 +67,54 @@ parser.add_argument("--random_action_prob", default=0.05, type=float)
 parser.add_argument("--array", default='')
 parser.add_argument("--repr_type", default='block_graph')
 parser.add_argument("--model_version", default='v4')
+parser.add_argument("--checkpoint_segments", default=0, type=int,
+                    help="recompute the message passing activations during backward, "
+                    "in this many segments (0 keeps them all in memory)")
 parser.add_argument("--run", default=0, help="run", type=int)
 parser.add_argument("--save_path", default='results/')
 parser.add_argument("--proxy_path", default='./data/pretrained_proxy')
+parser.add_argument("--proxy_quantize", default=False, action='store_true',
+                    help="run the proxy with int8 weights on CPU, see quantized_proxy.py")
+parser.add_argument("--surrogate_path", default='',
+                    help="if set, only call the proxy when this surrogate's score is above "
+                    "--cascade_threshold, see surrogate.py")
+parser.add_argument("--cascade_threshold", default=6, type=float)
+parser.add_argument("--cascade_k", default=1, type=float, help="number of ensemble stds added to the surrogate's score")
+parser.add_argument("--cascade_audit_prob", default=0.01, type=float)
 parser.add_argument("--print_array_length", default=False, action='store_true')
 parser.add_argument("--progress", default='yes')
 parser.add_argument("--floatX", default='float64')
 parser.add_argument("--include_nblocks", default=False)
 parser.add_argument("--balanced_loss", default=True)
+parser.add_argument("--objective", default='fm', choices=['fm', 'tb', 'subtb'],
+                    help="flow matching, trajectory balance or sub-trajectory balance")
+parser.add_argument("--logZ_learning_rate", default=1e-2, type=float)
+parser.add_argument("--subtb_lambda", default=0.9, type=float)
+parser.add_argument("--diagnostics_every", default=50, type=int,
+                    help="record flow/gradient diagnostics every n steps, 0 disables them")
+parser.add_argument("--diagnostics_buffer", default=100, type=int)
+parser.add_argument("--production", default=False, action='store_true',
+                    help="disable all diagnostics")
+parser.add_argument("--num_samplers", default=8, type=int, help="number of sampler threads")
+parser.add_argument("--node_budget", default=0, type=int,
+                    help="if set, batches are filled with trajectories up to this many graph "
+                    "nodes (states and parents) instead of mbsize trajectories")
+parser.add_argument("--edge_budget", default=0, type=int, help="same as node_budget, for edges")
+parser.add_argument("--size_buckets", default=1, type=int,
+                    help="with a budget, only batch together trajectories of similar length")
+parser.add_argument("--instrument", default=False, action='store_true',
+                    help="time the training loop stages, samplers, proxy and mdp calls")
+parser.add_argument("--instrument_every", default=100, type=int)
+parser.add_argument("--instrument_sync", default=False, action='store_true',
+                    help="synchronize cuda around GPU stages (slower, but accurate)")
+parser.add_argument("--instrument_port", default=0, type=int,
+                    help="if set, serve timings as prometheus text on localhost:port")
+parser.add_argument("--sampled_mols_window", default=10000, type=int,
+                    help="number of generated molecules kept in memory, all of them are written to disk")
 # If True this basically implements Buesing et al's TreeSample Q,
 # samples uniformly from it though, no MTCS involved
 parser.add_argument("--do_wrong_thing", default=False)
+add_execution_args(parser)
 
 
 
@@ -96,11 +140,14 @@ class Dataset:
         self.sampling_model_prob = 0
         self.floatX = floatX
         self.mdp.floatX = self.floatX
-        #######
-        # This is the "result", here a list of (reward, BlockMolDataExt, info...) tuples
-        self.sampled_mols = []
-
         get = lambda x, d: getattr(args, x) if hasattr(args, x) else d
+        #######
+        # This is the "result", every generated molecule is streamed to
+        # disk by mol_store, sampled_mols is a window of the most recent
+        # (reward, BlockMolDataExt, info...) tuples
+        self.mol_store = MolStore(window=get('sampled_mols_window', 10000))
+        self.sampled_mols = self.mol_store.recent
+        self.current_step = 0 # set by the training loop
         self.min_blocks = get('min_blocks', 2)
         self.max_blocks = get('max_blocks', 10)
         self.mdp._cue_max_blocks = self.max_blocks
@@ -110,6 +157,9 @@ class Dataset:
         self.random_action_prob = get('random_action_prob', 0)
         self.R_min = get('R_min', 1e-8)
         self.do_wrong_thing = get('do_wrong_thing', False)
+        # with 'tb' or 'subtb', samples are whole trajectories instead of
+        # transitions, see traj2batch
+        self.objective = get('objective', 'fm')
 
         self.online_mols = []
         self.max_online_mols = 1000
@@ -133,6 +183,8 @@ class Dataset:
             break
         if not isinstance(m, BlockMoleculeDataExtended):
             m = m[-1]
+        if self.objective != 'fm':
+            return [self._backward_trajectory(m)]
         r = m.reward
         done = 1
         samples = []
@@ -150,6 +202,20 @@ class Dataset:
             m = parents[self.train_rng.randint(len(parents))]
         return samples
 
+    def _backward_trajectory(self, x):
+        """Samples a trajectory ending in x with the uniform backward policy,
+        as a (states, actions, log P_B, reward, x) tuple"""
+        m = x
+        steps = []
+        if len(m.stems):
+            steps.append((m, (-1, 0), 0))
+        while len(m.blocks):
+            parents, actions = zip(*self.mdp.parents(m))
+            j = self.train_rng.randint(len(parents))
+            steps.append((parents[j], actions[j], -np.log(len(parents))))
+            m = parents[j]
+        return (*zip(*steps[::-1]), x.reward, x)
+
     def set_sampling_model(self, model, proxy_reward, sample_prob=0.5):
         self.sampling_model = model
         self.sampling_model_prob = sample_prob
@@ -160,9 +226,15 @@ class Dataset:
         samples = []
         max_blocks = self.max_blocks
         trajectory_stats = []
+        tb = self.objective != 'fm'
+        traj = [] # (state, action, log P_B) for tb, which needs no parents
         for t in range(max_blocks):
             s = self.mdp.mols2batch([self.mdp.mol2repr(m)])
-            s_o, m_o = self.sampling_model(s)
+            with torch.no_grad(): # and thus GraphAgent.inference_forward
+                s_o, m_o = self.sampling_model(s)
+            # with subtb the model also predicts the state log-flow, only
+            # the stop logit is an action
+            m_o = m_o[:, :1]
             ## fix from run 330 onwards
             if t < self.min_blocks:
                 m_o = m_o * 0 - 1000 # prevent assigning prob to stop
@@ -180,12 +252,16 @@ class Dataset:
             if t >= self.min_blocks and action == 0:
                 r = self._get_reward(m)
                 samples.append(((m,), ((-1,0),), r, m, 1))
+                traj.append((m, (-1, 0), 0))
                 break
             else:
                 action = max(0, action-1)
                 action = (action % self.mdp.num_blocks, action // self.mdp.num_blocks)
                 m_old = m
                 m = self.mdp.add_block_to(m, *action)
+                if tb:
+                    # uniform backward policy
+                    traj.append((m_old, action, -np.log(self.mdp.num_parents(m))))
                 if len(m.blocks) and not len(m.stems) or t == max_blocks - 1:
                     # can't add anything more to this mol so let's make it
                     # terminal. Note that this node's parent isn't just m,
@@ -193,21 +269,28 @@ class Dataset:
                     r = self._get_reward(m)
                     if self.do_wrong_thing:
                         samples.append(((m_old,), (action,), r, m, 1))
-                    else:
+                    elif not tb:
                         samples.append((*zip(*self.mdp.parents(m)), r, m, 1))
                     break
                 else:
                     if self.do_wrong_thing:
                         samples.append(((m_old,), (action,), 0, m, 0))
-                    else:
+                    elif not tb:
                         samples.append((*zip(*self.mdp.parents(m)), 0, m, 0))
-        p = self.mdp.mols2batch([self.mdp.mol2repr(i) for i in samples[-1][0]])
-        qp = self.sampling_model(p, None)
-        qsa_p = self.sampling_model.index_output_by_action(
-            p, qp[0], qp[1][:, 0],
-            torch.tensor(samples[-1][1], device=self._device).long())
-        inflow = torch.logsumexp(qsa_p.flatten(), 0).item()
-        self.sampled_mols.append((r, m, trajectory_stats, inflow))
+        if tb:
+            samples = [(*zip(*traj), r, m)]
+            inflow = float('nan')
+        else:
+            p = self.mdp.mols2batch([self.mdp.mol2repr(i) for i in samples[-1][0]])
+            with torch.no_grad():
+                qp = self.sampling_model(p, None)
+            qsa_p = self.sampling_model.index_output_by_action(
+                p, qp[0], qp[1][:, 0],
+                torch.tensor(samples[-1][1], device=self._device).long())
+            inflow = torch.logsumexp(qsa_p.flatten(), 0).item()
+        self.mol_store.add(m, r, inflow, step=self.current_step,
+                           policy_version=getattr(self.sampling_model, 'training_steps', 0),
+                           entry=(r, m, trajectory_stats, inflow))
         if self.replay_mode == 'online' or self.replay_mode == 'prioritized':
             m.reward = r
             self._add_mol_to_online(r, m, inflow)
@@ -236,23 +319,44 @@ class Dataset:
         return self.r2r(normscore=self.proxy_reward(m))
 
     def sample(self, n):
+        return zip(*sum(self._sample_trajectories(n), []))
+
+    def _sample_trajectories(self, n):
+        """Returns n lists of samples, one per trajectory"""
         if self.replay_mode == 'dataset':
             eidx = self.train_rng.randint(0, len(self.train_mols), n)
-            samples = sum((self._get(i, self.train_mols) for i in eidx), [])
+            return [self._get(i, self.train_mols) for i in eidx]
         elif self.replay_mode == 'online':
             eidx = self.train_rng.randint(0, max(1,len(self.online_mols)), n)
-            samples = sum((self._get(i, self.online_mols) for i in eidx), [])
+            return [self._get(i, self.online_mols) for i in eidx]
         elif self.replay_mode == 'prioritized':
             if not len(self.online_mols):
                 # _get will sample from the model
-                samples = sum((self._get(0, self.online_mols) for i in range(n)), [])
-            else:
-                prio = np.float32([i[0] for i in self.online_mols])
-                eidx = self.train_rng.choice(len(self.online_mols), n, False, prio/prio.sum())
-                samples = sum((self._get(i, self.online_mols) for i in eidx), [])
-        return zip(*samples)
-
+                return [self._get(0, self.online_mols) for i in range(n)]
+            prio = np.float32([i[0] for i in self.online_mols])
+            eidx = self.train_rng.choice(len(self.online_mols), n, False, prio/prio.sum())
+            return [self._get(i, self.online_mols) for i in eidx]
+
+    def trajectory_size(self, samples):
+        """(length, graph nodes, graph edges) of a trajectory's samples, as
+        they will be batched by sample2batch"""
+        if self.objective != 'fm':
+            mols = samples[0][0]
+            length = len(mols)
+        else:
+            mols = [m for p, a, r, s, d in samples for m in p + (s,)]
+            length = len(samples)
+        nodes, edges = 0, 0
+        for m in mols:
+            n, e = self.mdp.graph_size(m)
+            nodes += n
+            edges += e
+        return length, nodes, edges
+
+    @instrumentation.timed('collate')
     def sample2batch(self, mb):
+        if self.objective != 'fm':
+            return self.traj2batch(mb)
         p, a, r, s, d, *o = mb
         mols = (p, s)
         # The batch index of each parent
@@ -270,6 +374,22 @@ class Dataset:
         d = torch.tensor(d, device=self._device).to(self.floatX)
         return (p, p_batch, a, r, s, d, mols, *o)
 
+    def traj2batch(self, mb):
+        states, a, logpb, r, mols = mb
+        n = [len(i) for i in states]
+        # The trajectory index and step of each state
+        tb = torch.tensor(sum([[i]*k for i, k in enumerate(n)], []), device=self._device).long()
+        t = torch.tensor(sum([list(range(k)) for k in n], []), device=self._device).long()
+        states = sum(states, ())
+        nblocks = torch.tensor([len(i.blocks) for i in states], device=self._device).long()
+        s = self.mdp.mols2batch([self.mdp.mol2repr(i) for i in states])
+        # one action and log P_B per state
+        a = torch.tensor(sum(a, ()), device=self._device).long()
+        logpb = torch.tensor(sum(logpb, ()), device=self._device).to(self.floatX)
+        r = torch.tensor(r, device=self._device).to(self.floatX)
+        n = torch.tensor(n, device=self._device).long()
+        return (s, tb, t, a, logpb, r, n, nblocks, mols)
+
     def r2r(self, dockscore=None, normscore=None):
         if dockscore is not None:
             normscore = 4-(min(0, dockscore)-self.target_norm[0])/self.target_norm[1]
@@ -277,14 +397,21 @@ class Dataset:
         return (normscore/self.reward_norm) ** self.reward_exp
 
 
-    def start_samplers(self, n, mbsize):
+    def start_samplers(self, n, mbsize, node_budget=0, edge_budget=0, size_buckets=1):
+        """With a node or edge budget, each sampler fills its batches up to
+        the budget (see BudgetBatcher) and mbsize is ignored"""
         self.ready_events = [threading.Event() for i in range(n)]
         self.resume_events = [threading.Event() for i in range(n)]
         self.results = [None] * n
         def f(idx):
+            batcher = None
+            if node_budget or edge_budget:
+                batcher = BudgetBatcher(self, node_budget, edge_budget, size_buckets)
             while not self.stop_event.is_set():
                 try:
-                    self.results[idx] = self.sample2batch(self.sample(mbsize))
+                    with instrumentation.stage('sample', worker=idx):
+                        mb = self.sample(mbsize) if batcher is None else batcher.next()
+                        self.results[idx] = self.sample2batch(mb)
                 except Exception as e:
                     print("Exception while sampling:")
                     print(e)
@@ -320,6 +447,42 @@ class Dataset:
             [i.join(0.05) for i in self.sampler_threads]
 
 
+class BudgetBatcher:
+    """Batches trajectories so that their graphs (states, and parents for
+    flow matching) total at most `node_budget` nodes and `edge_budget`
+    edges (0 means no limit), so that the learner's step cost doesn't
+    depend on how long the sampled trajectories are. A trajectory larger
+    than the budget gets a batch of its own.
+
+    With size_buckets > 1, trajectories are split by length into that
+    many buckets, each filled separately, and a batch only holds
+    trajectories of one bucket."""
+
+    def __init__(self, dataset, node_budget, edge_budget=0, size_buckets=1):
+        self.dataset = dataset
+        self.node_budget = node_budget or float('inf')
+        self.edge_budget = edge_budget or float('inf')
+        self.size_buckets = size_buckets
+        # trajectories longer than this go in the last bucket
+        self.max_length = dataset.max_blocks + 1
+        self.pending = [[] for i in range(size_buckets)]
+        self.sizes = [[0, 0] for i in range(size_buckets)]
+
+    def next(self):
+        while True:
+            samples = self.dataset._sample_trajectories(1)[0]
+            length, nodes, edges = self.dataset.trajectory_size(samples)
+            k = min(self.size_buckets - 1, (length - 1) * self.size_buckets // self.max_length)
+            pending, size = self.pending[k], self.sizes[k]
+            full = (size[0] + nodes > self.node_budget or size[1] + edges > self.edge_budget)
+            if len(pending) and full:
+                self.pending[k], self.sizes[k] = [samples], [nodes, edges]
+                return zip(*sum(pending, []))
+            pending.append(samples)
+            size[0] += nodes
+            size[1] += edges
+
+
 def make_model(args, mdp, out_per_mol=1):
     if args.repr_type == 'block_graph':
         model = model_block.GraphAgent(nemb=args.nemb,
@@ -328,7 +491,8 @@ def make_model(args, mdp, out_per_mol=1):
                                        out_per_mol=out_per_mol,
                                        num_conv_steps=args.num_conv_steps,
                                        mdp_cfg=mdp,
-                                       version=args.model_version)
+                                       version=args.model_version,
+                                       checkpoint_segments=getattr(args, 'checkpoint_segments', 0))
     elif args.repr_type == 'atom_graph':
         model = model_atom.MolAC_GCN(nhid=args.nemb,
                                      nvec=0,
@@ -337,15 +501,60 @@ def make_model(args, mdp, out_per_mol=1):
                                      num_conv_steps=args.num_conv_steps,
                                      version=args.model_version,
                                      do_nblocks=(hasattr(args,'include_nblocks')
-                                                 and args.include_nblocks), dropout_rate=0.1)
+                                                 and args.include_nblocks), dropout_rate=0.1,
+                                     checkpoint_segments=getattr(args, 'checkpoint_segments', 0))
     elif args.repr_type == 'morgan_fingerprint':
-        raise ValueError('reimplement me')
-        model = model_fingerprint.MFP_MLP(args.nemb, 3, mdp.num_blocks, 1)
+        model = model_fingerprint.MFP_MLP(args.nemb, 0, mdp.num_blocks, out_per_mol)
     return model
 
 
+def trajectory_balance_loss(model, logZ, batch, min_blocks, subtb_lambda=None):
+    """Trajectory balance loss of a batch from Dataset.traj2batch, the
+    forward log-probabilities are recomputed with a single forward pass
+    over all the states.
+
+    With subtb_lambda, sub-trajectory balance over every sub-trajectory
+    (weighted by lambda**length), mol_out[:, 1] being the log-flow of
+    the intermediate states (make_model(..., out_per_mol=2)).
+
+    Returns the loss and the per trajectory losses."""
+    s, tb, t, a, logpb, r, n, nblocks, mols = batch
+    stem_out, mol_out = model(s, None)
+    # can't stop before min_blocks, same as in the sampler
+    stop = torch.where(nblocks < min_blocks, mol_out[:, 0] * 0 - 1000, mol_out[:, 0])
+    # log-softmax over all the (stem, block) actions and stop of each state
+    c = torch.maximum(gnn.global_max_pool(stem_out.max(1, keepdim=True)[0], s.stems_batch)[:, 0],
+                      stop).detach()
+    logsumexp = torch.log(model.sum_output(s, torch.exp(stem_out - c[s.stems_batch, None]),
+                                           torch.exp(stop - c))) + c
+    logpf = model.index_output_by_action(s, stem_out, stop, a) - logsumexp
+    logr = torch.log(r)
+    if subtb_lambda is None:
+        traj_logratio = torch.zeros_like(r).index_add_(0, tb, logpf - logpb)
+        losses = (logZ + traj_logratio - logr).pow(2)
+        return losses.mean(), losses
+    ntraj, L = r.shape[0], int(n.max()) + 1
+    # log F(s_0..s_n), logZ for s_0 and log R for the terminal state
+    flows = torch.where(t == 0, logZ, mol_out[:, 1])
+    logF = (torch.zeros((ntraj, L), device=r.device, dtype=r.dtype)
+            .index_put((tb, t), flows)
+            .index_put((torch.arange(ntraj, device=r.device), n), logr))
+    delta = torch.zeros((ntraj, L - 1), device=r.device, dtype=r.dtype).index_put((tb, t), logpf - logpb)
+    C = torch.cat([torch.zeros_like(logF[:, :1]), delta.cumsum(1)], 1)
+    # diff[k, i, j] is the balance violation of s_i -> s_j in trajectory k
+    diff = logF[:, :, None] + C[:, None, :] - C[:, :, None] - logF[:, None, :]
+    i = torch.arange(L, device=r.device)[:, None]
+    j = torch.arange(L, device=r.device)[None, :]
+    w = (subtb_lambda ** (j - i).clamp(min=0) * ((i < j)[None] & (j[None] <= n[:, None, None]))).to(r.dtype)
+    losses = (w * diff.pow(2)).sum((1, 2)) / w.sum((1, 2))
+    return losses.mean(), losses
+
+
 class Proxy:
     def __init__(self, args, bpath, device):
+        quantize = getattr(args, 'proxy_quantize', False)
+        if quantize:
+            device = torch.device('cpu') # int8 kernels are CPU only
         eargs = pickle.load(gzip.open(f'{args.proxy_path}/info.pkl.gz'))['args']
         params = pickle.load(gzip.open(f'{args.proxy_path}/best_params.pkl.gz'))
         self.mdp = MolMDPExtended(bpath)
@@ -355,17 +564,22 @@ class Proxy:
         for a,b in zip(self.proxy.parameters(), params):
             a.data = torch.tensor(b, dtype=self.mdp.floatX)
         self.proxy.to(device)
+        if quantize:
+            self.proxy = quantized_proxy.quantize(self.proxy)
+            self.mdp.floatX = torch.float
 
+    @instrumentation.timed('proxy')
     def __call__(self, m):
         m = self.mdp.mols2batch([self.mdp.mol2repr(m)])
-        return self.proxy(m, do_stems=False)[1].item()
+        with torch.no_grad():
+            return self.proxy(m, do_stems=False)[1].item()
 
 _stop = [None]
 
 
 def train_model_with_proxy(args, model, proxy, dataset, num_steps=None, do_save=True):
     debug_no_threads = False
-    device = torch.device('cuda')
+    device = dataset._device
 
     if num_steps is None:
         num_steps = args.num_iterations + 1
@@ -376,33 +590,52 @@ def train_model_with_proxy(args, model, proxy, dataset, num_steps=None, do_save=
 
     if do_save:
         exp_dir = f'{args.save_path}/{args.array}_{args.run}/'
-        os.makedirs(exp_dir, exist_ok=True)
+        writer = AsyncResultsWriter(exp_dir)
+    else:
+        # nothing flushes the generated molecules' records
+        dataset.mol_store.persist = False
 
 
     dataset.set_sampling_model(model, proxy, sample_prob=args.sample_prob)
 
-    def save_stuff():
-        pickle.dump([i.data.cpu().numpy() for i in model.parameters()],
-                    gzip.open(f'{exp_dir}/params.pkl.gz', 'wb'))
+    exporter = None
+    if args.instrument:
+        instrumentation.configure(
+            enabled=True,
+            sync=torch.cuda.synchronize if args.instrument_sync and device.type == 'cuda' else None)
+        if args.instrument_port:
+            instrumentation.serve_prometheus(args.instrument_port)
+        if do_save:
+            exporter = instrumentation.JsonlExporter(f'{exp_dir}/timings.jsonl')
 
-        pickle.dump(dataset.sampled_mols,
-                    gzip.open(f'{exp_dir}/sampled_mols.pkl.gz', 'wb'))
-
-        pickle.dump({'train_losses': train_losses,
-                     'test_losses': test_losses,
-                     'test_infos': test_infos,
-                     'time_start': time_start,
-                     'time_now': time.time(),
-                     'args': args,},
-                    gzip.open(f'{exp_dir}/info.pkl.gz', 'wb'))
-
-        pickle.dump(train_infos,
-                    gzip.open(f'{exp_dir}/train_info.pkl.gz', 'wb'))
+    def save_stuff():
+        # Pickling happens on the writer's thread, growing lists are
+        # written incrementally (see results_writer.load_results).
+        writer.put('params', writer.snapshot(model.parameters()))
+        dataset.mol_store.flush(writer)
+        writer.put('info', {'train_losses': writer.stream('train_losses', train_losses),
+                            'num_generated_mols': len(dataset.mol_store),
+                            'num_unique_mols': dataset.mol_store.num_unique,
+                            'test_losses': list(test_losses),
+                            'test_infos': list(test_infos),
+                            'time_start': time_start,
+                            'time_now': time.time(),
+                            'logZ': None if logZ is None else logZ.item(),
+                            'proxy_stats': proxy.stats() if hasattr(proxy, 'stats') else None,
+                            'args': args,})
+        diagnostics.flush(writer)
 
 
     opt = torch.optim.Adam(model.parameters(), args.learning_rate, weight_decay=args.weight_decay,
                            betas=(args.opt_beta, args.opt_beta2),
                            eps=args.opt_epsilon)
+    objective = args.objective
+    logZ = None
+    if objective != 'fm':
+        logZ = nn.Parameter(torch.zeros((1,), device=device, dtype=dataset.floatX))
+        opt.add_param_group({'params': [logZ], 'lr': args.logZ_learning_rate, 'weight_decay': 0})
+    subtb_lambda = args.subtb_lambda if objective == 'subtb' else None
+    budget = args.node_budget or args.edge_budget
 
     tf = lambda x: torch.tensor(x, device=device).to(args.floatX)
     tint = lambda x: torch.tensor(x, device=device).long()
@@ -411,7 +644,8 @@ def train_model_with_proxy(args, model, proxy, dataset, num_steps=None, do_save=
     ar = torch.arange(mbsize)
 
     if not debug_no_threads:
-        sampler = dataset.start_samplers(8, mbsize)
+        sampler = dataset.start_samplers(args.num_samplers, mbsize, args.node_budget,
+                                         args.edge_budget, args.size_buckets)
 
     last_losses = []
 
@@ -423,7 +657,7 @@ def train_model_with_proxy(args, model, proxy, dataset, num_steps=None, do_save=
     train_losses = []
     test_losses = []
     test_infos = []
-    train_infos = []
+    diagnostics = FlowDiagnostics.from_args(args)
     time_start = time.time()
     time_last_check = time.time()
 
@@ -436,73 +670,85 @@ def train_model_with_proxy(args, model, proxy, dataset, num_steps=None, do_save=
     leaf_coef = args.leaf_coef
 
     for i in range(num_steps):
+        dataset.current_step = i
+        lap = instrumentation.lap()
         if not debug_no_threads:
-            r = sampler()
+            batch = sampler()
             for thread in dataset.sampler_threads:
                 if thread.failed:
                     stop_everything()
                     pdb.post_mortem(thread.exception.__traceback__)
                     return
-            p, pb, a, r, s, d, mols = r
         else:
-            p, pb, a, r, s, d, mols = dataset.sample2batch(dataset.sample(mbsize))
-        # Since we sampled 'mbsize' trajectories, we're going to get
-        # roughly mbsize * H (H is variable) transitions
-        ntransitions = r.shape[0]
-        # state outputs
-        if tau > 0:
-            with torch.no_grad():
-                stem_out_s, mol_out_s = target_model(s, None)
-        else:
-            stem_out_s, mol_out_s = model(s, None)
-        # parents of the state outputs
-        stem_out_p, mol_out_p = model(p, None)
-        # index parents by their corresponding actions
-        qsa_p = model.index_output_by_action(p, stem_out_p, mol_out_p[:, 0], a)
-        # then sum the parents' contribution, this is the inflow
-        exp_inflow = (torch.zeros((ntransitions,), device=device, dtype=dataset.floatX)
-                      .index_add_(0, pb, torch.exp(qsa_p))) # pb is the parents' batch index
-        inflow = torch.log(exp_inflow + log_reg_c)
-        # sum the state's Q(s,a), this is the outflow
-        exp_outflow = model.sum_output(s, torch.exp(stem_out_s), torch.exp(mol_out_s[:, 0]))
-        # include reward and done multiplier, then take the log
-        # we're guarenteed that r > 0 iff d = 1, so the log always works
-        outflow_plus_r = torch.log(log_reg_c + r + exp_outflow * (1-d))
-        if do_nblocks_reg:
-            losses = _losses = ((inflow - outflow_plus_r) / (s.nblocks * max_blocks)).pow(2)
+            batch = dataset.sample2batch(dataset.sample(mbsize))
+        lap('sampler_wait')
+        if objective != 'fm':
+            loss, losses = trajectory_balance_loss(model, logZ, batch, args.min_blocks, subtb_lambda)
+            if budget:
+                # the number of trajectories varies with the budget, average
+                # over transitions instead, as flow matching does
+                n = batch[6]
+                loss = (losses * n).sum() / n.sum()
+            lap('loss', sync=True)
+            opt.zero_grad()
+            loss.backward()
+            lap('backward', sync=True)
+            last_losses.append((loss.item(), logZ.item()))
+            train_losses.append((loss.item(), logZ.item()))
         else:
-            losses = _losses = (inflow - outflow_plus_r).pow(2)
-        if clip_loss > 0:
-            ld = losses.detach()
-            losses = losses / ld * torch.minimum(ld, clip_loss)
-
-        term_loss = (losses * d).sum() / (d.sum() + 1e-20)
-        flow_loss = (losses * (1-d)).sum() / ((1-d).sum() + 1e-20)
-        if balanced_loss:
-            loss = term_loss * leaf_coef + flow_loss
-        else:
-            loss = losses.mean()
-        opt.zero_grad()
-        loss.backward(retain_graph=(not i % 50))
-
-        _term_loss = (_losses * d).sum() / (d.sum() + 1e-20)
-        _flow_loss = (_losses * (1-d)).sum() / ((1-d).sum() + 1e-20)
-        last_losses.append((loss.item(), term_loss.item(), flow_loss.item()))
-        train_losses.append((loss.item(), _term_loss.item(), _flow_loss.item(),
-                             term_loss.item(), flow_loss.item()))
-        if not i % 50:
-            train_infos.append((
-                _term_loss.data.cpu().numpy(),
-                _flow_loss.data.cpu().numpy(),
-                exp_inflow.data.cpu().numpy(),
-                exp_outflow.data.cpu().numpy(),
-                r.data.cpu().numpy(),
-                mols[1],
-                [i.pow(2).sum().item() for i in model.parameters()],
-                torch.autograd.grad(loss, qsa_p, retain_graph=True)[0].data.cpu().numpy(),
-                torch.autograd.grad(loss, stem_out_s, retain_graph=True)[0].data.cpu().numpy(),
-                torch.autograd.grad(loss, stem_out_p, retain_graph=True)[0].data.cpu().numpy(),
-            ))
+            p, pb, a, r, s, d, mols = batch
+            # Since we sampled 'mbsize' trajectories, we're going to get
+            # roughly mbsize * H (H is variable) transitions
+            ntransitions = r.shape[0]
+            # state outputs
+            if tau > 0:
+                with torch.no_grad():
+                    stem_out_s, mol_out_s = target_model(s, None)
+            else:
+                stem_out_s, mol_out_s = model(s, None)
+            lap('state_forward', sync=True)
+            # parents of the state outputs
+            stem_out_p, mol_out_p = model(p, None)
+            # index parents by their corresponding actions
+            qsa_p = model.index_output_by_action(p, stem_out_p, mol_out_p[:, 0], a)
+            lap('parent_forward', sync=True)
+            # then sum the parents' contribution, this is the inflow
+            exp_inflow = (torch.zeros((ntransitions,), device=device, dtype=dataset.floatX)
+                          .index_add_(0, pb, torch.exp(qsa_p))) # pb is the parents' batch index
+            inflow = torch.log(exp_inflow + log_reg_c)
+            # sum the state's Q(s,a), this is the outflow
+            exp_outflow = model.sum_output(s, torch.exp(stem_out_s), torch.exp(mol_out_s[:, 0]))
+            # include reward and done multiplier, then take the log
+            # we're guarenteed that r > 0 iff d = 1, so the log always works
+            outflow_plus_r = torch.log(log_reg_c + r + exp_outflow * (1-d))
+            if do_nblocks_reg:
+                losses = _losses = ((inflow - outflow_plus_r) / (s.nblocks * max_blocks)).pow(2)
+            else:
+                losses = _losses = (inflow - outflow_plus_r).pow(2)
+            if clip_loss > 0:
+                ld = losses.detach()
+                losses = losses / ld * torch.minimum(ld, clip_loss)
+
+            term_loss = (losses * d).sum() / (d.sum() + 1e-20)
+            flow_loss = (losses * (1-d)).sum() / ((1-d).sum() + 1e-20)
+            if balanced_loss:
+                loss = term_loss * leaf_coef + flow_loss
+            else:
+                loss = losses.mean()
+            _term_loss = (_losses * d).sum() / (d.sum() + 1e-20)
+            _flow_loss = (_losses * (1-d)).sum() / ((1-d).sum() + 1e-20)
+            lap('loss', sync=True)
+            opt.zero_grad()
+            if diagnostics.wants(i):
+                diagnostics.record(model, loss, _term_loss, _flow_loss, exp_inflow, exp_outflow,
+                                   r, mols[1], qsa_p, stem_out_s, stem_out_p)
+                lap('diagnostics')
+            loss.backward()
+            lap('backward', sync=True)
+
+            last_losses.append((loss.item(), term_loss.item(), flow_loss.item()))
+            train_losses.append((loss.item(), _term_loss.item(), _flow_loss.item(),
+                                 term_loss.item(), flow_loss.item()))
         if args.clip_grad > 0:
             torch.nn.utils.clip_grad_value_(model.parameters(),
                                            args.clip_grad)
@@ -511,11 +757,18 @@ def train_model_with_proxy(args, model, proxy, dataset, num_steps=None, do_save=
         if tau > 0:
             for _a,b in zip(model.parameters(), target_model.parameters()):
                 b.data.mul_(1-tau).add_(tau*_a)
+        lap('optimizer_step', sync=True)
 
+        if args.instrument and not i % args.instrument_every:
+            snap = instrumentation.snapshot()
+            if exporter is not None:
+                exporter.write(snap, step=i)
 
         if not i % 100:
             last_losses = [np.round(np.mean(i), 3) for i in zip(*last_losses)]
             print(i, last_losses)
+            if hasattr(proxy, 'stats'):
+                print('proxy skip rate:', round(proxy.stats()['skip_rate'], 3))
             print('time:', time.time() - time_last_check)
             time_last_check = time.time()
             last_losses = []
@@ -526,28 +779,29 @@ def train_model_with_proxy(args, model, proxy, dataset, num_steps=None, do_save=
     stop_everything()
     if do_save:
         save_stuff()
+        writer.close()
     return model
 
 
 def main(args):
     bpath = "data/blocks_PDB_105.json"
-    device = torch.device('cuda')
-
-    if args.floatX == 'float32':
-        args.floatX = torch.float
-    else:
-        args.floatX = torch.double
+    device = setup_execution(args, sampler_threads=args.num_samplers)
+    args.floatX = float_dtype(args.floatX)
     dataset = Dataset(args, bpath, device, floatX=args.floatX)
     print(args)
 
 
     mdp = dataset.mdp
 
-    model = make_model(args, mdp)
+    # subtb also predicts the state log-flows
+    model = make_model(args, mdp, out_per_mol=1 + (args.objective == 'subtb'))
     model.to(args.floatX)
     model.to(device)
 
     proxy = Proxy(args, bpath, device)
+    if args.surrogate_path:
+        proxy = CascadeProxy(proxy, load_surrogate(args.surrogate_path), args.cascade_threshold,
+                             args.cascade_k, args.cascade_audit_prob)
 
     train_model_with_proxy(args, model, proxy, dataset, do_save=True)
     print('Done.')
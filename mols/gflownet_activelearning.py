@@ -35,7 +35,11 @@ import ray
 from mol_mdp_ext import MolMDPExtended, BlockMoleculeDataExtended
 
 import model_atom, model_block, model_fingerprint
+from execution import add_execution_args, setup_execution, float_dtype
+from results_writer import AsyncResultsWriter
+from diagnostics import FlowDiagnostics
 from train_proxy import Dataset as _ProxyDataset
+from proxy_data import make_proxy_loader, iterate_forever, batch_to
 from gflownet import Dataset as GenModelDataset
 
 parser = argparse.ArgumentParser()
@@ -51,6 +55,7 @@ parser.add_argument("--num_init_examples", default=2000, type=int)
 parser.add_argument("--num_outer_loop_iters", default=25, type=int)
 parser.add_argument("--num_samples", default=200, type=int)
 parser.add_argument("--proxy_num_conv_steps", default=12, type=int)
+parser.add_argument("--proxy_num_workers", default=8, help="DataLoader worker processes", type=int)
 parser.add_argument("--proxy_repr_type", default='atom_graph')
 parser.add_argument("--proxy_model_version", default='v2')
 parser.add_argument("--save_path", default='results/act_flow/')
@@ -87,7 +92,13 @@ parser.add_argument("--repr_type", default='block_graph')
 parser.add_argument("--model_version", default='v4')
 parser.add_argument("--run", default=0, help="run", type=int)
 parser.add_argument("--balanced_loss", default=True)
+parser.add_argument("--diagnostics_every", default=50, type=int,
+                    help="record flow/gradient diagnostics every n steps, 0 disables them")
+parser.add_argument("--diagnostics_buffer", default=100, type=int)
+parser.add_argument("--production", default=False, action='store_true',
+                    help="disable all diagnostics")
 parser.add_argument("--floatX", default='float64')
+add_execution_args(parser)
 
 
 class ProxyDataset(_ProxyDataset):
@@ -129,7 +140,7 @@ class Proxy:
         # params = pickle.load(gzip.open(f'{args.proxy_path}/best_params.pkl.gz'))
         self.mdp = MolMDPExtended(bpath)
         self.mdp.post_init(device, args.proxy_repr_type)
-        self.mdp.floatX = torch.double
+        self.mdp.floatX = float_dtype(args.floatX)
         self.proxy = make_model(args, self.mdp, is_proxy=True)
         # for a,b in zip(self.proxy.parameters(), params):
         #     a.data = torch.tensor(b, dtype=self.mdp.floatX)
@@ -152,14 +163,18 @@ class Proxy:
         mbsize = self.args.mbsize
 
         if not debug_no_threads:
-            sampler = dataset.start_samplers(8, mbsize)
+            train_loader = make_proxy_loader(dataset.train_mols, dataset.mdp, mbsize,
+                                             num_workers=self.args.proxy_num_workers,
+                                             seed=self.args.run)
+            sampler = iterate_forever(train_loader, self.device)
+        test_loader = make_proxy_loader(dataset.test_mols, dataset.mdp, max(mbsize, 128),
+                                        num_workers=0, shuffle=False)
 
         last_losses = []
 
         def stop_everything():
             stop_event.set()
             print('joining')
-            dataset.stop_samplers_and_join()
 
         train_losses = []
         test_losses = []
@@ -171,15 +186,9 @@ class Proxy:
 
         for i in range(self.args.proxy_num_iterations+1):
             if not debug_no_threads:
-                r = sampler()
-                for thread in dataset.sampler_threads:
-                    if thread.failed:
-                        stop_event.set()
-                        stop_everything()
-                        pdb.post_mortem(thread.exception.__traceback__)
-                s, r = r
+                s, r = next(sampler)
             else:
-                p, pb, a, r, s, d = dataset.sample2batch(dataset.sample(mbsize))
+                s, r = dataset.sample2batch(dataset.sample(mbsize))
 
             # state outputs
             stem_out_s, mol_out_s = self.proxy(s, None, do_stems=False)
@@ -209,7 +218,7 @@ class Proxy:
                 total_test_loss = 0
                 total_test_n = 0
 
-                for s, r in dataset.itertest(max(mbsize, 128)):
+                for s, r in map(lambda b: batch_to(b, self.device), test_loader):
                     with torch.no_grad():
                         stem_o, mol_o = self.proxy(s, None, do_stems=False)
                         loss = (mol_o[:, 0] - r).pow(2)
@@ -259,15 +268,14 @@ def make_model(args, mdp, is_proxy=False):
                                      version=model_version,
                                      dropout_rate=args.proxy_dropout)
     elif repr_type == 'morgan_fingerprint':
-        raise ValueError('reimplement me')
-        model = model_fingerprint.MFP_MLP(args.nemb, 3, mdp.num_blocks, 1)
+        model = model_fingerprint.MFP_MLP(nemb, 0, mdp.num_blocks, 1)
     return model
 
 
 _stop = [None]
 def train_generative_model(args, model, proxy, dataset, num_steps=None, do_save=True):
     debug_no_threads = False
-    device = torch.device('cuda')
+    device = dataset._device
 
     if num_steps is None:
         num_steps = args.num_iterations + 1
@@ -278,30 +286,30 @@ def train_generative_model(args, model, proxy, dataset, num_steps=None, do_save=
 
     if do_save:
         exp_dir = f'{args.save_path}/{args.array}_{args.run}/'
-        os.makedirs(exp_dir, exist_ok=True)
+        writer = AsyncResultsWriter(exp_dir)
+    else:
+        # nothing flushes the generated molecules' records
+        dataset.mol_store.persist = False
 
-    model = model.double()
-    proxy.proxy = proxy.proxy.double()
+    model = model.to(dataset.floatX)
+    proxy.proxy = proxy.proxy.to(proxy.mdp.floatX)
     # import pdb; pdb.set_trace()
     dataset.set_sampling_model(model, proxy, sample_prob=args.sample_prob)
 
     def save_stuff():
-        pickle.dump([i.data.cpu().numpy() for i in model.parameters()],
-                    gzip.open(f'{exp_dir}/params.pkl.gz', 'wb'))
-
-        pickle.dump(dataset.sampled_mols,
-                    gzip.open(f'{exp_dir}/sampled_mols.pkl.gz', 'wb'))
-
-        pickle.dump({'train_losses': train_losses,
-                     'test_losses': test_losses,
-                     'test_infos': test_infos,
-                     'time_start': time_start,
-                     'time_now': time.time(),
-                     'args': args,},
-                    gzip.open(f'{exp_dir}/info.pkl.gz', 'wb'))
-
-        pickle.dump(train_infos,
-                    gzip.open(f'{exp_dir}/train_info.pkl.gz', 'wb'))
+        # Pickling happens on the writer's thread, growing lists are
+        # written incrementally (see results_writer.load_results).
+        writer.put('params', writer.snapshot(model.parameters()))
+        dataset.mol_store.flush(writer)
+        writer.put('info', {'train_losses': writer.stream('train_losses', train_losses),
+                            'num_generated_mols': len(dataset.mol_store),
+                            'num_unique_mols': dataset.mol_store.num_unique,
+                            'test_losses': list(test_losses),
+                            'test_infos': list(test_infos),
+                            'time_start': time_start,
+                            'time_now': time.time(),
+                            'args': args,})
+        diagnostics.flush(writer)
 
 
     opt = torch.optim.Adam(model.parameters(), args.learning_rate, weight_decay=args.weight_decay,
@@ -309,7 +317,7 @@ def train_generative_model(args, model, proxy, dataset, num_steps=None, do_save=
                            eps=args.opt_epsilon)
     #opt = torch.optim.SGD(model.parameters(), args.learning_rate)
 
-    tf = lambda x: torch.tensor(x, device=device).to(torch.float64 if args.floatX else torch.float32)
+    tf = lambda x: torch.tensor(x, device=device).to(dataset.floatX)
     tint = lambda x: torch.tensor(x, device=device).long()
 
     mbsize = args.mbsize
@@ -328,7 +336,7 @@ def train_generative_model(args, model, proxy, dataset, num_steps=None, do_save=
     train_losses = []
     test_losses = []
     test_infos = []
-    train_infos = []
+    diagnostics = FlowDiagnostics.from_args(args)
     time_start = time.time()
     time_last_check = time.time()
 
@@ -341,6 +349,7 @@ def train_generative_model(args, model, proxy, dataset, num_steps=None, do_save=
     leaf_coef = args.leaf_coef
 
     for i in range(num_steps):
+        dataset.current_step = i
         if not debug_no_threads:
             r = sampler()
             for thread in dataset.sampler_threads:
@@ -387,27 +396,17 @@ def train_generative_model(args, model, proxy, dataset, num_steps=None, do_save=
             loss = term_loss * leaf_coef + flow_loss
         else:
             loss = losses.mean()
-        opt.zero_grad()
-        loss.backward(retain_graph=(not i % 50))
-
         _term_loss = (_losses * d).sum() / (d.sum() + 1e-20)
         _flow_loss = (_losses * (1-d)).sum() / ((1-d).sum() + 1e-20)
+        opt.zero_grad()
+        if diagnostics.wants(i):
+            diagnostics.record(model, loss, _term_loss, _flow_loss, exp_inflow, exp_outflow,
+                               r, mols[1], qsa_p, stem_out_s, stem_out_p)
+        loss.backward()
+
         last_losses.append((loss.item(), term_loss.item(), flow_loss.item()))
         train_losses.append((loss.item(), _term_loss.item(), _flow_loss.item(),
                              term_loss.item(), flow_loss.item()))
-        if not i % 50:
-            train_infos.append((
-                _term_loss.data.cpu().numpy(),
-                _flow_loss.data.cpu().numpy(),
-                exp_inflow.data.cpu().numpy(),
-                exp_outflow.data.cpu().numpy(),
-                r.data.cpu().numpy(),
-                mols[1],
-                [i.pow(2).sum().item() for i in model.parameters()],
-                torch.autograd.grad(loss, qsa_p, retain_graph=True)[0].data.cpu().numpy(),
-                torch.autograd.grad(loss, stem_out_s, retain_graph=True)[0].data.cpu().numpy(),
-                torch.autograd.grad(loss, stem_out_p, retain_graph=True)[0].data.cpu().numpy(),
-            ))
         if args.clip_grad > 0:
             torch.nn.utils.clip_grad_value_(model.parameters(),
                                            args.clip_grad)
@@ -431,10 +430,11 @@ def train_generative_model(args, model, proxy, dataset, num_steps=None, do_save=
     stop_everything()
     if do_save:
         save_stuff()
+        writer.close()
     return model, dataset, {'train_losses': train_losses,
                             'test_losses': test_losses,
                             'test_infos': test_infos,
-                            'train_infos': train_infos}
+                            'train_infos': diagnostics.infos()}
 
 @ray.remote
 class _SimDockLet:
@@ -524,7 +524,7 @@ def sample_and_update_dataset(args, model, proxy_dataset, generator_dataset, doc
 
 def main(args):
     bpath = "data/blocks_PDB_105.json"
-    device = torch.device('cuda')
+    device = setup_execution(args, sampler_threads=8)
     proxy_repr_type = args.proxy_repr_type
     repr_type = args.repr_type
     reward_exp = args.reward_exp
@@ -565,11 +565,9 @@ def main(args):
         args.reward_exp = reward_exp
         args.reward_norm = reward_norm
         args.replay_mode = "online"
-        gen_model_dataset = GenModelDataset(args, bpath, device)
+        gen_model_dataset = GenModelDataset(args, bpath, device, floatX=float_dtype(args.floatX))
         model = make_model(args, gen_model_dataset.mdp)
-
-        if args.floatX == 'float64':
-            model = model.double()
+        model.to(gen_model_dataset.floatX)
         model.to(device)
         # train model with with proxy
         print(f"Training model: {i}")
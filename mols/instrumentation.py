@@ -0,0 +1,198 @@
+"""
+Lightweight per-stage timing for the training loop and the samplers.
+
+Code paths are wrapped in `stage(name)`, decorated with `timed(name)`,
+or, for a sequence of stages in a loop, timed with the `lap()` callable.
+When instrumentation is disabled (the default) all of them reduce to a
+single attribute check. When enabled, durations are measured
+with `time.perf_counter` and kept in a rolling window per stage, from
+which `snapshot()` computes percentiles. `stage(name, worker=i)` also
+accumulates the busy time of sampler thread `i`, which `snapshot()`
+turns into a utilization (busy time / wall time since the previous
+snapshot). The process RSS is reported through psutil.
+
+    instrumentation.configure(enabled=True, sync=torch.cuda.synchronize)
+    lap = instrumentation.lap()
+    s = sampler(); lap('sampler_wait')
+    loss.backward(); lap('backward', sync=True)
+    exporter = instrumentation.JsonlExporter(f'{exp_dir}/timings.jsonl')
+    exporter.write(instrumentation.snapshot(), step=i)
+
+`serve_prometheus(port)` exposes the latest snapshot in the Prometheus
+text format on localhost.
+"""
+from collections import defaultdict, deque
+from contextlib import contextmanager
+import functools
+import http.server
+import json
+import threading
+import time
+
+import numpy as np
+import psutil
+
+
+def _noop(*a, **kw):
+    pass
+
+
+class Instrumentation:
+
+    def __init__(self, window=1000):
+        self.enabled = False
+        self.sync = None
+        self.window = window
+        self._durations = defaultdict(lambda: deque(maxlen=self.window))
+        self._counts = defaultdict(int)
+        self._totals = defaultdict(float)
+        self._busy = defaultdict(float)
+        self._last_busy = {}
+        self._last_time = time.perf_counter()
+        self._lock = threading.Lock()
+        self._process = psutil.Process()
+        self.last_snapshot = {}
+
+    def configure(self, enabled=True, sync=None, window=None):
+        """`sync` is called before reading the clock for stages that ask
+        for it, e.g. torch.cuda.synchronize so that GPU stages aren't just
+        kernel launch times"""
+        self.enabled = enabled
+        self.sync = sync
+        if window is not None:
+            self.window = window
+
+    def _sync(self, sync):
+        if sync and self.sync is not None:
+            self.sync()
+
+    @contextmanager
+    def stage(self, name, worker=None, sync=False):
+        if not self.enabled:
+            yield
+            return
+        self._sync(sync)
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._sync(sync)
+            self.add(name, time.perf_counter() - t0, worker)
+
+    def lap(self):
+        """Returns f(name, sync=False) which records the time elapsed since
+        the previous call (or since lap() was called) under `name`"""
+        if not self.enabled:
+            return _noop
+        last = [time.perf_counter()]
+        def f(name, sync=False):
+            self._sync(sync)
+            t = time.perf_counter()
+            self.add(name, t - last[0])
+            last[0] = t
+        return f
+
+    def timed(self, name):
+        def deco(f):
+            @functools.wraps(f)
+            def g(*a, **kw):
+                if not self.enabled:
+                    return f(*a, **kw)
+                t0 = time.perf_counter()
+                try:
+                    return f(*a, **kw)
+                finally:
+                    self.add(name, time.perf_counter() - t0)
+            return g
+        return deco
+
+    def add(self, name, dt, worker=None):
+        with self._lock:
+            self._durations[name].append(dt)
+            self._counts[name] += 1
+            self._totals[name] += dt
+            if worker is not None:
+                self._busy[worker] += dt
+
+    def snapshot(self):
+        now = time.perf_counter()
+        with self._lock:
+            durations = {k: np.float64(v) for k, v in self._durations.items() if len(v)}
+            counts = dict(self._counts)
+            totals = dict(self._totals)
+            busy = dict(self._busy)
+        wall = max(now - self._last_time, 1e-9)
+        stages = {}
+        for k, d in durations.items():
+            p50, p90, p99 = np.percentile(d, [50, 90, 99])
+            stages[k] = {'count': counts[k], 'total': totals[k], 'mean': d.mean(),
+                         'p50': p50, 'p90': p90, 'p99': p99}
+        util = {w: (b - self._last_busy.get(w, 0)) / wall for w, b in busy.items()}
+        self._last_busy = busy
+        self._last_time = now
+        self.last_snapshot = {'time': time.time(),
+                              'stages': stages,
+                              'sampler_utilization': util,
+                              'rss_mb': self._process.memory_info().rss / 2**20}
+        return self.last_snapshot
+
+
+# Process wide instance, so library code (mdp, proxies, samplers) can be
+# instrumented without passing it around.
+_default = Instrumentation()
+configure = _default.configure
+stage = _default.stage
+lap = _default.lap
+timed = _default.timed
+snapshot = _default.snapshot
+
+
+def get():
+    return _default
+
+
+class JsonlExporter:
+    """Appends one json line per snapshot"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, snap, **extra):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps({**extra, **snap}, default=float) + '\n')
+
+
+def prometheus_text(snap, prefix='gflownet'):
+    lines = []
+    for k, s in snap.get('stages', {}).items():
+        for q in ('p50', 'p90', 'p99'):
+            lines.append(f'{prefix}_stage_seconds{{stage="{k}",quantile="0.{q[1:]}"}} {s[q]:.9f}')
+        lines.append(f'{prefix}_stage_seconds_sum{{stage="{k}"}} {s["total"]:.9f}')
+        lines.append(f'{prefix}_stage_seconds_count{{stage="{k}"}} {s["count"]}')
+    for w, u in snap.get('sampler_utilization', {}).items():
+        lines.append(f'{prefix}_sampler_utilization{{worker="{w}"}} {u:.6f}')
+    if 'rss_mb' in snap:
+        lines.append(f'{prefix}_rss_bytes {int(snap["rss_mb"] * 2**20)}')
+    return '\n'.join(lines) + '\n'
+
+
+def serve_prometheus(port, instrumentation=None):
+    """Serves the last snapshot of `instrumentation` on 127.0.0.1:port
+    from a daemon thread. Returns the server (call .shutdown() to stop)."""
+    inst = instrumentation or _default
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = prometheus_text(inst.last_snapshot).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *a):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
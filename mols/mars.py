@@ -3,10 +3,8 @@ from copy import copy, deepcopy
 from collections import defaultdict
 from datetime import timedelta
 import gc
-import gzip
 import os
 import os.path as osp
-import pickle
 import psutil
 import pdb
 import subprocess
@@ -36,8 +34,11 @@ import concurrent.futures
 from mol_mdp_ext import MolMDPExtended, BlockMoleculeDataExtended
 from gflownet import Proxy, make_model
 import reward_proxy
+import quantized_proxy
 from utils import sascore
 import model_atom, model_block, model_fingerprint
+from execution import add_execution_args, setup_execution, float_dtype
+from results_writer import AsyncResultsWriter
 from compute_metrics import MultiObjectiveStatsHook
 
 parser = argparse.ArgumentParser()
@@ -68,11 +69,14 @@ parser.add_argument("--model_version", default='v5')
 parser.add_argument("--run", default=0, help="run", type=int)
 parser.add_argument("--save_path", default='results/mars/')
 parser.add_argument("--proxy_path", default='data/pretrained_proxy/')
+parser.add_argument("--proxy_quantize", default=False, action='store_true',
+                    help="run the proxy with int8 weights, see quantized_proxy.py")
 parser.add_argument("--print_array_length", default=False, action='store_true')
 parser.add_argument("--progress", default='yes')
 parser.add_argument("--reward_type", default='sum')
 parser.add_argument("--use_wandb", default=False, action='store_true')
 parser.add_argument("--num_objectives", default=2, type=int)
+add_execution_args(parser)
 
 
 class SplitCategorical:
@@ -98,8 +102,10 @@ class SplitCategorical:
         return Categorical(probs=torch.cat([self.cats[0].probs, self.cats[1].probs], -1) * 0.5).entropy()
 
 
-def _load_task_models(pretrained_path):
+def _load_task_models(pretrained_path, quantize=False):
     model = reward_proxy.load_original_model(pretrained_path)
+    if quantize:
+        model = quantized_proxy.quantize(model)
     return {'seh': model}
 
 
@@ -126,15 +132,13 @@ class Dataset:
         self.R_min = 1e-8
         self.min_blocks = args.min_blocks
         self.max_blocks = args.max_blocks
-        self.floatX = torch.double
-        self.mdp.floatX = self.floatX
         self.args = args
         #######
         # This is the "result", here a list of (reward, BlockMolDataExt) tuples
         self.sampled_mols = []
         self.current_mols = []
         self.reward_exp = args.reward_exp
-        self.proxy_reward = _load_task_models(args.proxy_path)['seh']
+        self.proxy_reward = _load_task_models(args.proxy_path, args.proxy_quantize)['seh']
         self.stats_hook = MultiObjectiveStatsHook(256, args.num_objectives)
 
         if args.use_wandb:
@@ -287,11 +291,8 @@ _stop = [None]
 
 def main(args):
     bpath = "data/blocks_PDB_105.json"
-    device = torch.device('cuda')
-    if args.floatX == 'float32':
-        args.floatX = torch.float
-    else:
-        args.floatX = torch.double
+    device = setup_execution(args)
+    args.floatX = float_dtype(args.floatX)
     # tf = lambda x: torch.tensor(x, device=device).float()
     tf = lambda x: torch.tensor(x, device=device).to(args.floatX)
     tint = lambda x: torch.tensor(x, device=device).long()
@@ -299,7 +300,7 @@ def main(args):
     dataset = Dataset(args, bpath, device, args.repr_type, floatX=args.floatX)
 
     exp_dir = f'{args.save_path}'
-    os.makedirs(exp_dir, exist_ok=True)
+    writer = AsyncResultsWriter(exp_dir)
     print(args)
     debug_no_threads = True
 
@@ -307,7 +308,7 @@ def main(args):
 
     stop_event = threading.Event()
     model = make_model(args, mdp)
-    model.to(torch.double)
+    model.to(args.floatX)
     model.to(device)
 
     # Just replace this my reward_proxy.py
@@ -330,19 +331,16 @@ def main(args):
     _stop[0] = stop_everything
 
     def save_stuff():
-        pickle.dump([i.data.cpu().numpy() for i in model.parameters()],
-                    gzip.open(f'{exp_dir}/params.pkl.gz', 'wb'))
-
-        pickle.dump(dataset.sampled_mols,
-                    gzip.open(f'{exp_dir}/sampled_mols.pkl.gz', 'wb'))
-
-        pickle.dump({'train_losses': train_losses,
-                     'test_losses': test_losses,
-                     'test_infos': test_infos,
-                     'time_start': time_start,
-                     'time_now': time.time(),
-                     'args': args, },
-                    gzip.open(f'{exp_dir}/info.pkl.gz', 'wb'))
+        # Pickling happens on the writer's thread, growing lists are
+        # written incrementally (see results_writer.load_results).
+        writer.put('params', writer.snapshot(model.parameters()))
+        writer.stream('train_sampled_mols', dataset.sampled_mols)
+        writer.put('info', {'train_losses': writer.stream('train_losses', train_losses),
+                            'test_losses': list(test_losses),
+                            'test_infos': list(test_infos),
+                            'time_start': time_start,
+                            'time_now': time.time(),
+                            'args': args,})
 
     train_losses = []
     test_losses = []
@@ -397,12 +395,15 @@ def main(args):
 
     # Sample 5000 molecules for evaluation.
     model.eval()
-    dataset = Dataset(args, bpath, device, args.repr_type, floatX=args.floatX)
-    dataset.set_sampling_model(model, sample_prob=args.sample_prob)
-    dataset.step_all(num_threads)
-    dataset.log_metrics("test")
+    test_dataset = Dataset(args, bpath, device, args.repr_type, floatX=args.floatX)
+    test_dataset.set_sampling_model(model, sample_prob=args.sample_prob)
+    test_dataset.step_all(num_threads)
+    test_dataset.log_metrics("test")
     stop_everything()
+    # as before, sampled_mols ends up holding the evaluation molecules
+    writer.put('sampled_mols', list(test_dataset.sampled_mols))
     save_stuff()
+    writer.close()
     print('Done.')
 
 
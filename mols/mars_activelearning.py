@@ -9,7 +9,6 @@ import os.path as osp
 import pickle
 from types import prepare_class
 import psutil
-import pdb
 import subprocess
 import sys
 import threading
@@ -36,7 +35,9 @@ import ray
 from mol_mdp_ext import MolMDPExtended, BlockMoleculeDataExtended
 
 import model_atom, model_block, model_fingerprint
+from execution import add_execution_args, setup_execution, float_dtype
 from train_proxy import Dataset as _ProxyDataset
+from proxy_data import make_proxy_loader, iterate_forever, batch_to
 from mars import Dataset as GenModelDataset
 from mars import SplitCategorical
 tmp_dir = '/tmp/molexp/'
@@ -55,6 +56,7 @@ parser.add_argument("--num_init_examples", default=2000, type=int)
 parser.add_argument("--num_outer_loop_iters", default=25, type=int)
 parser.add_argument("--num_samples", default=200, type=int)
 parser.add_argument("--proxy_num_conv_steps", default=12, type=int)
+parser.add_argument("--proxy_num_workers", default=8, help="DataLoader worker processes", type=int)
 parser.add_argument("--proxy_repr_type", default='atom_graph')
 parser.add_argument("--proxy_model_version", default='v2')
 parser.add_argument("--save_path", default='results/')
@@ -94,6 +96,7 @@ parser.add_argument("--model_version", default='v5')
 parser.add_argument("--run", default=0, help="run", type=int)
 parser.add_argument("--balanced_loss", default=True)
 parser.add_argument("--floatX", default='float64')
+add_execution_args(parser)
 
 
 class ProxyDataset(_ProxyDataset):
@@ -132,7 +135,7 @@ class Proxy:
         # params = pickle.load(gzip.open(f'{args.proxy_path}/best_params.pkl.gz'))
         self.mdp = MolMDPExtended(bpath)
         self.mdp.post_init(device, args.proxy_repr_type)
-        self.mdp.floatX = torch.double
+        self.mdp.floatX = float_dtype(args.floatX)
         self.proxy = make_model(args, self.mdp, is_proxy=True)
         # for a,b in zip(self.proxy.parameters(), params):
         #     a.data = torch.tensor(b, dtype=self.mdp.floatX)
@@ -155,14 +158,18 @@ class Proxy:
         mbsize = self.args.mbsize
 
         if not debug_no_threads:
-            sampler = dataset.start_samplers(8, mbsize)
+            train_loader = make_proxy_loader(dataset.train_mols, dataset.mdp, mbsize,
+                                             num_workers=self.args.proxy_num_workers,
+                                             seed=self.args.run)
+            sampler = iterate_forever(train_loader, self.device)
+        test_loader = make_proxy_loader(dataset.test_mols, dataset.mdp, max(mbsize, 128),
+                                        num_workers=0, shuffle=False)
 
         last_losses = []
 
         def stop_everything():
             stop_event.set()
             print('joining')
-            dataset.stop_samplers_and_join()
 
         train_losses = []
         test_losses = []
@@ -174,15 +181,9 @@ class Proxy:
 
         for i in range(self.args.proxy_num_iterations+1):
             if not debug_no_threads:
-                r = sampler()
-                for thread in dataset.sampler_threads:
-                    if thread.failed:
-                        stop_event.set()
-                        stop_everything()
-                        pdb.post_mortem(thread.exception.__traceback__)
-                s, r = r
+                s, r = next(sampler)
             else:
-                p, pb, a, r, s, d = dataset.sample2batch(dataset.sample(mbsize))
+                s, r = dataset.sample2batch(dataset.sample(mbsize))
 
             # state outputs
             stem_out_s, mol_out_s = self.proxy(s, None, do_stems=False)
@@ -212,7 +213,7 @@ class Proxy:
                 total_test_loss = 0
                 total_test_n = 0
 
-                for s, r in dataset.itertest(max(mbsize, 128)):
+                for s, r in map(lambda b: batch_to(b, self.device), test_loader):
                     with torch.no_grad():
                         stem_o, mol_o = self.proxy(s, None, do_stems=False)
                         loss = (mol_o[:, 0] - r).pow(2)
@@ -262,18 +263,17 @@ def make_model(args, mdp, is_proxy=False):
                                      version=model_version,
                                      dropout_rate=args.proxy_dropout)
     elif repr_type == 'morgan_fingerprint':
-        raise ValueError('reimplement me')
-        model = model_fingerprint.MFP_MLP(args.nemb, 3, mdp.num_blocks, 1)
+        model = model_fingerprint.MFP_MLP(nemb, 0, mdp.num_blocks, 1)
     return model
 
 
 _stop = [None]
 def train_generative_model(args, model, proxy, dataset, num_steps=None, do_save=True):
-    device = torch.device('cuda')
+    device = dataset._device
     debug_no_threads = False
     mdp = dataset.mdp
-    model = model.double()
-    proxy.proxy = proxy.proxy.double()
+    model = model.to(dataset.floatX)
+    proxy.proxy = proxy.proxy.to(proxy.mdp.floatX)
     stop_event = threading.Event()
 
     dataset.set_sampling_model(model, proxy, sample_prob=args.sample_prob)
@@ -281,7 +281,7 @@ def train_generative_model(args, model, proxy, dataset, num_steps=None, do_save=
     opt = torch.optim.Adam(model.parameters(), args.learning_rate, #weight_decay=1e-4,
                            betas=(args.opt_beta, 0.99))
 
-    tf = lambda x: torch.tensor(x, device=device).double()
+    tf = lambda x: torch.tensor(x, device=device).to(dataset.floatX)
     tint = lambda x: torch.tensor(x, device=device).long()
 
     mbsize = args.mbsize
@@ -462,7 +462,7 @@ def sample_and_update_dataset(args, model, proxy_dataset, generator_dataset, doc
 def main(args):
     ray.init()
     bpath = "data/blocks_PDB_105.json"
-    device = torch.device('cuda')
+    device = setup_execution(args, sampler_threads=8)
     proxy_repr_type = args.proxy_repr_type
     repr_type = args.repr_type
     reward_exp = args.reward_exp
@@ -505,11 +505,10 @@ def main(args):
         args.reward_exp = reward_exp
         args.reward_norm = reward_norm
         args.replay_mode = "online"
-        gen_model_dataset = GenModelDataset(args, bpath, device, args.repr_type)
+        gen_model_dataset = GenModelDataset(args, bpath, device, args.repr_type,
+                                            floatX=float_dtype(args.floatX))
         model = make_model(args, gen_model_dataset.mdp)
-
-        if args.floatX == 'float64':
-            model = model.double()
+        model.to(gen_model_dataset.floatX)
         model.to(device)
         # train model with with proxy
         print(f"Training model: {i}")
@@ -21,6 +21,7 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 from torch_geometric.nn import NNConv, Set2Set
 from torch_geometric.data import Data, Batch
 import torch_geometric.nn as gnn
@@ -35,12 +36,15 @@ class MPNNet_v2(nn.Module):
     def __init__(self, num_feat=14, num_vec=3, dim=64,
                  num_out_per_mol=1, num_out_per_stem=105,
                  num_out_per_bond=1,
-                 num_conv_steps=12, version='v1', dropout_rate=None):
+                 num_conv_steps=12, version='v1', dropout_rate=None, checkpoint_segments=0):
         super().__init__()
         self.lin0 = nn.Linear(num_feat + num_vec, dim)
         self.num_ops = num_out_per_stem
         self.num_opm = num_out_per_mol
         self.num_conv_steps = num_conv_steps
+        # if > 0, the message passing steps are split in that many
+        # segments whose activations are recomputed during backward
+        self.checkpoint_segments = checkpoint_segments
         self.version = int(version[1:])
         self.dropout_rate = dropout_rate
         print('v:', self.version)
@@ -98,19 +102,13 @@ class MPNNet_v2(nn.Module):
         h = out.unsqueeze(0)
         h = F.dropout(h, training=do_dropout, p=self.dropout_rate)
 
-        if self.version < 4:
-            for i in range(self.num_conv_steps):
-                m = self.act(self.conv(out, data.edge_index, data.edge_attr))
-                m = F.dropout(m, training=do_dropout, p=self.dropout_rate)
-                out, h = self.gru(m.unsqueeze(0).contiguous(), h.contiguous())
-                h = F.dropout(h, training=do_dropout, p=self.dropout_rate)
-                out = out.squeeze(0)
-        elif self.version == 4 or self.version == 6:
-            for i in range(self.num_conv_steps):
-                out = self.act(self.conv(out, data.edge_index, data.edge_attr))
+        if self.checkpoint_segments and torch.is_grad_enabled():
+            for steps in np.array_split(np.arange(self.num_conv_steps), self.checkpoint_segments):
+                out, h = checkpoint(self._conv_steps, int(steps[0]), len(steps), out, h,
+                                    data.edge_index, data.edge_attr, do_dropout)
         else:
-            for i in range(self.num_conv_steps):
-                out = self.act(self.convs[i](out, data.edge_index, data.edge_attr))
+            out, h = self._conv_steps(0, self.num_conv_steps, out, h,
+                                      data.edge_index, data.edge_attr, do_dropout)
         if self.version >= 4:
             global_out = gnn.global_mean_pool(out, data.batch)
 
@@ -151,9 +149,24 @@ class MPNNet_v2(nn.Module):
             return per_stem_out, per_mol_out, per_bond_out
         return per_stem_out, per_mol_out
 
+    def _conv_steps(self, start, n, out, h, edge_index, edge_attr, do_dropout):
+        for i in range(start, start + n):
+            if self.version < 4:
+                m = self.act(self.conv(out, edge_index, edge_attr))
+                m = F.dropout(m, training=do_dropout, p=self.dropout_rate)
+                out, h = self.gru(m.unsqueeze(0).contiguous(), h.contiguous())
+                h = F.dropout(h, training=do_dropout, p=self.dropout_rate)
+                out = out.squeeze(0)
+            elif self.version == 4 or self.version == 6:
+                out = self.act(self.conv(out, edge_index, edge_attr))
+            else:
+                out = self.act(self.convs[i](out, edge_index, edge_attr))
+        return out, h
+
 
 class MolAC_GCN(nn.Module):
-    def __init__(self, nhid, nvec, num_out_per_stem, num_out_per_mol, num_conv_steps, version, dropout_rate=0, do_stem_mask=True, do_nblocks=False):
+    def __init__(self, nhid, nvec, num_out_per_stem, num_out_per_mol, num_conv_steps, version, dropout_rate=0, do_stem_mask=True, do_nblocks=False,
+                 checkpoint_segments=0):
         nn.Module.__init__(self)
         self.training_steps = 0
         # atomfeats + stem_mask + atom one hot + nblocks
@@ -166,7 +179,8 @@ class MolAC_GCN(nn.Module):
             num_out_per_stem=num_out_per_stem,
             num_conv_steps=num_conv_steps,
             version=version,
-            dropout_rate=dropout_rate)
+            dropout_rate=dropout_rate,
+            checkpoint_segments=checkpoint_segments)
 
     def out_to_policy(self, s, stem_o, mol_o):
         stem_e = torch.exp(stem_o)
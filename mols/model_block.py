@@ -6,12 +6,14 @@ from rdkit.Chem import QED
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 from torch_geometric.data import Data, Batch
 import torch_geometric.nn as gnn
 
 class GraphAgent(nn.Module):
 
-    def __init__(self, nemb, nvec, out_per_stem, out_per_mol, num_conv_steps, mdp_cfg, version='v1'):
+    def __init__(self, nemb, nvec, out_per_stem, out_per_mol, num_conv_steps, mdp_cfg, version='v1',
+                 checkpoint_segments=0):
         super().__init__()
         print(version)
         if version == 'v5': version = 'v4'
@@ -33,13 +35,21 @@ class GraphAgent(nn.Module):
                                          nn.Linear(nemb, out_per_mol))
         #self.set2set = Set2Set(nemb, processing_steps=3)
         self.num_conv_steps = num_conv_steps
+        # if > 0, the message passing steps are split in that many
+        # segments whose activations are recomputed during backward
+        self.checkpoint_segments = checkpoint_segments
         self.nemb = nemb
         self.training_steps = 0
         self.categorical_style = 'softmax'
         self.escort_p = 6
+        # use inference_forward when autograd is off
+        self.fused_inference = True
 
 
     def forward(self, graph_data, vec_data=None, do_stems=True):
+        if (self.fused_inference and not torch.is_grad_enabled()
+            and (self.version == 'v2' or self.version == 'v4')):
+            return self.inference_forward(graph_data, vec_data, do_stems)
         blockemb, stememb, bondemb = self.embeddings
         graph_data.x = blockemb(graph_data.x)
         if do_stems:
@@ -57,23 +67,63 @@ class GraphAgent(nn.Module):
 
         h = out.unsqueeze(0)
 
+        if self.checkpoint_segments and torch.is_grad_enabled():
+            for n in np.array_split(np.arange(self.num_conv_steps), self.checkpoint_segments):
+                out, h = checkpoint(self._conv_steps, len(n), out, h,
+                                    graph_data.edge_index, graph_data.edge_attr)
+        else:
+            out, h = self._conv_steps(self.num_conv_steps, out, h,
+                                      graph_data.edge_index, graph_data.edge_attr)
+
+        return self._heads(graph_data, out, graph_data.stemtypes if do_stems else None, vec_data)
+
+    def inference_forward(self, graph_data, vec_data=None, do_stems=True):
+        """forward() for v2 and v4 without autograd, and without modifying
+        graph_data. NNConv's weight for an edge is the outer product a b^T of
+        the edge's two bond embeddings, so its message x_j a b^T is
+        (x_j . a) b, which avoids the (num_edges, nemb**2) edge features;
+        the GRU step is a single gru_cell. Same outputs as forward up to
+        float rounding."""
+        blockemb, stememb, bondemb = self.embeddings
+        conv = self.conv
+        src, dst = graph_data.edge_index
+        bond_a = bondemb(graph_data.edge_attr[:, 0])
+        bond_b = bondemb(graph_data.edge_attr[:, 1])
+        out = self.block2emb(blockemb(graph_data.x))
+        # mean aggregation, nodes without incoming edges get 0
+        inv_deg = 1 / (torch.zeros(out.shape[0], dtype=out.dtype, device=out.device)
+                       .index_add_(0, dst, torch.ones_like(bond_a[:, 0])).clamp(min=1))
+        gru = self.gru
         for i in range(self.num_conv_steps):
-            m = F.leaky_relu(self.conv(out, graph_data.edge_index, graph_data.edge_attr))
-            out, h = self.gru(m.unsqueeze(0).contiguous(), h.contiguous())
-            out = out.squeeze(0)
-
+            msg = (out[src] * bond_a).sum(1, keepdim=True) * bond_b
+            m = torch.zeros_like(out).index_add_(0, dst, msg) * inv_deg[:, None]
+            if getattr(conv, 'root', None) is not None: # torch_geometric < 2
+                m = m + out @ conv.root
+            elif getattr(conv, 'lin', None) is not None:
+                m = m + conv.lin(out)
+            if conv.bias is not None:
+                m = m + conv.bias
+            if type(gru) is nn.GRU:
+                out = torch.gru_cell(F.leaky_relu(m), out, gru.weight_ih_l0, gru.weight_hh_l0,
+                                     gru.bias_ih_l0, gru.bias_hh_l0)
+            else: # e.g. quantized
+                out = gru(F.leaky_relu(m)[None], out[None])[1][0]
+        return self._heads(graph_data, out,
+                           stememb(graph_data.stemtypes) if do_stems else None, vec_data)
+
+    def _heads(self, graph_data, out, stemtypes, vec_data):
         # Index of the origin block of each stem in the batch (each
         # stem is a pair [block idx, stem atom type], we need to
         # adjust for the batch packing)
-        if do_stems:
+        if stemtypes is not None:
             stem_block_batch_idx = (
                 torch.tensor(graph_data.__slices__['x'], device=out.device)[graph_data.stems_batch]
                 + graph_data.stems[:, 0])
             if self.version == 'v1' or self.version == 'v4':
-                stem_out_cat = torch.cat([out[stem_block_batch_idx], graph_data.stemtypes], 1)
+                stem_out_cat = torch.cat([out[stem_block_batch_idx], stemtypes], 1)
             elif self.version == 'v2' or self.version == 'v3':
                 stem_out_cat = torch.cat([out[stem_block_batch_idx],
-                                          graph_data.stemtypes,
+                                          stemtypes,
                                           vec_data[graph_data.stems_batch]], 1)
 
             stem_preds = self.stem2pred(stem_out_cat)
@@ -82,6 +132,13 @@ class GraphAgent(nn.Module):
         mol_preds = self.global2pred(gnn.global_mean_pool(out, graph_data.batch))
         return stem_preds, mol_preds
 
+    def _conv_steps(self, n, out, h, edge_index, edge_attr):
+        for i in range(n):
+            m = F.leaky_relu(self.conv(out, edge_index, edge_attr))
+            out, h = self.gru(m.unsqueeze(0).contiguous(), h.contiguous())
+            out = out.squeeze(0)
+        return out, h
+
     def out_to_policy(self, s, stem_o, mol_o):
         if self.categorical_style == 'softmax':
             stem_e = torch.exp(stem_o)
@@ -1,3 +1,6 @@
+from collections import OrderedDict
+import threading
+
 import numpy as np
 import torch
 import torch.nn as nn
@@ -11,6 +14,11 @@ FP_CONFIG = {
     "stem_fp_len": 64,
     "stem_fp_radiis": [4, 3, 2]
 }
+# fingerprints are computed from the RDKit molecule, which is itself
+# rebuilt from the blocks, so they are cached per state
+FP_CACHE_SIZE = 100000
+_fp_cache = OrderedDict()
+_fp_cache_lock = threading.Lock()
 
 class MFP_MLP(nn.Module):
 
@@ -18,9 +26,10 @@ class MFP_MLP(nn.Module):
         super().__init__()
         act = nn.LeakyReLU()
 
-        self.m2h = nn.Linear(FP_CONFIG['mol_fp_len'], nhid) # mol
-        self.s2h = nn.Linear(FP_CONFIG['stem_fp_len'] * FP_CONFIG['mol_fp_radiis'][0], nhid) # stem
-        self.b2h = nn.Linear(FP_CONFIG['stem_fp_len'] * FP_CONFIG['mol_fp_radiis'][0], nhid) # bond
+        stem_fp_len = FP_CONFIG['stem_fp_len'] * len(FP_CONFIG['stem_fp_radiis'])
+        self.m2h = nn.Linear(FP_CONFIG['mol_fp_len'] * len(FP_CONFIG['mol_fp_radiis']), nhid) # mol
+        self.s2h = nn.Linear(stem_fp_len, nhid) # stem
+        self.b2h = nn.Linear(stem_fp_len, nhid) # bond
 
         self.h2stemp = nn.Sequential(nn.Linear(nhid * 2, nhid), act,
                                      nn.Linear(nhid, nhid), act,
@@ -33,23 +42,38 @@ class MFP_MLP(nn.Module):
                                     nn.Linear(nhid, out_per_mol))
         self.categorical_style = 'escort'
         self.escort_p = 4
+        self.training_steps = 0
 
-    def forward(self, x, v):
+    def forward(self, x, v=None, do_stems=True):
         molx, stemx, stem_batch, bondx, bond_batch, _ = x
         molh = self.m2h(molx)
-        stemh = self.s2h(stemx)
         bondh = self.b2h(bondx)
 
         # push bond, vec and mol info together
-        per_bond_molh = self.h2molh(torch.cat([molh[bond_batch], bondh, v[bond_batch]], 1))
+        per_bond_molh = self.h2molh(torch.cat([molh[bond_batch], bondh] +
+                                              ([v[bond_batch]] if v is not None else []), 1))
         # then reduce to molh
         molh = torch.zeros_like(molh).index_add_(0, bond_batch, per_bond_molh)
         # push stem and mol info (now mol+bond info) together
-        per_stem_pred = self.h2stemp(torch.cat([molh[stem_batch], stemh], 1))
+        if do_stems:
+            stemh = self.s2h(stemx)
+            per_stem_pred = self.h2stemp(torch.cat([molh[stem_batch], stemh], 1))
+        else:
+            per_stem_pred = None
         # compute per-molecule outputs
         per_mol_pred = self.molh2o(molh)
         return per_stem_pred, per_mol_pred
 
+    def index_output_by_action(self, s, stem_o, mol_o, a):
+        stem_slices = s.stem_slices
+        return (
+            stem_o[stem_slices + a[:, 1]][
+                torch.arange(a.shape[0]), a[:, 0]] * (a[:, 0] >= 0)
+            + mol_o * (a[:, 0] == -1))
+
+    def sum_output(self, s, stem_o, mol_o):
+        return torch.zeros_like(mol_o).index_add_(0, s.stems_batch, stem_o.sum(1)) + mol_o
+
 
     def out_to_policy(self, s, stem_o, mol_o):
 
@@ -91,16 +115,60 @@ class MFP_MLP(nn.Module):
                 torch.arange(a.shape[0]), a[:, 0]] * (a[:, 0] >= 0)
             + mol_lsm * (a[:, 0] == -1))
 
-def mol2fp(mol, mdp):
+def _fp_key(mol):
+    return (tuple(mol.blockidxs), tuple(tuple(int(j) for j in i) for i in mol.jbonds),
+            tuple(tuple(int(j) for j in i) for i in mol.stems))
+
+
+def clear_fp_cache():
+    with _fp_cache_lock:
+        _fp_cache.clear()
+
+
+def mol2fp(mol, mdp, floatX=torch.float):
     if fpe[0] is None:
         fpe[0] = chem.FPEmbedding_v2(
             FP_CONFIG['mol_fp_len'],
             FP_CONFIG['mol_fp_radiis'],
             FP_CONFIG['stem_fp_len'],
             FP_CONFIG['stem_fp_radiis'])
-    # ask for non-empty stem and bond embeddings so that they at least
-    # have shape (1, n), rather than (0, n) if there are not stems/bonds
-    return list(map(torch.tensor,fpe[0](mol, non_empty=True)))  # mol_fp, stem_fps, jbond_fps
+    key = _fp_key(mol)
+    with _fp_cache_lock:
+        fps = _fp_cache.get(key)
+        if fps is not None:
+            _fp_cache.move_to_end(key)
+    if fps is None:
+        # ask for non-empty stem and bond embeddings so that they at least
+        # have shape (1, n), rather than (0, n) if there are not stems/bonds
+        fps = fpe[0](mol, non_empty=True) # mol_fp, stem_fps, jbond_fps
+        with _fp_cache_lock:
+            _fp_cache[key] = fps
+            if len(_fp_cache) > FP_CACHE_SIZE:
+                _fp_cache.popitem(last=False)
+    return [torch.tensor(i, dtype=floatX) for i in fps]
+
+
+class FPBatch(tuple):
+    """(molx, stemx, stem_batch, bondx, bond_batch, stem_slices), with
+    stems_batch as an attribute like on the graph batches"""
+
+    @property
+    def stems_batch(self):
+        return self[2]
+
+    @property
+    def stem_slices(self):
+        return self[5]
+
+    @property
+    def num_graphs(self):
+        return self[0].shape[0]
+
+    def to(self, device, non_blocking=False):
+        return FPBatch(i.to(device, non_blocking=non_blocking) for i in self)
+
+    def pin_memory(self):
+        return FPBatch(i.pin_memory() for i in self)
 
 
 def mols2batch(mols, mdp):
@@ -113,4 +181,4 @@ def mols2batch(mols, mdp):
                             for j,i in enumerate(mols)]).to(mdp.device)
     stem_slices = torch.tensor(np.cumsum([0]+[i[1].shape[0] for i in mols[:-1]]),
                                dtype=torch.long, device=mdp.device)
-    return (molx, stemx, stem_batch, bondx, bond_batch, stem_slices)
+    return FPBatch((molx, stemx, stem_batch, bondx, bond_batch, stem_slices))
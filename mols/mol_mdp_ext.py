@@ -7,11 +7,13 @@ import utils.chem as chem
 from rdkit import Chem
 
 import model_atom, model_block, model_fingerprint
+import instrumentation
 
 
 class BlockMoleculeDataExtended(BlockMoleculeData):
 
     @property
+    @instrumentation.timed('rdkit_mol')
     def mol(self):
         return chem.mol_from_frag(jun_bonds=self.jbonds, frags=self.blocks)[0]
 
@@ -100,6 +102,7 @@ class MolMDPExtended(MolMDP):
                     #      'in position 0 is a symmetric duplicate of',
                     #      symmetric_duplicate)
 
+    @instrumentation.timed('parents')
     def parents(self, mol=None):
         """returns all the possible parents of molecule mol (or the current
         molecule if mol is None.
@@ -164,6 +167,16 @@ class MolMDPExtended(MolMDP):
             raise ValueError('Could not find any parents')
         return parent_mols
 
+    def num_parents(self, mol):
+        """len(self.parents(mol)), without building the parents"""
+        if len(mol.blockidxs) == 1:
+            return 1
+        blocks_degree = defaultdict(int)
+        for a,b,_,_ in mol.jbonds:
+            blocks_degree[a] += 1
+            blocks_degree[b] += 1
+        return sum(d == 1 for d in blocks_degree.values())
+
 
     def add_block_to(self, mol, block_idx, stem_idx=None, atmidx=None):
         '''out-of-place version of add_block'''
@@ -199,6 +212,7 @@ class MolMDPExtended(MolMDP):
         self.repr_type = repr_type
         #self.max_bond_atmidx = max([max(i) for i in self.block_rs])
         self.max_num_atm = max(self.block_natm)
+        self.block_nbonds = np.asarray([b.GetNumBonds() for b in self.block_mols])
         # see model_block.mol2graph
         self.true_block_set = sorted(set(self.block_smi))
         self.stem_type_offset = np.int32([0] + list(np.cumsum([
@@ -219,6 +233,16 @@ class MolMDPExtended(MolMDP):
         elif self.repr_type == 'morgan_fingerprint':
             return model_fingerprint.mols2batch(mols, self)
 
+    def graph_size(self, mol):
+        """(nodes, edges) of mol2repr(mol), without building it. Approximate
+        for atom graphs (bonds counted in both directions)"""
+        if self.repr_type == 'atom_graph':
+            if not len(mol.blockidxs):
+                return 1, 1
+            return (int(self.block_natm[mol.blockidxs].sum()),
+                    2 * (int(self.block_nbonds[mol.blockidxs].sum()) + len(mol.jbonds)))
+        return max(1, len(mol.blockidxs)), len(mol.jbonds)
+
     def mol2repr(self, mol=None):
         if mol is None:
             mol = self.molecule
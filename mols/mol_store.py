@@ -0,0 +1,159 @@
+"""
+Compact storage for the molecules generated during training.
+
+`Dataset.sampled_mols` used to keep every generated
+`BlockMoleculeDataExtended` (with its RDKit block references) and its
+trajectory stats for the whole run. `MolStore` instead keeps:
+ - a bounded window of the most recent full entries (`recent`), for
+   replay and logging,
+ - the `top_capacity` best records, so top-k queries don't touch disk,
+ - a set of 64 bit molecule keys (of the canonical SMILES) for the
+   unique-molecule count,
+and streams every record to the results writer as a compact chunk of
+numpy arrays (blockidxs, jbonds, reward, inflow, step, policy version).
+Runs that save nothing set `persist = False`, and the records are then
+not kept for writing.
+
+`load_mol_store(exp_dir)` reads the chunks back, `record2mol` rebuilds
+a molecule (without stems) from a record.
+"""
+from collections import deque, namedtuple
+import hashlib
+import heapq
+import itertools
+import threading
+
+import numpy as np
+
+from results_writer import load_stream
+
+
+MolRecord = namedtuple('MolRecord', ['blockidxs', 'jbonds', 'reward', 'inflow',
+                                     'step', 'policy_version'])
+
+
+def mol_key(m):
+    """64 bit key of a molecule, from its canonical SMILES so that the
+    same molecule built in different orders gets the same key. Molecules
+    RDKit can't build fall back to their (non canonical) block graph."""
+    from rdkit import Chem
+    rdmol = m.mol
+    if rdmol is not None:
+        s = Chem.MolToSmiles(rdmol)
+    else:
+        s = repr((tuple(m.blockidxs), tuple(map(tuple, m.jbonds))))
+    h = hashlib.blake2b(s.encode(), digest_size=8)
+    return int.from_bytes(h.digest(), 'little')
+
+
+def records2chunk(records):
+    """Packs a list of MolRecords in flat numpy arrays"""
+    nblocks = np.int32([len(i.blockidxs) for i in records])
+    njbonds = np.int32([len(i.jbonds) for i in records])
+    return {
+        'reward': np.float64([i.reward for i in records]),
+        'inflow': np.float32([i.inflow for i in records]),
+        'step': np.int64([i.step for i in records]),
+        'policy_version': np.int64([i.policy_version for i in records]),
+        'nblocks': nblocks.astype(np.uint8),
+        'blockidxs': np.int16(list(itertools.chain(*(i.blockidxs for i in records)))),
+        'njbonds': njbonds.astype(np.uint8),
+        'jbonds': np.int16(list(itertools.chain(*(i.jbonds for i in records)))).reshape((-1, 4)),
+    }
+
+
+def concat_chunks(chunks):
+    if not len(chunks):
+        return records2chunk([])
+    return {k: np.concatenate([c[k] for c in chunks]) for k in chunks[0]}
+
+
+def chunk2records(chunk):
+    boff = np.concatenate([[0], np.cumsum(chunk['nblocks'], dtype=np.int64)])
+    joff = np.concatenate([[0], np.cumsum(chunk['njbonds'], dtype=np.int64)])
+    for i in range(len(chunk['reward'])):
+        yield MolRecord(chunk['blockidxs'][boff[i]:boff[i+1]].tolist(),
+                        chunk['jbonds'][joff[i]:joff[i+1]].tolist(),
+                        float(chunk['reward'][i]), float(chunk['inflow'][i]),
+                        int(chunk['step'][i]), int(chunk['policy_version'][i]))
+
+
+def load_mol_store(exp_dir):
+    """Returns all the records written to `exp_dir` as a single chunk"""
+    return concat_chunks(load_stream(exp_dir, 'mol_store'))
+
+
+def top_k_indices(chunk, k):
+    """Indices of the `k` highest reward records of a chunk, best first"""
+    r = chunk['reward']
+    k = min(k, len(r))
+    if k == 0:
+        return np.zeros(0, dtype=np.int64)
+    idx = np.argpartition(-r, k - 1)[:k]
+    return idx[np.argsort(-r[idx], kind='stable')]
+
+
+def record2mol(rec, mdp):
+    """Rebuilds a BlockMoleculeDataExtended from a record. Stems are not
+    stored, the molecule is only good for `.mol`/`.smiles`."""
+    from mol_mdp_ext import BlockMoleculeDataExtended
+    m = BlockMoleculeDataExtended()
+    m.blockidxs = list(rec.blockidxs)
+    m.blocks = [mdp.block_mols[i] for i in m.blockidxs]
+    m.slices = [0] + list(np.cumsum([mdp.block_natm[i] for i in m.blockidxs]))
+    m.numblocks = len(m.blocks)
+    m.jbonds = [list(i) for i in rec.jbonds]
+    m.reward = rec.reward
+    return m
+
+
+class MolStore:
+
+    def __init__(self, window=10000, top_capacity=1000):
+        # Most recent full entries, e.g. (reward, mol, trajectory_stats, inflow)
+        self.recent = deque(maxlen=window)
+        self.top_capacity = top_capacity
+        self.num_records = 0
+        self._top = [] # min-heap of (reward, record number, record)
+        self._keys = set()
+        self._pending = []
+        self.persist = True # False if nothing will flush the records
+        self._lock = threading.Lock() # add() is called by the sampler threads
+
+    def __len__(self):
+        return self.num_records
+
+    def add(self, m, reward, inflow, step=0, policy_version=0, entry=None):
+        rec = MolRecord(tuple(m.blockidxs), tuple(map(tuple, m.jbonds)),
+                        float(reward), float(inflow), int(step), int(policy_version))
+        key = mol_key(m)
+        with self._lock:
+            self.recent.append(entry if entry is not None else (reward, m))
+            if self.persist:
+                self._pending.append(rec)
+            self._keys.add(key)
+            if len(self._top) < self.top_capacity:
+                heapq.heappush(self._top, (rec.reward, self.num_records, rec))
+            elif rec.reward > self._top[0][0]:
+                heapq.heapreplace(self._top, (rec.reward, self.num_records, rec))
+            self.num_records += 1
+
+    @property
+    def num_unique(self):
+        return len(self._keys)
+
+    def top_k(self, k):
+        """The `k` highest reward records seen so far, best first"""
+        if k > self.top_capacity:
+            raise ValueError(f'only the top {self.top_capacity} records are kept in memory, '
+                             'use load_mol_store for larger queries')
+        with self._lock:
+            top = sorted(self._top, key=lambda i: (-i[0], i[1]))
+        return [i[2] for i in top[:k]]
+
+    def flush(self, writer):
+        """Hands the records added since the last flush to `writer`"""
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if len(pending):
+            writer.extend('mol_store', [records2chunk(pending)])
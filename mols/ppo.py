@@ -4,10 +4,7 @@ from collections import defaultdict
 from datetime import timedelta
 import concurrent.futures
 import gc
-import gzip
-import os
 import os.path as osp
-import pickle
 import psutil
 import pdb
 import subprocess
@@ -30,6 +27,8 @@ import torch_geometric.nn as gnn
 from mol_mdp_ext import MolMDPExtended, BlockMoleculeDataExtended
 from gflownet import Dataset, make_model, Proxy
 import model_atom, model_block, model_fingerprint
+from execution import add_execution_args, setup_execution, float_dtype
+from results_writer import AsyncResultsWriter
 
 parser = argparse.ArgumentParser()
 
@@ -67,14 +66,15 @@ parser.add_argument("--ppo_clip", default=0.2, type=float)
 parser.add_argument("--ppo_entropy_coef", default=1e-4, type=float)
 parser.add_argument("--ppo_num_samples_per_step", default=256, type=float)
 parser.add_argument("--ppo_num_epochs_per_step", default=32, type=float)
+add_execution_args(parser)
 
 
 
 
 class PPODataset(Dataset):
 
-    def __init__(self, args, bpath, device):
-        super().__init__(args, bpath, device)
+    def __init__(self, args, bpath, device, floatX=torch.double):
+        super().__init__(args, bpath, device, floatX=floatX)
         self.current_dataset = []
 
     def _get_sample_model(self):
@@ -112,7 +112,8 @@ class PPODataset(Dataset):
             traj[i].append(r) # The return is the terminal reward
             # the advantage, r + vsp * (1-done) - vs
             traj[i].append(traj[i][2] + (traj[i+1][6] if i < len(traj)-2 else 0) - traj[i][6])
-        self.sampled_mols.append((r, m))
+        self.mol_store.add(m, r, float('nan'), step=self.current_step,
+                           policy_version=getattr(self.sampling_model, 'training_steps', 0))
         return traj
 
     def sample2batch(self, mb):
@@ -181,7 +182,7 @@ _stop = [None]
 
 def train_model_with_proxy(args, model, proxy, dataset, num_steps=None, do_save=True):
     debug_no_threads = False
-    device = torch.device('cuda')
+    device = dataset._device
 
     if num_steps is None:
         num_steps = args.num_iterations + 1
@@ -192,28 +193,28 @@ def train_model_with_proxy(args, model, proxy, dataset, num_steps=None, do_save=
 
     if do_save:
         exp_dir = f'{args.save_path}/{args.array}_{args.run}/'
-        os.makedirs(exp_dir, exist_ok=True)
+        writer = AsyncResultsWriter(exp_dir)
+    else:
+        # nothing flushes the generated molecules' records
+        dataset.mol_store.persist = False
 
 
     dataset.set_sampling_model(model, proxy, sample_prob=args.sample_prob)
 
     def save_stuff():
-        pickle.dump([i.data.cpu().numpy() for i in model.parameters()],
-                    gzip.open(f'{exp_dir}/params.pkl.gz', 'wb'))
-
-        pickle.dump(dataset.sampled_mols,
-                    gzip.open(f'{exp_dir}/sampled_mols.pkl.gz', 'wb'))
-
-        pickle.dump({'train_losses': train_losses,
-                     'test_losses': test_losses,
-                     'test_infos': test_infos,
-                     'time_start': time_start,
-                     'time_now': time.time(),
-                     'args': args,},
-                    gzip.open(f'{exp_dir}/info.pkl.gz', 'wb'))
-
-        pickle.dump(train_infos,
-                    gzip.open(f'{exp_dir}/train_info.pkl.gz', 'wb'))
+        # Pickling happens on the writer's thread, growing lists are
+        # written incrementally (see results_writer.load_results).
+        writer.put('params', writer.snapshot(model.parameters()))
+        dataset.mol_store.flush(writer)
+        writer.put('info', {'train_losses': writer.stream('train_losses', train_losses),
+                            'num_generated_mols': len(dataset.mol_store),
+                            'num_unique_mols': dataset.mol_store.num_unique,
+                            'test_losses': list(test_losses),
+                            'test_infos': list(test_infos),
+                            'time_start': time_start,
+                            'time_now': time.time(),
+                            'args': args,})
+        writer.stream('train_info', train_infos)
 
 
     opt = torch.optim.Adam(model.parameters(), args.learning_rate, weight_decay=args.weight_decay,
@@ -248,6 +249,7 @@ def train_model_with_proxy(args, model, proxy, dataset, num_steps=None, do_save=
     entropy_coef = args.ppo_entropy_coef
 
     for i in range(num_steps):
+        dataset.current_step = i
         samples = []
         with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
             futures = [executor.submit(dataset._get_sample_model)
@@ -297,26 +299,24 @@ def train_model_with_proxy(args, model, proxy, dataset, num_steps=None, do_save=
     stop_everything()
     if do_save:
         save_stuff()
+        writer.close()
     return model
 
 
 def main(args):
     bpath = "data/blocks_PDB_105.json"
-    device = torch.device('cuda')
-
-    if args.floatX == 'float32':
-        args.floatX = torch.float
-    else:
-        args.floatX = torch.double
+    # samples are generated by a pool of 8 threads
+    device = setup_execution(args, sampler_threads=8)
+    args.floatX = float_dtype(args.floatX)
 
-    dataset = PPODataset(args, bpath, device)
+    dataset = PPODataset(args, bpath, device, floatX=args.floatX)
     print(args)
 
 
     mdp = dataset.mdp
 
     model = make_model(args, mdp, out_per_mol=2)
-    model.to(torch.double)
+    model.to(args.floatX)
     model.to(device)
 
     proxy = Proxy(args, bpath, device)
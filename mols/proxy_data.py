@@ -0,0 +1,118 @@
+"""
+Map-style dataset, sampler and collate path for supervised proxy training.
+
+The generative model's `Dataset.start_samplers` threads are built to
+produce whole trajectories from a moving policy. Proxy training only
+needs random (molecule, reward) minibatches from a fixed list, which a
+standard `torch.utils.data.DataLoader` does better: featurization runs
+in worker processes (no GIL contention with the learner), batches are
+collated on the CPU into pinned memory, and the epoch order is a pure
+function of (seed, epoch) so runs are reproducible.
+"""
+from copy import copy
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Sampler
+
+from model_fingerprint import FPBatch
+
+
+class ProxyMolDataset(torch.utils.data.Dataset):
+    """Indexes a list of `BlockMoleculeDataExtended` that have a `.reward`.
+
+    `mols` is held by reference, so molecules appended to it (e.g. by
+    `ProxyDataset.add_samples`) are seen the next time a loader over
+    this dataset is built.
+    """
+
+    def __init__(self, mols, mdp, floatX=torch.float):
+        self.mols = mols
+        # Featurization always happens on the CPU (possibly in a worker
+        # process), the training loop moves whole batches to the device.
+        self.mdp = copy(mdp)
+        self.mdp.device = torch.device('cpu')
+        self.floatX = floatX
+
+    def __len__(self):
+        return len(self.mols)
+
+    def __getitem__(self, idx):
+        m = self.mols[idx]
+        return self.mdp.mol2repr(m), m.reward
+
+    def collate(self, items):
+        graphs, rewards = zip(*items)
+        return (self.mdp.mols2batch(list(graphs)),
+                torch.tensor(rewards).to(self.floatX))
+
+
+class EpochShuffleSampler(Sampler):
+    """Random permutation per epoch, seeded by (seed, epoch).
+
+    Unlike `RandomSampler`, the order does not depend on the global torch
+    RNG or on how many workers the loader uses.
+    """
+
+    def __init__(self, data_source, seed=0):
+        self.data_source = data_source
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        rng = np.random.RandomState((self.seed * 1000003 + self.epoch) % 2**32)
+        return iter(rng.permutation(len(self.data_source)).tolist())
+
+    def __len__(self):
+        return len(self.data_source)
+
+
+def make_proxy_loader(mols, mdp, mbsize, num_workers=8, seed=0, shuffle=True,
+                      floatX=torch.float, prefetch_factor=4):
+    """Builds a DataLoader yielding (graph batch, rewards) on the CPU."""
+    dataset = ProxyMolDataset(mols, mdp, floatX)
+    sampler = EpochShuffleSampler(dataset, seed) if shuffle else None
+    kw = {}
+    if num_workers > 0:
+        kw = dict(persistent_workers=True, prefetch_factor=prefetch_factor)
+    return DataLoader(dataset, batch_size=mbsize, sampler=sampler,
+                      collate_fn=dataset.collate, num_workers=num_workers,
+                      pin_memory=torch.cuda.is_available(),
+                      drop_last=shuffle and len(dataset) >= mbsize,
+                      **kw)
+
+
+def batch_to(batch, device):
+    s, r = batch
+    non_blocking = device.type == 'cuda'
+    if isinstance(s, (list, tuple)):
+        # fingerprint batches, which the DataLoader's pin_memory turns
+        # into lists
+        s = FPBatch(s)
+    return s.to(device, non_blocking=non_blocking), r.to(device, non_blocking=non_blocking)
+
+
+def iterate_forever(loader, device):
+    """Yields device batches, advancing the sampler's epoch on each pass."""
+    if not len(loader.dataset):
+        raise ValueError('cannot iterate over an empty proxy dataset')
+    epoch = 0
+    while True:
+        if isinstance(loader.sampler, EpochShuffleSampler):
+            loader.sampler.set_epoch(epoch)
+        for batch in loader:
+            yield batch_to(batch, device)
+        epoch += 1
+
+
+def benchmark_loader(get_batch, num_batches, mbsize):
+    """Returns molecules/sec for a zero-arg callable producing batches."""
+    get_batch() # warmup (starts workers, fills prefetch queues)
+    t0 = time.time()
+    for i in range(num_batches):
+        get_batch()
+    return num_batches * mbsize / (time.time() - t0)
@@ -0,0 +1,169 @@
+"""
+Dynamic int8 quantization of the reward proxies for CPU inference.
+
+    model = quantize(proxy_model, modules=('linear', 'rnn'))
+
+The weights of the quantized module types are stored in int8 and their
+activations quantized on the fly, so building the model needs no data.
+Whether the error is acceptable does, so running this file compares the
+float64 proxy with its int8 versions on the docked_mols data:
+ - calibration: on a slice of the train split, picks the most aggressive
+   set of quantized modules whose p99 absolute score error is below
+   --max_abs_error,
+ - validation: reports the score and reward error distributions of that
+   model on the test split, and the per molecule speedup,
+and exits with status 1 if the test p99 error is above --max_abs_error.
+
+    python quantized_proxy.py --proxy graph_agent --proxy_path data/pretrained_proxy
+    python quantized_proxy.py --proxy original --max_abs_error 0.1
+"""
+import argparse
+from copy import deepcopy
+import json
+import sys
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+
+QUANTIZABLE = {'linear': {nn.Linear}, 'rnn': {nn.GRU, nn.LSTM}}
+# most aggressive first
+CANDIDATES = [('linear', 'rnn'), ('linear',)]
+
+
+def quantize(model, modules=('linear', 'rnn')):
+    """int8 copy of model, for float32 inputs on CPU"""
+    types = set().union(*[QUANTIZABLE[m] for m in modules])
+    model = deepcopy(model).float().cpu().eval()
+    return torch.quantization.quantize_dynamic(model, types, dtype=torch.qint8)
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--proxy", default='graph_agent', choices=['graph_agent', 'original'],
+                    help="gflownet.Proxy or reward_proxy.load_original_model")
+parser.add_argument("--proxy_path", default='./data/pretrained_proxy')
+parser.add_argument("--data", default='data/docked_mols.h5')
+parser.add_argument("--num_examples", default=20000, type=int)
+parser.add_argument("--calibration_examples", default=500, type=int)
+parser.add_argument("--timing_examples", default=200, type=int)
+parser.add_argument("--mbsize", default=128, type=int)
+parser.add_argument("--max_abs_error", default=0.05, type=float,
+                    help="acceptable p99 absolute error on the proxy's score")
+parser.add_argument("--reward_exp", default=10, type=float)
+parser.add_argument("--reward_norm", default=8, type=float)
+parser.add_argument("--R_min", default=0.1, type=float)
+parser.add_argument("--out", default='quantized_proxy.json')
+
+
+class _Scorer:
+    """Scores BlockMoleculeDataExtended's with a proxy model, batched"""
+
+    def __init__(self, kind, mdp=None):
+        self.kind = kind
+        self.mdp = mdp
+
+    def batch(self, mols, floatX):
+        if self.kind == 'graph_agent':
+            self.mdp.floatX = floatX
+            return self.mdp.mols2batch([self.mdp.mol2repr(m) for m in mols])
+        import reward_proxy
+        return reward_proxy.mols2batch([reward_proxy.mol2graph(m.mol, floatX=floatX) for m in mols])
+
+    def __call__(self, model, mols, floatX, mbsize):
+        out = []
+        with torch.no_grad():
+            for i in range(0, len(mols), mbsize):
+                b = self.batch(mols[i:i + mbsize], floatX)
+                if self.kind == 'graph_agent':
+                    out.append(model(b, do_stems=False)[1][:, 0])
+                else:
+                    out.append(model(b)[:, 0])
+        return torch.cat(out).double().numpy()
+
+    def time_per_mol(self, model, mols, floatX):
+        t0 = time.perf_counter()
+        for m in mols:
+            self(model, [m], floatX, 1)
+        return (time.perf_counter() - t0) / len(mols)
+
+
+def error_stats(ref, pred):
+    err = np.abs(pred - ref)
+    p50, p90, p99 = np.percentile(err, [50, 90, 99])
+    rank = lambda x: np.argsort(np.argsort(x))
+    return {'mean': float(err.mean()), 'p50': float(p50), 'p90': float(p90),
+            'p99': float(p99), 'max': float(err.max()),
+            'pearson': float(np.corrcoef(ref, pred)[0, 1]),
+            'spearman': float(np.corrcoef(rank(ref), rank(pred))[0, 1])}
+
+
+def main(args):
+    import gflownet
+    from train_proxy import Dataset
+
+    cpu = torch.device('cpu')
+    torch.manual_seed(0)
+    dargs = gflownet.parser.parse_args([])
+    dargs.progress = ''
+    dargs.max_blocks = 10
+    dataset = Dataset(dargs, "data/blocks_PDB_105.json", cpu, floatX=torch.double)
+    dataset.load_h5(args.data, dargs, num_examples=args.num_examples)
+    calib_mols = dataset.train_mols[:args.calibration_examples]
+    test_mols = dataset.test_mols
+    print(len(calib_mols), 'calibration mols,', len(test_mols), 'test mols')
+
+    if args.proxy == 'graph_agent':
+        dargs.proxy_path = args.proxy_path
+        dargs.floatX = torch.double
+        proxy = gflownet.Proxy(dargs, "data/blocks_PDB_105.json", cpu)
+        model, scorer = proxy.proxy, _Scorer('graph_agent', proxy.mdp)
+    else:
+        import reward_proxy
+        model = reward_proxy.load_original_model(args.proxy_path).double()
+        scorer = _Scorer('original')
+    model.eval()
+    r2r = lambda s: (np.maximum(args.R_min, s) / args.reward_norm) ** args.reward_exp
+
+    report = {'args': vars(args), 'calibration': {}}
+    ref = scorer(model, calib_mols, torch.double, args.mbsize)
+    chosen = None
+    for modules in CANDIDATES:
+        qmodel = quantize(model, modules)
+        stats = error_stats(ref, scorer(qmodel, calib_mols, torch.float, args.mbsize))
+        report['calibration']['+'.join(modules)] = stats
+        print(f'calibration {"+".join(modules):>12s}: p99 abs error {stats["p99"]:.4f}')
+        if chosen is None and stats['p99'] <= args.max_abs_error:
+            chosen = modules
+    if chosen is None:
+        chosen = CANDIDATES[-1]
+        print('no configuration is within --max_abs_error, validating', chosen)
+    report['modules'] = chosen
+
+    qmodel = quantize(model, chosen)
+    ref = scorer(model, test_mols, torch.double, args.mbsize)
+    pred = scorer(qmodel, test_mols, torch.float, args.mbsize)
+    report['test'] = {'score': error_stats(ref, pred),
+                      'reward': error_stats(r2r(ref), r2r(pred))}
+    timing_mols = test_mols[:args.timing_examples]
+    t_ref = scorer.time_per_mol(model, timing_mols, torch.double)
+    t_q = scorer.time_per_mol(qmodel, timing_mols, torch.float)
+    report['time_per_mol'] = {'float64': t_ref, 'int8': t_q, 'speedup': t_ref / t_q}
+    report['accepted'] = report['test']['score']['p99'] <= args.max_abs_error
+
+    for k in ('score', 'reward'):
+        s = report['test'][k]
+        print(f'test {k:>6s} abs error: mean {s["mean"]:.4g} p50 {s["p50"]:.4g} '
+              f'p90 {s["p90"]:.4g} p99 {s["p99"]:.4g} max {s["max"]:.4g} '
+              f'spearman {s["spearman"]:.4f}')
+    print(f'{t_ref*1e3:.2f}ms -> {t_q*1e3:.2f}ms per mol, x{t_ref/t_q:.2f}',
+          'accepted' if report['accepted'] else 'rejected')
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=1)
+    return int(not report['accepted'])
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    sys.exit(main(args))
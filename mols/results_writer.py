@@ -0,0 +1,181 @@
+"""
+Background, incremental writer for experiment results.
+
+The trainers used to gzip-pickle every parameter, the whole
+`sampled_mols` list and every loss from scratch on each `save_stuff()`,
+on the learner thread. Here the learner only snapshots what it needs
+(parameters are copied to CPU tensors, growing lists are sliced) and a
+writer thread does the pickling. Growing lists are written as numbered
+shards that only contain the entries added since the previous flush,
+and every file is written to a temporary name then renamed, so a
+crash never leaves a truncated pickle behind.
+
+Layout of `exp_dir`:
+    <name>.pkl.gz            whole objects (`put`), e.g. params, info
+    <name>.<shard>.pkl.gz    pieces of a growing list (`extend`/`stream`)
+
+`load_results(exp_dir)` reassembles the structures the old pickles held.
+"""
+from collections import namedtuple, defaultdict
+import gzip
+import os
+import pickle
+import queue
+import re
+import threading
+
+import torch
+
+
+# Placeholder stored inside a `put` object in lieu of a streamed list,
+# `load_results` replaces it by the concatenated shards.
+StreamRef = namedtuple('StreamRef', ['name'])
+
+_shard_re = re.compile(r'^(.+)\.(\d{5})\.pkl\.gz$')
+_whole_re = re.compile(r'^(.+)\.pkl\.gz$')
+
+
+def _to_numpy(obj):
+    if torch.is_tensor(obj):
+        return obj.numpy()
+    if isinstance(obj, list) and len(obj) and all(torch.is_tensor(i) for i in obj):
+        return [i.numpy() for i in obj]
+    return obj
+
+
+def atomic_pickle(obj, path):
+    tmp = path + '.tmp'
+    with gzip.open(tmp, 'wb') as f:
+        pickle.dump(obj, f)
+    os.replace(tmp, path)
+
+
+class AsyncResultsWriter:
+
+    def __init__(self, exp_dir):
+        self.exp_dir = exp_dir
+        os.makedirs(exp_dir, exist_ok=True)
+        # Shards of a previous run in the same directory would otherwise
+        # be read back as part of this one.
+        for fn in os.listdir(exp_dir):
+            if _shard_re.match(fn):
+                os.remove(os.path.join(exp_dir, fn))
+        self._offsets = defaultdict(int)
+        self._sources = {}
+        self._next_shard = defaultdict(int)
+        self._put_version = defaultdict(int)
+        self._queue = queue.Queue()
+        self.exception = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def snapshot(tensors):
+        """Copies tensors to the CPU now, they are converted to numpy later"""
+        return [i.detach().to('cpu', copy=True) for i in tensors]
+
+    def put(self, name, obj):
+        """Writes `obj` as `<name>.pkl.gz`, replacing the previous version.
+
+        If several versions are queued only the newest is written."""
+        self._put_version[name] += 1
+        self._queue.put(('put', name, self._put_version[name], obj))
+
+    def extend(self, name, items):
+        """Appends `items` to the stream `name` as a new shard"""
+        items = list(items)
+        if not len(items):
+            return
+        self._queue.put(('extend', name, self._next_shard[name], items))
+        self._next_shard[name] += 1
+
+    def stream(self, name, seq):
+        """Appends the entries of the growing list `seq` that were not
+        written yet. Returns a StreamRef that can be embedded in a `put`."""
+        if self._sources.setdefault(name, seq) is not seq:
+            raise ValueError(f'stream {name} was started from another list')
+        n = len(seq)
+        self.extend(name, seq[self._offsets[name]:n])
+        self._offsets[name] = n
+        return StreamRef(name)
+
+    def flush(self):
+        self._queue.join()
+        if self.exception is not None:
+            raise self.exception
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        if self.exception is not None:
+            raise self.exception
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    break
+                self._write(*item)
+            except Exception as e:
+                print("Exception while writing results:")
+                print(e)
+                self.exception = e
+            finally:
+                self._queue.task_done()
+
+    def _write(self, kind, name, idx, payload):
+        if kind == 'put':
+            if idx < self._put_version[name]:
+                return # a newer version is already queued
+            path = os.path.join(self.exp_dir, f'{name}.pkl.gz')
+            atomic_pickle(_to_numpy(payload), path)
+        else:
+            path = os.path.join(self.exp_dir, f'{name}.{idx:05d}.pkl.gz')
+            atomic_pickle(payload, path)
+
+
+def load_stream(exp_dir, name):
+    """Concatenates the shards of a single stream"""
+    files = []
+    for fn in os.listdir(exp_dir):
+        m = _shard_re.match(fn)
+        if m and m.group(1) == name:
+            files.append((int(m.group(2)), fn))
+    items = []
+    for _, fn in sorted(files):
+        with gzip.open(os.path.join(exp_dir, fn), 'rb') as f:
+            items += pickle.load(f)
+    return items
+
+
+def load_results(exp_dir):
+    """Returns {name: object} for everything in `exp_dir`, streams are
+    concatenated and StreamRefs inside dict objects are resolved.
+
+    For mars.py runs, sampled_mols is the final evaluation sample (and
+    is only there once the run is done), the molecules sampled during
+    training are in train_sampled_mols."""
+    objects = {}
+    shards = defaultdict(list)
+    for fn in os.listdir(exp_dir):
+        m = _shard_re.match(fn)
+        if m:
+            shards[m.group(1)].append((int(m.group(2)), fn))
+            continue
+        m = _whole_re.match(fn)
+        if m:
+            with gzip.open(os.path.join(exp_dir, fn), 'rb') as f:
+                objects[m.group(1)] = pickle.load(f)
+    streams = {}
+    for name, files in shards.items():
+        streams[name] = []
+        for _, fn in sorted(files):
+            with gzip.open(os.path.join(exp_dir, fn), 'rb') as f:
+                streams[name] += pickle.load(f)
+    for obj in objects.values():
+        if isinstance(obj, dict):
+            for k, v in obj.items():
+                if isinstance(v, StreamRef):
+                    obj[k] = streams.get(v.name, [])
+    return {**streams, **objects}
@@ -0,0 +1,261 @@
+"""
+A cheap surrogate of the reward proxy, distilled from it, and a cascade
+that only calls the full proxy when the surrogate can't rule a molecule
+out.
+
+The surrogate is a small ensemble of MLPs over either the block counts
+of a molecule (no RDKit involved) or its Morgan fingerprint, trained to
+regress the proxy's score. `CascadeProxy` returns the surrogate's mean
+when mean + k * std (the ensemble's spread) is below a threshold, and
+the full proxy's score otherwise; with audit_prob > 0 a fraction of the
+skipped molecules is also scored by the proxy to keep track of the error
+made by skipping.
+
+    python surrogate.py --proxy_path data/pretrained_proxy --sampled_from results/_0/ --out data/surrogate
+    python gflownet.py --surrogate_path data/surrogate --cascade_threshold 6
+
+Distillation uses docked_mols molecules, molecules sampled by previous
+runs (--sampled_from, see mol_store) and random molecules, and reports,
+on held out molecules, the surrogate's error and for a few thresholds
+how often the proxy would be skipped and the resulting reward error.
+"""
+import argparse
+import gzip
+import json
+import os
+import pickle
+import threading
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+
+class Surrogate(nn.Module):
+
+    def __init__(self, num_blocks, features='block_counts', nhid=256, nlayers=2,
+                 ensemble=5, fp_bits=1024, fp_radius=2):
+        super().__init__()
+        self.config = dict(num_blocks=num_blocks, features=features, nhid=nhid,
+                           nlayers=nlayers, ensemble=ensemble, fp_bits=fp_bits,
+                           fp_radius=fp_radius)
+        self.features = features
+        self.num_blocks = num_blocks
+        self.fp_bits = fp_bits
+        self.fp_radius = fp_radius
+        nin = num_blocks + 1 if features == 'block_counts' else fp_bits
+        self.mlps = nn.ModuleList([
+            nn.Sequential(*sum([[nn.Linear(i, o), nn.LeakyReLU()] for i, o in
+                                zip([nin] + [nhid] * (nlayers - 1), [nhid] * nlayers)], []),
+                          nn.Linear(nhid, 1))
+            for k in range(ensemble)])
+
+    def featurize(self, mols):
+        if self.features == 'block_counts':
+            x = np.zeros((len(mols), self.num_blocks + 1), dtype=np.float32)
+            for i, m in enumerate(mols):
+                x[i, :-1] = np.bincount(m.blockidxs, minlength=self.num_blocks)
+                x[i, -1] = len(m.blockidxs)
+        else:
+            from rdkit.Chem import AllChem
+            x = np.zeros((len(mols), self.fp_bits), dtype=np.float32)
+            for i, m in enumerate(mols):
+                rdmol = m.mol
+                if rdmol is not None:
+                    fp = AllChem.GetMorganFingerprintAsBitVect(rdmol, self.fp_radius, self.fp_bits)
+                    x[i, list(fp.GetOnBits())] = 1
+        return torch.tensor(x)
+
+    def forward(self, x):
+        """(ensemble, n) predictions"""
+        return torch.stack([f(x)[:, 0] for f in self.mlps])
+
+    def predict(self, mols):
+        """mean and std of the ensemble's predictions"""
+        return self.predict_features(self.featurize(mols))
+
+    def predict_features(self, x):
+        """predict for already featurized molecules. The std is the
+        unbiased one, this is what CascadeProxy and the report use"""
+        with torch.no_grad():
+            p = self(x).double()
+        return p.mean(0).numpy(), (p.std(0).numpy() if p.shape[0] > 1 else np.zeros(p.shape[1]))
+
+
+def save_surrogate(surrogate, path, **info):
+    os.makedirs(path, exist_ok=True)
+    with gzip.open(f'{path}/surrogate.pkl.gz', 'wb') as f:
+        pickle.dump({'config': surrogate.config,
+                     'params': [i.data.numpy() for i in surrogate.parameters()],
+                     'info': info}, f)
+
+
+def load_surrogate(path):
+    with gzip.open(f'{path}/surrogate.pkl.gz', 'rb') as f:
+        d = pickle.load(f)
+    surrogate = Surrogate(**d['config'])
+    for a, b in zip(surrogate.parameters(), d['params']):
+        a.data = torch.tensor(b)
+    return surrogate.eval()
+
+
+class CascadeProxy:
+    """Drop-in replacement for `gflownet.Proxy`, see the module docstring.
+    Thread safe, the samplers share it."""
+
+    def __init__(self, proxy, surrogate, threshold, k=1, audit_prob=0.01, seed=0):
+        self.proxy = proxy
+        self.surrogate = surrogate
+        self.threshold = threshold
+        self.k = k
+        self.audit_prob = audit_prob
+        self.rng = np.random.RandomState(seed)
+        self._lock = threading.Lock()
+        self.num_calls = 0
+        self.num_skipped = 0
+        self.audit_errors = []
+
+    def __call__(self, m):
+        mean, std = self.surrogate.predict([m])
+        mean, std = float(mean[0]), float(std[0])
+        with self._lock:
+            self.num_calls += 1
+            skip = mean + self.k * std < self.threshold
+            audit = skip and self.rng.uniform() < self.audit_prob
+            self.num_skipped += skip
+        if not skip:
+            return self.proxy(m)
+        if audit:
+            err = mean - self.proxy(m)
+            with self._lock:
+                self.audit_errors.append(err)
+        return mean
+
+    def stats(self):
+        with self._lock:
+            err = np.abs(self.audit_errors)
+            return {'calls': self.num_calls,
+                    'skipped': self.num_skipped,
+                    'skip_rate': self.num_skipped / max(1, self.num_calls),
+                    'audited': len(err),
+                    'audit_abs_error_mean': float(err.mean()) if len(err) else None,
+                    'audit_abs_error_p99': float(np.percentile(err, 99)) if len(err) else None}
+
+
+def cascade_report(score, mean, std, thresholds, k, r2r):
+    """For each threshold, the fraction of molecules whose proxy call
+    would be skipped and the reward error on those"""
+    out = {}
+    for t in thresholds:
+        skip = mean + k * std < t
+        err = np.abs(r2r(mean[skip]) - r2r(score[skip]))
+        out[str(t)] = {'skip_rate': float(skip.mean()),
+                       'reward_abs_error_mean': float(err.mean()) if skip.any() else 0.,
+                       'reward_abs_error_max': float(err.max()) if skip.any() else 0.,
+                       # how many of the molecules the proxy scores above
+                       # the threshold the cascade would miss
+                       'missed_above_threshold': int((skip & (score >= t)).sum())}
+    return out
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--proxy_path", default='./data/pretrained_proxy')
+parser.add_argument("--data", default='data/docked_mols.h5')
+parser.add_argument("--num_examples", default=20000, type=int)
+parser.add_argument("--sampled_from", default=[], nargs='*', help="experiment dirs with a mol_store")
+parser.add_argument("--num_random", default=20000, type=int)
+parser.add_argument("--max_blocks", default=8, type=int)
+parser.add_argument("--features", default='block_counts', choices=['block_counts', 'morgan'])
+parser.add_argument("--nhid", default=256, type=int)
+parser.add_argument("--nlayers", default=2, type=int)
+parser.add_argument("--ensemble", default=5, type=int)
+parser.add_argument("--learning_rate", default=1e-3, type=float)
+parser.add_argument("--mbsize", default=256, type=int)
+parser.add_argument("--num_epochs", default=50, type=int)
+parser.add_argument("--holdout", default=0.1, type=float)
+parser.add_argument("--cascade_k", default=1, type=float)
+parser.add_argument("--thresholds", default=[4, 5, 6, 7], nargs='+', type=float)
+parser.add_argument("--reward_exp", default=10, type=float)
+parser.add_argument("--reward_norm", default=8, type=float)
+parser.add_argument("--R_min", default=0.1, type=float)
+parser.add_argument("--seed", default=0, type=int)
+parser.add_argument("--out", default='data/surrogate')
+
+
+def proxy_scores(proxy, mols, mbsize):
+    out = []
+    with torch.no_grad():
+        for i in range(0, len(mols), mbsize):
+            b = proxy.mdp.mols2batch([proxy.mdp.mol2repr(m) for m in mols[i:i + mbsize]])
+            out.append(proxy.proxy(b, do_stems=False)[1][:, 0].double().cpu())
+    return torch.cat(out).numpy()
+
+
+def main(args):
+    import gflownet
+    from train_proxy import Dataset
+    from mol_store import load_mol_store, chunk2records, record2mol
+    from bench_mdp import random_mols
+
+    rng = np.random.RandomState(args.seed)
+    torch.manual_seed(args.seed)
+    device = torch.device('cpu')
+    bpath = "data/blocks_PDB_105.json"
+    dargs = gflownet.parser.parse_args([])
+    dargs.progress = ''
+    dargs.max_blocks = 10
+    dargs.proxy_path = args.proxy_path
+    dargs.floatX = torch.double
+    dataset = Dataset(dargs, bpath, device, floatX=torch.double)
+    mdp = dataset.mdp
+    mols = []
+    if args.num_examples:
+        dataset.load_h5(args.data, dargs, num_examples=args.num_examples)
+        mols += dataset.train_mols + dataset.test_mols
+    for exp_dir in args.sampled_from:
+        mols += [record2mol(r, mdp) for r in chunk2records(load_mol_store(exp_dir))]
+    mols += [m for m, _ in random_mols(mdp, rng, args.num_random, args.max_blocks)]
+    print(len(mols), 'molecules')
+
+    proxy = gflownet.Proxy(dargs, bpath, device)
+    score = proxy_scores(proxy, mols, args.mbsize)
+    surrogate = Surrogate(mdp.num_blocks, args.features, args.nhid, args.nlayers, args.ensemble)
+    x = surrogate.featurize(mols)
+    y = torch.tensor(score).float()
+    idx = rng.permutation(len(mols))
+    nval = int(args.holdout * len(mols))
+    val, train = idx[:nval], idx[nval:]
+
+    opt = torch.optim.Adam(surrogate.parameters(), args.learning_rate)
+    for epoch in range(args.num_epochs):
+        # each ensemble member sees its own shuffling of the data
+        perms = [rng.permutation(train) for k in range(args.ensemble)]
+        for i in range(0, len(train), args.mbsize):
+            loss = sum((f(x[p[i:i + args.mbsize]])[:, 0] - y[p[i:i + args.mbsize]]).pow(2).mean()
+                       for f, p in zip(surrogate.mlps, perms))
+            opt.zero_grad()
+            loss.backward()
+            opt.step()
+        with torch.no_grad():
+            val_loss = (surrogate(x[val]).mean(0) - y[val]).pow(2).mean().item()
+        print(epoch, 'val mse', round(val_loss, 4))
+
+    surrogate.eval()
+    # the same mean + k * std as CascadeProxy
+    mean, std = surrogate.predict_features(x[val])
+    err = np.abs(mean - score[val])
+    r2r = lambda s: (np.maximum(args.R_min, s) / args.reward_norm) ** args.reward_exp
+    report = {'num_train': len(train), 'num_val': nval,
+              'score_abs_error': {'mean': float(err.mean()),
+                                  'p90': float(np.percentile(err, 90)),
+                                  'p99': float(np.percentile(err, 99))},
+              'cascade': cascade_report(score[val], mean, std, args.thresholds,
+                                        args.cascade_k, r2r)}
+    print(json.dumps(report, indent=1))
+    save_surrogate(surrogate, args.out, args=vars(args), report=report)
+    return report
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main(args)
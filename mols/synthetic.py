@@ -0,0 +1,70 @@
+"""
+Synthetic stand-ins for the expensive parts of the molecule setup, for
+benchmarking without data, GPU or pretrained proxy:
+ - `make_block_library` generates a block library of any size in the
+   format of data/blocks_PDB_105.json,
+ - `SyntheticProxy` is a cheap, deterministic reward: a seeded random
+   MLP over the counts of each block in the molecule.
+"""
+import json
+
+import numpy as np
+
+
+def make_block_library(num_blocks, seed=0, min_atoms=1, max_atoms=6, max_stems=3):
+    """Returns {'block_name', 'block_smi', 'block_r'} for `num_blocks`
+    blocks made of unique C/N/O chains.
+
+    Like in the PDB library, a block with n attachment atoms appears n
+    times, once with each attachment atom first in its `block_r` (the
+    atom used to attach it), so `build_translation_table` finds all the
+    duplicates it needs without symmetry checks.
+    """
+    rng = np.random.RandomState(seed)
+    smis, rs = [], []
+    seen = set()
+    while len(smis) < num_blocks:
+        n = rng.randint(min_atoms, max_atoms + 1)
+        smi = ''.join(rng.choice(['C', 'C', 'C', 'N', 'O'], n))
+        # atoms that still have a hydrogen to bond through
+        attach = [i for i, a in enumerate(smi) if a in 'CN']
+        if smi in seen or not len(attach):
+            continue
+        seen.add(smi)
+        r = list(rng.choice(attach, rng.randint(1, min(max_stems, len(attach)) + 1),
+                            replace=False))
+        # the duplicates of a block must all be there, so the last block
+        # gets fewer attachment atoms if its group doesn't fit
+        r = r[:num_blocks - len(smis)]
+        for k in range(len(r)):
+            smis.append(smi)
+            rs.append([int(i) for i in r[k:k+1] + r[:k] + r[k+1:]])
+    return {'block_name': {str(i): f'{s}_{j}' for i, (s, j) in
+                           enumerate(zip(smis, [r[0] for r in rs]))},
+            'block_smi': {str(i): s for i, s in enumerate(smis)},
+            'block_r': {str(i): r for i, r in enumerate(rs)}}
+
+
+def write_block_library(path, num_blocks, seed=0, **kw):
+    with open(path, 'w') as f:
+        json.dump(make_block_library(num_blocks, seed, **kw), f)
+    return path
+
+
+class SyntheticProxy:
+    """Drop-in replacement for `gflownet.Proxy`: maps a molecule to a
+    normalized score in [0, max_score) with a random 2 layer MLP over its
+    block counts. No RDKit or torch involved."""
+
+    def __init__(self, mdp, seed=0, nhid=64, max_score=10):
+        rng = np.random.RandomState(seed)
+        n = mdp.num_blocks
+        self.w1 = rng.normal(0, 1 / np.sqrt(4), (n, nhid))
+        self.b1 = rng.normal(0, 1, nhid)
+        self.w2 = rng.normal(0, 1 / np.sqrt(nhid), nhid)
+        self.max_score = max_score
+
+    def __call__(self, m):
+        counts = np.bincount(m.blockidxs, minlength=self.w1.shape[0])
+        h = np.tanh(counts @ self.w1 + self.b1)
+        return self.max_score / (1 + np.exp(-(h @ self.w2)))
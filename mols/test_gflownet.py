@@ -0,0 +1,48 @@
+"""
+    cd mols && python -m pytest test_gflownet.py
+"""
+import os
+
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('rdkit')
+
+import gflownet
+from synthetic import SyntheticProxy
+
+
+BPATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data/blocks_PDB_105.json')
+
+
+def test_subtb_sampling_actions(monkeypatch):
+    """with subtb the model outputs 2 values per mol, the stop logit and
+    the state log-flow, but only the stop logit is an action"""
+    torch.manual_seed(0)
+    args = gflownet.parser.parse_args(['--objective', 'subtb', '--repr_type', 'block_graph',
+                                       '--nemb', '16'])
+    args.min_blocks, args.max_blocks = 2, 6
+    dataset = gflownet.Dataset(args, BPATH, torch.device('cpu'), floatX=torch.double)
+    mdp = dataset.mdp
+    model = gflownet.make_model(args, mdp, out_per_mol=2).double()
+
+    num_stems = []
+    def sampling_model(s):
+        s_o, m_o = model(s)
+        assert m_o.shape == (1, 2)
+        num_stems.append(s_o.shape[0])
+        return s_o, m_o
+    num_actions = []
+    Categorical = torch.distributions.Categorical
+    def recording_categorical(logits):
+        num_actions.append(logits.shape[0])
+        return Categorical(logits=logits)
+    monkeypatch.setattr(torch.distributions, 'Categorical', recording_categorical)
+
+    dataset.set_sampling_model(sampling_model, SyntheticProxy(mdp))
+    for i in range(5):
+        samples = dataset._get_sample_model()
+        assert len(samples) == 1 # a whole trajectory
+    assert len(num_actions) and len(num_actions) == len(num_stems)
+    for n, k in zip(num_actions, num_stems):
+        assert n == 1 + mdp.num_blocks * k
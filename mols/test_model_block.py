@@ -0,0 +1,44 @@
+"""
+    cd mols && python -m pytest test_model_block.py
+"""
+import os
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('rdkit')
+
+from bench_mdp import random_mols
+from mol_mdp_ext import MolMDPExtended
+import model_block
+
+
+BPATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data/blocks_PDB_105.json')
+
+
+@pytest.mark.parametrize('version', ['v2', 'v4'])
+def test_inference_forward_matches_forward(version):
+    """the fused no_grad forward against the regular one, on random molecules"""
+    torch.manual_seed(0)
+    rng = np.random.RandomState(0)
+    mdp = MolMDPExtended(BPATH)
+    mdp.post_init(torch.device('cpu'), 'block_graph')
+    mdp.build_translation_table()
+    mdp.floatX = torch.double
+    mols = [m for m, _ in random_mols(mdp, rng, 32, 8)]
+    nvec = 4 if version == 'v2' else 0
+    model = model_block.GraphAgent(nemb=16, nvec=nvec, out_per_stem=mdp.num_blocks,
+                                   out_per_mol=2, num_conv_steps=4, mdp_cfg=mdp,
+                                   version=version).double().eval()
+    vec = torch.randn(len(mols), nvec, dtype=torch.double) if nvec else None
+    # forward overwrites the batch's features, so each call gets its own
+    batch = lambda: mdp.mols2batch([mdp.mol2repr(m) for m in mols])
+    with torch.no_grad():
+        model.fused_inference = False
+        eager = model(batch(), vec)
+        model.fused_inference = True
+        fused = model(batch(), vec)
+    for x, y in zip(eager, fused):
+        assert x.shape == y.shape
+        assert torch.allclose(x, y, rtol=1e-6, atol=1e-8)
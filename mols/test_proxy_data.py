@@ -0,0 +1,41 @@
+"""
+    cd mols && python -m pytest test_proxy_data.py
+"""
+import os
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('rdkit')
+
+from bench_mdp import random_mols
+from mol_mdp_ext import MolMDPExtended
+import model_fingerprint
+from proxy_data import make_proxy_loader, iterate_forever, batch_to
+
+
+BPATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data/blocks_PDB_105.json')
+
+
+def test_fingerprint_loader():
+    """the morgan_fingerprint path of train_proxy, through the DataLoader"""
+    rng = np.random.RandomState(0)
+    mdp = MolMDPExtended(BPATH)
+    mdp.post_init(torch.device('cpu'), 'morgan_fingerprint')
+    mdp.build_translation_table()
+    mdp.floatX = torch.float
+    mols = []
+    for m, _ in random_mols(mdp, rng, 16, 4):
+        m.reward = rng.uniform()
+        mols.append(m)
+    loader = make_proxy_loader(mols, mdp, 8, num_workers=0)
+    s, r = next(iterate_forever(loader, torch.device('cpu')))
+    assert isinstance(s, model_fingerprint.FPBatch) and s.num_graphs == 8
+    model = model_fingerprint.MFP_MLP(16, 0, mdp.num_blocks, 1)
+    stem_o, mol_o = model(s)
+    assert mol_o.shape == (8, 1)
+    # what pin_memory makes of an FPBatch
+    s2, r2 = batch_to((list(s), r), torch.device('cpu'))
+    assert isinstance(s2, model_fingerprint.FPBatch)
+    assert all(torch.equal(a, b) for a, b in zip(s, s2))
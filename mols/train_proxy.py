@@ -8,7 +8,6 @@ import os
 import os.path as osp
 import pickle
 import psutil
-import pdb
 import subprocess
 import sys
 import threading
@@ -32,6 +31,8 @@ from utils import chem
 from mol_mdp_ext import MolMDPExtended, BlockMoleculeDataExtended
 
 import model_atom, model_block, model_fingerprint
+from execution import add_execution_args, setup_execution
+from proxy_data import make_proxy_loader, iterate_forever, batch_to
 
 tmp_dir = "/tmp/molexp"
 
@@ -53,6 +54,9 @@ parser.add_argument("--save_path", default='results/')
 parser.add_argument("--print_array_length", default=False, action='store_true')
 parser.add_argument("--progress", default='yes')
 parser.add_argument("--dump_episodes", default='')
+parser.add_argument("--num_workers", default=8, help="DataLoader worker processes", type=int)
+parser.add_argument("--data_seed", default=0, help="Seed of the epoch order", type=int)
+add_execution_args(parser)
 
 
 
@@ -141,7 +145,7 @@ class Dataset(_Dataset):
 
 def main(args):
     bpath = "data/blocks_PDB_105.json"
-    device = torch.device('cuda')
+    device = setup_execution(args, worker_processes=args.num_workers)
 
     dataset = Dataset(args, bpath, device, floatX=torch.float)
     dataset.load_h5("data/docked_mols.h5", args)
@@ -177,8 +181,7 @@ def main(args):
                                      version=args.model_version)
         model.to(device)
     elif args.repr_type == 'morgan_fingerprint':
-        raise ValueError('reimplement me')
-        model = model_fingerprint.MFP_MLP(args.nemb, 3, mdp.num_blocks, 1)
+        model = model_fingerprint.MFP_MLP(args.nemb, 0, mdp.num_blocks, 1)
         model.to(device)
 
 
@@ -195,14 +198,18 @@ def main(args):
     ar = torch.arange(mbsize)
 
     if not debug_no_threads:
-        sampler = dataset.start_samplers(8, mbsize)
+        train_loader = make_proxy_loader(dataset.train_mols, mdp, mbsize,
+                                         num_workers=args.num_workers,
+                                         seed=args.data_seed)
+        sampler = iterate_forever(train_loader, device)
+    test_loader = make_proxy_loader(dataset.test_mols, mdp, max(mbsize, 128),
+                                    num_workers=0, shuffle=False)
 
     last_losses = []
 
     def stop_everything():
         stop_event.set()
         print('joining')
-        dataset.stop_samplers_and_join()
 
     def save_stuff():
         pickle.dump([i.data.cpu().numpy() for i in model.parameters()],
@@ -235,15 +242,9 @@ def main(args):
 
     for i in range(args.num_iterations+1):
         if not debug_no_threads:
-            r = sampler()
-            for thread in dataset.sampler_threads:
-                if thread.failed:
-                    stop_event.set()
-                    stop_everything()
-                    pdb.post_mortem(thread.exception.__traceback__)
-            s, r = r
+            s, r = next(sampler)
         else:
-            p, pb, a, r, s, d = dataset.sample2batch(dataset.sample(mbsize))
+            s, r = dataset.sample2batch(dataset.sample(mbsize))
 
         # state outputs
         stem_out_s, mol_out_s = model(s, None, do_stems=False)
@@ -274,7 +275,7 @@ def main(args):
             total_test_n = 0
             all_nlls = []
             all_ts = []
-            for s, r in dataset.itertest(max(mbsize, 128)):
+            for s, r in map(lambda b: batch_to(b, device), test_loader):
                 with torch.no_grad():
                     stem_o, mol_o = model(s, None, do_stems=False)
                     loss = (mol_o[:, 0] - r).pow(2)
@@ -88,6 +88,20 @@ def mol_from_frag(jun_bonds, frags=None, frag_smis=None, coord=None, optimize=Fa
     return mol, mol_bonds
 
 
+def get_fp(mol, fp_len, fp_radiis, from_atoms=None):
+    """Morgan bit fingerprints of mol for each radius, concatenated. With
+    from_atoms, only the environments of these atoms are included."""
+    fps = []
+    for r in fp_radiis:
+        fp = np.zeros(fp_len, dtype=np.float32)
+        if mol is not None:
+            kw = {} if from_atoms is None else {'fromAtoms': [int(i) for i in from_atoms]}
+            bv = AllChem.GetMorganFingerprintAsBitVect(mol, r, nBits=fp_len, **kw)
+            fp[list(bv.GetOnBits())] = 1
+        fps.append(fp)
+    return np.concatenate(fps)
+
+
 class FPEmbedding_v2:
     def __init__(self, mol_fp_len, mol_fp_radiis, stem_fp_len, stem_fp_radiis):
         self.mol_fp_len = mol_fp_len
@@ -95,7 +109,9 @@ class FPEmbedding_v2:
         self.stem_fp_len = stem_fp_len
         self.stem_fp_radiis = stem_fp_radiis
 
-    def __call__(self, molecule):
+    def __call__(self, molecule, non_empty=False):
+        """With non_empty, molecules without stems or junction bonds get a
+        single all-zero stem or bond row instead of none"""
         mol = molecule.mol
         mol_fp = get_fp(mol, self.mol_fp_len, self.mol_fp_radiis)
 
@@ -107,14 +123,15 @@ class FPEmbedding_v2:
                      get_fp(mol, self.stem_fp_len, self.stem_fp_radiis, [idx[1]]))/2.
                      for idx in molecule.jbond_atmidxs]
 
+        n = int(non_empty)
         if len(stem_fps) > 0:
             stem_fps = np.stack(stem_fps, 0)
         else:
-            stem_fps = np.empty(shape=[0, self.stem_fp_len * len(self.stem_fp_radiis)], dtype=np.float32)
+            stem_fps = np.zeros(shape=[n, self.stem_fp_len * len(self.stem_fp_radiis)], dtype=np.float32)
         if len(jbond_fps) > 0:
             jbond_fps = np.stack(jbond_fps, 0)
         else:
-            jbond_fps = np.empty(shape=[0, self.stem_fp_len * len(self.stem_fp_radiis)], dtype=np.float32)
+            jbond_fps = np.zeros(shape=[n, self.stem_fp_len * len(self.stem_fp_radiis)], dtype=np.float32)
         return mol_fp, stem_fps, jbond_fps
 
 